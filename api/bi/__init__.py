@@ -8,6 +8,7 @@ from .metrics import router as metrics
 from .smart_search import router as search_router
 from .download_csv import router as csv_download_router
 from .json_uploading import router as uploading_router
+from .dashboard import router as dashboard_router
 
 routers = [piecharts, histograms, filters, timelines, other_graphics,
-           metrics, tables, search_router, csv_download_router, uploading_router]
+           metrics, tables, search_router, csv_download_router, uploading_router, dashboard_router]
@@ -0,0 +1,121 @@
+import asyncio
+from typing import Annotated, Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import APIRouter, Depends
+
+from api.bi.histograms import build_tags_sentiment_histogram, financial_sentiment_histogram
+from api.bi.metrics import (
+    build_count_comments, build_average_sentiment, build_average_mark, build_cluster_metric
+)
+from api.bi.piecharts import build_sentiment_distribution, build_service_distribution
+from api.bi.timelines import (
+    count_timeline, rating_timeline, tags_count_timeline, avg_tag_mark, key_rate_tags_mark_correlation
+)
+from api.bi.unusual import (
+    build_negative_pareto, build_tags_scatter, tags_treemap, tags_correlation, word_cloud
+)
+from api.models.Filter import Filters
+from api.models.dashboard import DashboardBundleRequest, DashboardBundleResponse
+from api.src.clickhouse import get_clickhouse
+from api.utils.aggregations import fetch_tag_stats, fetch_service_stats, fetch_positive_rating_share
+
+router = APIRouter(prefix="/dashboard")
+
+
+class DashboardSources:
+    """
+    memoizes shared scans for one bundle, so widgets built from the same
+    ARRAY JOIN / GROUP BY result trigger a single clickhouse query
+    """
+
+    def __init__(self, connection, filters: Filters, top_n: Optional[int] = None):
+        self.connection = connection
+        self.filters = filters
+        self.top_n = top_n
+        self._tasks: Dict[Callable, asyncio.Future] = {}
+
+    def get(self, fetcher: Callable[..., Awaitable[Any]]) -> asyncio.Future:
+        if fetcher not in self._tasks:
+            self._tasks[fetcher] = asyncio.ensure_future(fetcher(self.connection, self.filters))
+        return self._tasks[fetcher]
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+
+async def _sentiment_distribution(s: DashboardSources):
+    tag_stats, mean_sentiment = await asyncio.gather(
+        s.get(fetch_tag_stats), s.get(fetch_positive_rating_share)
+    )
+    return build_sentiment_distribution(tag_stats, mean_sentiment)
+
+
+WIDGETS: Dict[str, Callable[[DashboardSources], Awaitable[Any]]] = {
+    "metrics/count_comments":
+        lambda s: _build(build_count_comments, s.get(fetch_service_stats)),
+    "metrics/average_sentiment":
+        lambda s: _build(build_average_sentiment, s.get(fetch_tag_stats)),
+    "metrics/average_mark":
+        lambda s: _build(build_average_mark, s.get(fetch_service_stats)),
+    "metrics/most_liked_cluster":
+        lambda s: _build(lambda st: build_cluster_metric(st, reversed=True), s.get(fetch_tag_stats)),
+    "metrics/most_disliked_cluster":
+        lambda s: _build(lambda st: build_cluster_metric(st, reversed=False), s.get(fetch_tag_stats)),
+    "pie/sentiment_distribution": _sentiment_distribution,
+    "pie/service_distribution":
+        lambda s: _build(build_service_distribution, s.get(fetch_service_stats)),
+    "histograms/tags_sentiment_histogram":
+        lambda s: _build(lambda st: build_tags_sentiment_histogram(st, s.top_n), s.get(fetch_tag_stats)),
+    "histograms/fin_tags_sentiment_histogram":
+        lambda s: financial_sentiment_histogram(s.connection, s.filters),
+    "timeline/count_timeline":
+        lambda s: count_timeline(s.connection, s.filters),
+    "timeline/rating_timeline":
+        lambda s: rating_timeline(s.connection, s.filters),
+    "timeline/tags_count_timeline":
+        lambda s: tags_count_timeline(s.connection, s.filters),
+    "timeline/avg_tags_mark":
+        lambda s: avg_tag_mark(s.connection, s.filters),
+    "timeline/key_rate_tags_mark_correlation":
+        lambda s: key_rate_tags_mark_correlation(s.connection, s.filters),
+    "unusual_graphics/tags_treemap":
+        lambda s: tags_treemap(s.connection, s.filters),
+    "unusual_graphics/pareto":
+        lambda s: _build(build_negative_pareto, s.get(fetch_tag_stats)),
+    "unusual_graphics/tags_scatter":
+        lambda s: _build(build_tags_scatter, s.get(fetch_tag_stats)),
+    "unusual_graphics/tags_correlation":
+        lambda s: tags_correlation(s.connection, s.filters),
+    "unusual_graphics/wordcloud":
+        lambda s: word_cloud(s.connection, s.filters),
+}
+
+
+async def _build(builder: Callable[[Any], Any], source: Awaitable[Any]):
+    return builder(await source)
+
+
+@router.post("/bundle", response_model=DashboardBundleResponse)
+async def dashboard_bundle(
+        connection: Annotated[Any, Depends(get_clickhouse)],
+        request: DashboardBundleRequest,
+):
+    """
+    computes every requested widget for one filter set in a single round-trip.
+    widgets sharing a scan (per-tag stats, per-service stats) reuse one query,
+    the rest run concurrently. if one widget fails, the others are cancelled and the error is returned
+    """
+    sources = DashboardSources(connection, request.filters, request.top_n)
+    widget_ids = list(dict.fromkeys(request.widgets))
+    tasks = [asyncio.ensure_future(WIDGETS[w](sources)) for w in widget_ids]
+    try:
+        payloads = await asyncio.gather(*tasks)
+    except BaseException:
+        # gather не отменяет соседей: без этого оставшиеся запросы к clickhouse доработали бы впустую
+        for task in tasks:
+            task.cancel()
+        sources.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return DashboardBundleResponse(widgets=dict(zip(widget_ids, payloads)))
@@ -1,98 +1,127 @@
-from fastapi import APIRouter, Depends
+from contextlib import aclosing
+
+from fastapi import APIRouter, Depends, Query
 from fastapi.responses import StreamingResponse
 from api.models.Filter import Filters, get_filters
-from api.utils.clauses_generation import generate_where_clause
-from api.src.clickhouse import get_clickhouse
-from typing import Annotated, Any
+from api.utils.clauses_generation import WhereClause, generate_where_clause
+from api.utils.planner import tag_stats_query
+from api.src.clickhouse import ClickHousePool, get_export_clickhouse, settings
+from typing import Annotated, Any, List, Literal
 import csv
 import io
 
 router = APIRouter(prefix="/csv")
 
+ExportFormat = Literal["csv", "parquet", "arrow"]
+
+# форматы, которые ClickHouse отдаёт сам: (формат ClickHouse, media type, расширение файла)
+NATIVE_FORMATS = {
+    "parquet": ("Parquet", "application/vnd.apache.parquet", "parquet"),
+    "arrow": ("ArrowStream", "application/vnd.apache.arrow.stream", "arrow"),
+}
+
+
+async def _csv_chunks(connection: ClickHousePool, query: str, where: WhereClause, columns: List[str]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    # вложенный генератор закрываем явно, иначе его поток и клиент освободит только сборщик мусора
+    async with aclosing(connection.stream_rows(query, **where.query_args())) as blocks:
+        async for block in blocks:
+            writer.writerows(block)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+class ExportResponse(StreamingResponse):
+    """
+    closes the body generator as soon as the response ends, an aborted download included,
+    so the clickhouse stream and its client go back to the export pool right away
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+
+def export_response(connection: ClickHousePool, query: str, where: WhereClause, columns: List[str],
+                    filename: str, fmt: ExportFormat) -> StreamingResponse:
+    """
+    streams the query result without materializing it: csv is encoded block by block,
+    parquet/arrow are produced by clickhouse and passed through as is (column names come from the query aliases)
+    """
+    if fmt == "csv":
+        body = _csv_chunks(connection, query, where, columns)
+        media_type, extension = "text/csv", "csv"
+    else:
+        ch_format, media_type, extension = NATIVE_FORMATS[fmt]
+        body = connection.stream_raw(
+            query, ch_format, **where.query_args(), chunk_size=settings.clickhouse_export_chunk_size,
+        )
+    return ExportResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}.{extension}"}
+    )
+
 
 @router.get("/tags_statistic")
 async def download_tags_statistic(
-    connection: Annotated[Any, Depends(get_clickhouse)],
+    connection: Annotated[Any, Depends(get_export_clickhouse)],
     filters: Filters = Depends(get_filters),
+    format: ExportFormat = Query("csv"),
 ):
+    tag_stats, where = tag_stats_query(filters)
     query = f"""
         SELECT
             tag,
-            count(*) AS mentions,
-            sum(if(sentiment = 1, 1, 0)) AS positive,
-            sum(if(sentiment = 0, 1, 0)) AS neutral,
-            sum(if(sentiment = -1, 1, 0)) AS negative,
-            floor(AVG(rating), 2) AS avg_rating
-        FROM
-        (
-            SELECT
-                arrayJoin(mapKeys(tags)) AS tag,
-                arrayJoin(mapValues(tags)) AS sentiment,
-                rating
-            FROM comments
-            WHERE {generate_where_clause(filters)}
-        )
-        GROUP BY tag
+            mentions,
+            positive,
+            neutral,
+            negative,
+            floor(rating_sum / mentions, 2) AS avg_rating,
+            100 * round(positive / mentions, 2) AS avg_sentiment
+        FROM ({tag_stats})
         ORDER BY mentions DESC
     """
-    rows = connection.query(query).result_rows
-    for i in range(len(rows)):
-        rows[i] = list(rows[i])
-        rows[i].append(100 * round(rows[i][2] / rows[i][1], 2))
     columns = ["сервис/услуга", "кол-во упоминаний", "позитивных упоминаний", "нейтральных упоминаний",
                "негативных упоминаний", "ср. рейтинг", "ср. сентимент"]
-
-    buffer = io.StringIO()
-    writer = csv.writer(buffer)
-    writer.writerow(columns)
-    writer.writerows(rows)
-    buffer.seek(0)
-
-    return StreamingResponse(
-        buffer,
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=tags_statistic.csv"}
-    )
+    return export_response(connection, query, where, columns, "tags_statistic", format)
 
 
 @router.get("/timeline")
 async def download_timeline(
-    connection: Annotated[Any, Depends(get_clickhouse)],
+    connection: Annotated[Any, Depends(get_export_clickhouse)],
     filters: Filters = Depends(get_filters),
+    format: ExportFormat = Query("csv"),
 ):
+    tag_stats, where = tag_stats_query(filters, group_by=("date",))
     query = f"""
         SELECT
             date,
-            count() AS reviews_count,
-            round(AVG(rating), 2) AS avg_rating,
-            round(AVG(sentiment * 50 + 50), 2) AS avg_sentiment
-        FROM comments
-        ARRAY JOIN mapValues(tags) AS sentiment
-        WHERE {generate_where_clause(filters)}
-        GROUP BY date
+            mentions AS reviews_count,
+            round(rating_sum / mentions, 2) AS avg_rating,
+            round(sentiment_sum / mentions * 50 + 50, 2) AS avg_sentiment
+        FROM ({tag_stats})
         ORDER BY date
     """
-    rows = connection.query(query).result_rows
     columns = ["дата", "кол-во отзывов", "ср. рейтинг", "ср. сентимент"]
-
-    buffer = io.StringIO()
-    writer = csv.writer(buffer)
-    writer.writerow(columns)
-    writer.writerows(rows)
-    buffer.seek(0)
-
-    return StreamingResponse(
-        buffer,
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=timeline.csv"}
-    )
+    return export_response(connection, query, where, columns, "timeline", format)
 
 
 @router.get("/data_table")
 async def data_table(
-    connection: Annotated[Any, Depends(get_clickhouse)],
+    connection: Annotated[Any, Depends(get_export_clickhouse)],
     filters: Filters = Depends(get_filters),
+    format: ExportFormat = Query("csv"),
 ):
+    where = generate_where_clause(filters)
     query = f"""
         SELECT
             date,
@@ -104,22 +133,8 @@ async def data_table(
             tags,
             source
         FROM comments
-        WHERE {generate_where_clause(filters)}
+        WHERE {where}
         ORDER BY date DESC
-        LIMIT 5000
     """
-    rows = connection.query(query).result_rows
     columns = ["дата", "отзыв", "имя", "рейтинг", "банк", "сервис", "продукты/услуги", "источник получения"]
-
-    buffer = io.StringIO()
-    writer = csv.writer(buffer)
-    writer.writerow(columns)
-    writer.writerows(rows)
-    buffer.seek(0)
-
-    return StreamingResponse(
-        buffer,
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=timeline.csv"}
-    )
-
+    return export_response(connection, query, where, columns, "data_table", format)
@@ -1,21 +1,28 @@
 from fastapi import APIRouter, Depends
 from typing import Annotated, Any
+from api.src.cache import cached
 from api.src.clickhouse import get_clickhouse
-from api.utils.clauses_generation import generate_where_clause
+from api.utils.clauses_generation import generate_tags_where_clause
 from api.models.Filter import Filters, get_filters
+import asyncio
 import uuid
 
 router = APIRouter(prefix="/filter")
 
 
 @router.get("/available_filter_values")
+@cached("filter/available_filter_values", ttl=3600)
 async def available_filter_values(
         connection: Annotated[Any, Depends(get_clickhouse)]
 ):
-    banks = connection.query("SELECT DISTINCT bank FROM comments").result_rows
-    services = connection.query("SELECT DISTINCT service FROM comments").result_rows
-    ratings = connection.query("SELECT MIN(rating), MAX(rating) FROM comments").result_rows
-    dates = connection.query("SELECT MIN(date), MAX(date) FROM comments").result_rows
+    banks, services, ratings, dates = [
+        result.result_rows for result in await asyncio.gather(
+            connection.query("SELECT DISTINCT bank FROM comments"),
+            connection.query("SELECT DISTINCT service FROM comments"),
+            connection.query("SELECT MIN(rating), MAX(rating) FROM comments"),
+            connection.query("SELECT MIN(date), MAX(date) FROM comments"),
+        )
+    ]
 
     return {
         "id": str(uuid.uuid4()),
@@ -49,14 +56,16 @@ async def available_filter_values(
 
 
 @router.get("/distinct_tags")
+@cached("filter/distinct_tags")
 async def dist_tags(connection: Annotated[Any, Depends(get_clickhouse)],
                     filters: Filters = Depends(get_filters)):
-    rows = connection.query(
+    where = generate_tags_where_clause(filters)
+    rows = (await connection.query(
         f"""
-            SELECT DISTINCT key
-            FROM comments
-            ARRAY JOIN mapKeys(tags) AS key
-            WHERE {generate_where_clause(filters)}
-            """
-    ).result_columns
+            SELECT DISTINCT tag
+            FROM comment_tags
+            WHERE {where}
+            """,
+        **where.query_args(),
+    )).result_columns
     return {"tags": rows[0]}
@@ -1,48 +1,26 @@
 from fastapi import APIRouter, Depends, Query
-from typing import Annotated, Any, Optional
+from typing import Annotated, Any, List, Optional
+from api.src.cache import cached
 from api.src.clickhouse import get_clickhouse
 from api.models.histogram import ClusterBarsResponse, ClusterBarRow
 from api.models.Filter import Filters, get_filters
-from api.utils.clauses_generation import generate_where_clause
+from api.utils.aggregations import TagStat, fetch_tag_stats
+from api.utils.planner import tag_stats_query
 
 
 router = APIRouter(prefix="/histograms")
 
 
-@router.get("/tags_sentiment_histogram", response_model=ClusterBarsResponse)
-async def tags_sentiment_histogram(
-    connection: Annotated[Any, Depends(get_clickhouse)],
-    filters: Filters = Depends(get_filters),
-    top_n: Optional[int] = Query(None)
-):
-    query = f"""
-        SELECT
-            tag,
-            sum(if(sentiment = 1, 1, 0)) AS positive,
-            sum(if(sentiment = 0, 1, 0)) AS neutral,
-            sum(if(sentiment = -1, 1, 0)) AS negative,
-            count(*) AS mentions
-        FROM
-        (
-            SELECT arrayJoin(mapKeys(tags)) AS tag, arrayJoin(mapValues(tags)) AS sentiment
-            FROM comments
-            WHERE {generate_where_clause(filters)}
-        )
-        GROUP BY tag
-        ORDER BY mentions DESC
-        {'LIMIT ' + str(top_n) if top_n else ''}
-    """
-    rows = connection.query(query).result_rows
-
+def build_tags_sentiment_histogram(stats: List[TagStat], top_n: Optional[int] = None) -> ClusterBarsResponse:
     data = [
         ClusterBarRow(
-            name=row[0],
-            mentions=row[4],
-            positive=row[1],
-            neutral=row[2],
-            negative=row[3]
+            name=s.tag,
+            mentions=s.mentions,
+            positive=s.positive,
+            neutral=s.neutral,
+            negative=s.negative
         )
-        for row in rows
+        for s in (stats[:top_n] if top_n else stats)
     ]
 
     response = ClusterBarsResponse(
@@ -53,26 +31,28 @@ async def tags_sentiment_histogram(
     return response
 
 
+@router.get("/tags_sentiment_histogram", response_model=ClusterBarsResponse)
+async def tags_sentiment_histogram(
+    connection: Annotated[Any, Depends(get_clickhouse)],
+    filters: Filters = Depends(get_filters),
+    top_n: Optional[int] = Query(None)
+):
+    return build_tags_sentiment_histogram(await fetch_tag_stats(connection, filters), top_n)
+
+
 @router.get("/fin_tags_sentiment_histogram", response_model=ClusterBarsResponse)
+@cached("histograms/fin_tags_sentiment_histogram")
 async def financial_sentiment_histogram(
     connection: Annotated[Any, Depends(get_clickhouse)],
     filters: Filters = Depends(get_filters)
 ):
+    tag_stats, where = tag_stats_query(filters)
     query = f"""
-         SELECT
-	        key,
-	        sum(if(value = 1, 1, 0)),
-	        sum(if(value = 0, 1, 0)),
-	        sum(if(value = -1, 1, 0)),
-	        count(*)
-        FROM comments
-	        ARRAY JOIN
-		        mapKeys(tags) AS key,
-		        mapValues(tags) AS value
-        WHERE key in (SELECT category FROM financial_categories) AND {generate_where_clause(filters)}
-        GROUP BY key
-     """
-    rows = connection.query(query).result_rows
+        SELECT tag, positive, neutral, negative, mentions
+        FROM ({tag_stats})
+        WHERE tag IN (SELECT category FROM financial_categories)
+    """
+    rows = (await connection.query(query, **where.query_args())).result_rows
 
     data = [
         ClusterBarRow(
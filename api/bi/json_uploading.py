@@ -1,10 +1,11 @@
-import os
 from typing import List
 from datetime import datetime
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-import aio_pika
+
+from api.src.amqp import publisher
+from common.amqp import PublishError, QueueFullError
 
 router = APIRouter(prefix="/data_uploading")
 
@@ -28,29 +29,32 @@ class RawComment(BaseModel):
 
 @router.post("/upload_json")
 async def upload_json(msg: List[InferenceComment], uploading_date: datetime):
+    bodies = [
+        RawComment(
+            date=uploading_date,
+            comment=comm.text,
+            name="",
+            rating=0,
+            bank="газпромбанк",
+            service="внешняя загрузка",
+            source="uploading",
+        )
+        .model_dump_json()
+        .encode()
+        for comm in msg
+    ]
     try:
-        connection = await aio_pika.connect_robust(os.getenv("AMQP_DSN"))
-        async with connection:
-            channel = await connection.channel()
-            queue = await channel.declare_queue(QUEUE_NAME, durable=True)
-
-            for comm in msg:
-                await channel.default_exchange.publish(
-                    aio_pika.Message(
-                        body=RawComment(
-                            date=uploading_date,
-                            comment=comm.text,
-                            name="",
-                            rating=0,
-                            bank="газпромбанк",
-                            service="внешняя загрузка",
-                            source="uploading",
-                        )
-                        .model_dump_json()
-                        .encode()
-                    ),
-                    routing_key=queue.name,
-                )
-        return {"status": "successfull", "detail": ""}
-    except Exception as exc:
-        return {"status": "error", "detail": exc}
+        published = await publisher.publish(QUEUE_NAME, bodies)
+    except QueueFullError as exc:
+        # очередь переполнена: клиенту стоит повторить загрузку оставшихся комментариев позже
+        raise HTTPException(
+            status_code=503,
+            detail={"message": str(exc), "published": exc.published, "total": len(bodies)},
+        )
+    except PublishError as exc:
+        # брокер недоступен или не подтвердил пачку, как и для ml-сервиса отвечаем 502
+        raise HTTPException(
+            status_code=502,
+            detail={"message": str(exc), "published": exc.published, "total": len(bodies)},
+        )
+    return {"status": "successfull", "detail": "", "published": published, "total": len(bodies)}
@@ -1,24 +1,53 @@
+import math
 from fastapi import APIRouter, Depends
-from typing import Annotated, Any
+from typing import Annotated, Any, List
 from api.src.clickhouse import get_clickhouse
 import uuid
-from api.utils.clusters import get_cluster_info
-from api.utils.clauses_generation import generate_where_clause
+from api.utils.aggregations import TagStat, ServiceStat, fetch_tag_stats, fetch_service_stats
+from api.utils.clusters import cluster_info_from_stats
 from api.models.Filter import Filters, get_filters
 
 router = APIRouter(prefix="/metrics")
 
 
+def build_count_comments(stats: List[ServiceStat]):
+    return {
+        'id': str(uuid.uuid4()),
+        'value': str(sum(s.comments for s in stats))
+    }
+
+
+def build_average_sentiment(stats: List[TagStat]):
+    mentions = sum(s.mentions for s in stats)
+    value = math.floor(sum(s.sentiment_sum for s in stats) / mentions * 50 + 50) if mentions else 0
+    return {
+        'id': str(uuid.uuid4()),
+        'value': str(value)
+    }
+
+
+def build_average_mark(stats: List[ServiceStat]):
+    comments = sum(s.comments for s in stats)
+    value = math.floor(sum(s.rating_sum for s in stats) / comments * 100) / 100 if comments else 0
+    return {
+        'id': str(uuid.uuid4()),
+        'value': str(value)
+    }
+
+
+def build_cluster_metric(stats: List[TagStat], reversed: bool):
+    return {
+        'id': str(uuid.uuid4()),
+        'value': cluster_info_from_stats(stats, reversed=reversed)[0]['cluster'],
+    }
+
+
 @router.get("/count_comments")
 async def count_comments(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
-    data = connection.query(f"SELECT COUNT(*) FROM comments WHERE {generate_where_clause(filters)}").result_rows
-    return {
-        'id': str(uuid.uuid4()),
-        'value': str(data[0][0])
-    }
+    return build_count_comments(await fetch_service_stats(connection, filters))
 
 
 @router.get('/average_sentiment')
@@ -26,17 +55,7 @@ async def average_sentiment(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
-    data = connection.query(f"""
-    SELECT
-        floor(AVG(val * 50 + 50)) AS value
-    FROM comments
-        ARRAY JOIN mapValues(tags) AS val
-        WHERE {generate_where_clause(filters)}
-    """).result_rows
-    return {
-        'id': str(uuid.uuid4()),
-        'value': str(int(data[0][0]))
-    }
+    return build_average_sentiment(await fetch_tag_stats(connection, filters))
 
 
 @router.get('/average_mark')
@@ -44,13 +63,7 @@ async def average_mark(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
-    data = connection.query(f"""
-        SELECT floor(AVG(rating), 2) FROM comments WHERE {generate_where_clause(filters)}
-    """).result_rows
-    return {
-        'id': str(uuid.uuid4()),
-        'value': str(data[0][0])
-    }
+    return build_average_mark(await fetch_service_stats(connection, filters))
 
 
 @router.get('/most_liked_cluster')
@@ -58,10 +71,7 @@ async def most_liked_cluster(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
-    return {
-        'id': str(uuid.uuid4()),
-        'value': get_cluster_info(connection, filters)[0]['cluster'],
-    }
+    return build_cluster_metric(await fetch_tag_stats(connection, filters), reversed=True)
 
 
 @router.get('/most_disliked_cluster')
@@ -69,7 +79,4 @@ async def most_disliked_cluster(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
-    return {
-        'id': str(uuid.uuid4()),
-        'value': get_cluster_info(connection, filters, reversed=False)[0]['cluster'],
-    }
+    return build_cluster_metric(await fetch_tag_stats(connection, filters), reversed=False)
@@ -1,41 +1,26 @@
 from fastapi import APIRouter, Depends
-from typing import Annotated, Any
+from typing import Annotated, Any, List
 from api.src.clickhouse import get_clickhouse
 from api.models.piechart import PieSlice, PieResponse, CentralValue
-from api.utils.clauses_generation import generate_where_clause
+from api.utils.aggregations import (
+    TagStat, ServiceStat, fetch_tag_stats, fetch_service_stats, fetch_positive_rating_share
+)
 from api.models.Filter import Filters, get_filters
 
 router = APIRouter(prefix="/pie")
 
 
-@router.get("/sentiment_distribution", response_model=PieResponse)
-async def sentiment_distribution(
-    connection: Annotated[Any, Depends(get_clickhouse)],
-    filters: Filters = Depends(get_filters)
-):
-    query = f"""
-        SELECT
-            sentiment,
-            count(*) AS cnt
-        FROM
-        (
-            SELECT arrayJoin(mapValues(tags)) AS sentiment
-            FROM comments
-            WHERE {generate_where_clause(filters)}
-        )
-        GROUP BY sentiment
-    """
-    rows = connection.query(query).result_rows
-
-    mean_sentiment = connection.query("""
-        SELECT
-            floor((SELECT COUNT(*) FROM comments WHERE rating > 3) / (SELECT COUNT(*) FROM comments) * 100)
-    """).result_rows[0][0]
+def build_sentiment_distribution(stats: List[TagStat], mean_sentiment: float) -> PieResponse:
+    counts = {
+        -1: sum(s.negative for s in stats),
+        0: sum(s.neutral for s in stats),
+        1: sum(s.positive for s in stats),
+    }
 
     mapping = {-1: "Негативная", 0: "Нейтральная", 1: "Позитивная"}
     data = [
-        PieSlice(name=mapping.get(row[0], str(row[0])), value=row[1])
-        for row in rows
+        PieSlice(name=mapping[sentiment], value=cnt)
+        for sentiment, cnt in counts.items() if cnt > 0
     ]
 
     return PieResponse(
@@ -48,27 +33,33 @@ async def sentiment_distribution(
     )
 
 
-@router.get("/service_distribution", response_model=PieResponse)
-async def service_distribution(
-    connection: Annotated[Any, Depends(get_clickhouse)],
-    filters: Filters = Depends(get_filters)
-):
-    query = f"""
-        SELECT service, count(*) AS cnt
-        FROM comments
-        WHERE {generate_where_clause(filters)}
-        GROUP BY service
-        ORDER BY cnt DESC
-    """
-    rows = connection.query(query).result_rows
-
-    data = [PieSlice(name=row[0], value=row[1]) for row in rows]
+def build_service_distribution(stats: List[ServiceStat]) -> PieResponse:
+    data = [PieSlice(name=s.service, value=s.comments) for s in stats]
 
     return PieResponse(
         title="Распределение источников",
         data=data,
         centralValue=CentralValue(
             label="Всего",
-            value=str(sum([x[1] for x in rows])) + " шт."
+            value=str(sum([s.comments for s in stats])) + " шт."
         )
     )
+
+
+@router.get("/sentiment_distribution", response_model=PieResponse)
+async def sentiment_distribution(
+    connection: Annotated[Any, Depends(get_clickhouse)],
+    filters: Filters = Depends(get_filters)
+):
+    return build_sentiment_distribution(
+        await fetch_tag_stats(connection, filters),
+        await fetch_positive_rating_share(connection, filters),
+    )
+
+
+@router.get("/service_distribution", response_model=PieResponse)
+async def service_distribution(
+    connection: Annotated[Any, Depends(get_clickhouse)],
+    filters: Filters = Depends(get_filters)
+):
+    return build_service_distribution(await fetch_service_stats(connection, filters))
@@ -1,15 +1,37 @@
+import asyncio
+
 from fastapi import APIRouter, Depends, Query
-from typing import Annotated, Any, Optional
+from typing import Annotated, Any, List
+from api.src.cache import cached, result_cache
 from api.src.clickhouse import get_clickhouse
+from api.src.ml_service import ml_client
 from api.models.Filter import Filters, get_filters
-import requests
-from api.bi.metrics import count_comments, average_mark, average_sentiment
-from api.bi.unusual import word_cloud
-from api.bi.piecharts import service_distribution, sentiment_distribution
-from api.bi.histograms import tags_sentiment_histogram
+from api.bi.metrics import build_average_mark, build_average_sentiment
+from api.bi.unusual import build_word_cloud
+from api.bi.piecharts import build_service_distribution, build_sentiment_distribution
+from api.bi.histograms import build_tags_sentiment_histogram
+from api.utils.aggregations import SearchStats, fetch_positive_rating_share, fetch_search_stats
 
 router = APIRouter(prefix="/searching")
 
+# версия векторного индекса опрашивается вместе с версиями таблиц clickhouse,
+# новые векторы делают закэшированные списки соседей недостижимыми
+result_cache.add_version_source("embeddings", ml_client.index_version)
+
+
+def theme_key(theme: str) -> str:
+    # только схлопываем пробелы, как text_key в ml/embeddings.py: регистр меняет вектор, а значит и соседей
+    return " ".join(theme.split())
+
+
+@cached("searching/nearest_ids", ttl=1800, tables=("embeddings",), ignore=("theme",))
+async def nearest_comment_ids(key: str, theme: str) -> List[str]:
+    """
+    neighbour ids of a theme cached by its whitespace-normalized key, the original text is what gets embedded.
+    repeated searches skip both the embedding call and the qdrant search
+    """
+    return [str(x["id"]) for x in await ml_client.nearest_comments(theme)]
+
 
 @router.get("/find_nearest_comments")
 async def find_nearest_comments(
@@ -19,28 +41,26 @@ async def find_nearest_comments(
 ):
     filters.source = ["parsing"]
 
-    nearest_comms = requests.get(f"http://188.225.34.42:8881/embeddings?comment={theme}").json()["matches"]
-    ids = [x["id"] for x in nearest_comms]
-    filters.comment_ids = ids
-    metric2 = await average_sentiment(connection, filters)
-    metric3 = await average_mark(connection, filters)
-    wc = await word_cloud(connection, filters)
-    sentiment_piechart = await sentiment_distribution(connection, filters)
-    service_piechart = await service_distribution(connection, filters)
-    tags_histogram = await tags_sentiment_histogram(connection, filters, top_n=5)
+    filters.comment_ids = list(await nearest_comment_ids(theme_key(theme), theme))
+    # пустой список id в фильтрах означает "без фильтра", поэтому без совпадений в clickhouse не ходим
+    if filters.comment_ids:
+        stats, positive_share = await asyncio.gather(
+            fetch_search_stats(connection, filters),
+            fetch_positive_rating_share(connection, filters),
+        )
+    else:
+        stats, positive_share = SearchStats([], [], []), 0
 
     return {
         "metrics": {
-            "total_count": {"id": "123", "value": len(nearest_comms)},
-            "avg_sentiment": metric2,
-            "avg_rating": metric3,
+            "total_count": {"id": "123", "value": len(filters.comment_ids)},
+            "avg_sentiment": build_average_sentiment(stats.tags),
+            "avg_rating": build_average_mark(stats.services),
         },
-        "wordcloud": wc,
+        "wordcloud": build_word_cloud([(k.keyword, k.mentions, k.avg_rating) for k in stats.keywords]),
         "piecharts": {
-            "sentiment": sentiment_piechart,
-            "services": service_piechart
+            "sentiment": build_sentiment_distribution(stats.tags, positive_share),
+            "services": build_service_distribution(stats.services)
         },
-        "nearest_tags": tags_histogram
+        "nearest_tags": build_tags_sentiment_histogram(stats.tags, top_n=5)
     }
-
-
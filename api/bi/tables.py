@@ -1,32 +1,99 @@
-from typing import Annotated, Any, Optional
+import base64
+import binascii
+import json
+from typing import Annotated, Any, Dict, List, Literal, Optional, Tuple
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.params import Query
 
 from api.models.Filter import Filters, get_filters
 from api.models.table import TableRow
-from api.src.clickhouse import get_clickhouse
+from api.src.cache import cached
+from api.src.clickhouse import ClickHousePool, get_clickhouse
 from api.utils.clauses_generation import generate_where_clause
 
 tables = APIRouter(prefix="/table")
 
+SortOrder = Literal["ASC", "DESC"]
+
+# (колонка, параметр курсора, тип параметра). date и comment_id сравниваются со строками из курсора,
+# ClickHouse приводит их к типу колонки, так что формат и часовой пояс совпадают с toString на сервере
+CURSOR_COLUMNS = {
+    "date": ("date", "c_date", "String"),
+    "rating": ("rating", "c_rating", "Float64"),
+    "comment_id": ("comment_id", "c_comment_id", "String"),
+}
+
+
+def _sort_keys(date_order: Optional[SortOrder], rating_order: Optional[SortOrder]) -> List[Tuple[str, str]]:
+    """
+    order of the page: the sorted column goes first, the rest break ties.
+    matches the comments_by_date / comments_by_rating projections
+    """
+    date_dir = date_order or "DESC"
+    rating_dir = rating_order or "DESC"
+    if rating_order and not date_order:
+        return [("rating", rating_dir), ("date", date_dir), ("comment_id", rating_dir)]
+    return [("date", date_dir), ("rating", rating_dir), ("comment_id", date_dir)]
+
+
+def _keyset_condition(keys: List[Tuple[str, str]]) -> str:
+    """
+    rows strictly after the cursor in `keys` order, directions may be mixed:
+    c1 > v1 OR (c1 = v1 AND c2 > v2) OR ...
+    the leading c1 >= v1 bound is repeated outside so the primary key / projection can prune granules
+    """
+    def cmp(key: str, direction: str, strict: bool) -> str:
+        column, param, param_type = CURSOR_COLUMNS[key]
+        op = (">" if direction == "ASC" else "<") + ("" if strict else "=")
+        return f"{column} {op} {{{param}:{param_type}}}"
+
+    branches = []
+    for i, (key, direction) in enumerate(keys):
+        equal = [f"{CURSOR_COLUMNS[k][0]} = {{{CURSOR_COLUMNS[k][1]}:{CURSOR_COLUMNS[k][2]}}}" for k, _ in keys[:i]]
+        branches.append("(" + " AND ".join(equal + [cmp(key, direction, True)]) + ")")
+    first_key, first_direction = keys[0]
+    return f"{cmp(first_key, first_direction, False)} AND ({' OR '.join(branches)})"
 
-@tables.get("/comment_table_rows")
-def get_table_rows(
-        connection: Annotated[Any, Depends(get_clickhouse)],
-        filters: Filters = Depends(get_filters),
-        limit: int = Query(100),
-        offset: int = Query(0),
-        date_order: Optional[str] = Query(None),
-        rating_order: Optional[str] = Query(None)
-):
-    order_parts = []
-    if date_order:
-        order_parts.append(f"date {date_order}")
-    if rating_order:
-        order_parts.append(f"rating {rating_order}")
 
-    order_clause = f"ORDER BY {', '.join(order_parts)}" if order_parts else ""
+def _order_signature(keys: List[Tuple[str, str]]) -> str:
+    return ",".join(f"{key} {direction}" for key, direction in keys)
+
+
+def encode_cursor(keys: List[Tuple[str, str]], date: str, rating: float, comment_id: str) -> str:
+    payload = json.dumps({"o": _order_signature(keys), "k": [date, rating, comment_id]}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(keys: List[Tuple[str, str]], cursor: str) -> Dict[str, Any]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        date, rating, comment_id = payload["k"]
+        order = payload["o"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if order != _order_signature(keys):
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different sort order")
+    return {"c_date": str(date), "c_rating": float(rating), "c_comment_id": str(comment_id)}
+
+
+@cached("table/comment_table_rows", ttl=60)
+async def fetch_table_page(
+        connection: ClickHousePool,
+        filters: Filters,
+        limit: int,
+        offset: int,
+        date_order: Optional[SortOrder],
+        rating_order: Optional[SortOrder],
+        cursor: Optional[str],
+) -> Tuple[List[TableRow], Optional[str]]:
+    keys = _sort_keys(date_order, rating_order)
+    where = generate_where_clause(filters)
+    condition = str(where)
+    params = {"limit": limit, "offset": offset}
+    if cursor:
+        condition = f"{condition} AND {_keyset_condition(keys)}"
+        params.update(decode_cursor(keys, cursor), offset=0)
 
     query = f"""
         SELECT
@@ -37,13 +104,20 @@ def get_table_rows(
             bank,
             service,
             tags,
-            source
+            source,
+            toString(date),
+            toString(comment_id)
         FROM comments
-        WHERE {generate_where_clause(filters)}
-        {order_clause}
-        LIMIT {limit} OFFSET {offset}
+        WHERE {condition}
+        ORDER BY {', '.join(f'{CURSOR_COLUMNS[key][0]} {direction}' for key, direction in keys)}
+        LIMIT {{limit:UInt32}} OFFSET {{offset:UInt32}}
     """
-    rows = connection.query(query).result_rows
+    rows = (await connection.query(query, **where.query_args(**params))).result_rows
+
+    next_cursor = None
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_cursor(keys, last[8], last[3], last[9])
 
     return [
         TableRow(
@@ -55,4 +129,21 @@ def get_table_rows(
             tags=dict(row[6]),
         )
         for row in rows
-    ]
+    ], next_cursor
+
+
+@tables.get("/comment_table_rows")
+async def get_table_rows(
+        response: Response,
+        connection: Annotated[Any, Depends(get_clickhouse)],
+        filters: Filters = Depends(get_filters),
+        limit: int = Query(100, ge=1, le=1000),
+        offset: int = Query(0, ge=0),
+        date_order: Optional[SortOrder] = Query(None),
+        rating_order: Optional[SortOrder] = Query(None),
+        cursor: Optional[str] = Query(None, description="opaque X-Next-Cursor of the previous page, replaces offset"),
+):
+    rows, next_cursor = await fetch_table_page(connection, filters, limit, offset, date_order, rating_order, cursor)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
@@ -5,27 +5,29 @@ from fastapi import APIRouter, Depends
 
 from api.models.Filter import Filters, get_filters
 from api.models.timeline import TsPoint, TsSeriesDef, LineTimeseriesResponse, MultilineTimelinePoint, MultilineTimeline
+from api.src.cache import cached
 from api.src.clickhouse import get_clickhouse
-from api.utils.clauses_generation import generate_where_clause
+from api.utils.clauses_generation import generate_date_clause
+from api.utils.planner import daily_comments_query, tag_stats_query
 
 router = APIRouter(prefix="/timeline")
 
 
 @router.get("/count_timeline", response_model=LineTimeseriesResponse)
+@cached("timeline/count_timeline")
 async def count_timeline(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
+    daily, where = daily_comments_query(filters)
     query = f"""
         SELECT
             date,
-            floor(AVG(count(*)) OVER (ORDER BY date ROWS BETWEEN 3 PRECEDING AND CURRENT ROW), 0)
-        FROM comments
-        WHERE {generate_where_clause(filters)}
-        GROUP BY date
+            floor(AVG(comments) OVER (ORDER BY date ROWS BETWEEN 3 PRECEDING AND CURRENT ROW), 0)
+        FROM ({daily})
         ORDER BY date
     """
-    rows = connection.query(query).result_rows
+    rows = (await connection.query(query, **where.query_args())).result_rows
 
     points = [
         TsPoint(t=row[0], value={"metricKey_1": row[1]})
@@ -50,18 +52,18 @@ async def count_timeline(
 
 
 @router.get("/rating_timeline", response_model=LineTimeseriesResponse)
+@cached("timeline/rating_timeline")
 async def rating_timeline(
         connection: Annotated[Any, Depends(get_clickhouse)],
         filters: Filters = Depends(get_filters)
 ):
+    daily, where = daily_comments_query(filters)
     query = f"""
         WITH daily AS (
             SELECT
                 date,
-                avg(rating) AS daily_avg
-            FROM comments
-            WHERE {generate_where_clause(filters)}
-            GROUP BY date
+                rating_sum / comments AS daily_avg
+            FROM ({daily})
         )
         SELECT
             date,
@@ -72,7 +74,7 @@ async def rating_timeline(
         FROM daily
         ORDER BY date
     """
-    rows = connection.query(query).result_rows
+    rows = (await connection.query(query, **where.query_args())).result_rows
 
     points = [
         TsPoint(t=row[0], value={"metricKey_1": round(row[1], 2)})
@@ -97,23 +99,20 @@ async def rating_timeline(
 
 
 @router.get("/tags_count_timeline", response_model=MultilineTimeline)
+@cached("timeline/tags_count_timeline")
 async def tags_count_timeline(
         connection: Any = Depends(get_clickhouse),
         filters: Filters = Depends(get_filters),
 ):
-    rows = connection.query(
+    tag_stats, where = tag_stats_query(filters, group_by=("date", "tag"))
+    rows = (await connection.query(
         f"""
-        SELECT
-            date,
-            key,
-            COUNT(*) AS cnt
-        FROM comments
-        ARRAY JOIN mapKeys(tags) AS key
-        WHERE {generate_where_clause(filters)}
-        GROUP BY date, key
+        SELECT date, tag, mentions
+        FROM ({tag_stats})
         ORDER BY date
-        """
-    ).result_rows
+        """,
+        **where.query_args(),
+    )).result_rows
     data_by_date = defaultdict(dict)
     for t, key, cnt in rows:
         if (filters.tags and key in filters.tags) or not filters.tags:
@@ -140,31 +139,32 @@ async def tags_count_timeline(
 
 
 @router.get("/avg_tags_mark", response_model=MultilineTimeline)
+@cached("timeline/avg_tags_mark")
 async def avg_tag_mark(
         connection: Any = Depends(get_clickhouse),
         filters: Filters = Depends(get_filters),
 ):
-    rows = connection.query(
+    """
+    per tag and day: mention-weighted average sentiment (scaled to 0..100) over that day and the 7 previous
+    days that have mentions of the tag. before the move to comment_tags the window was the last 8 single
+    mentions, and the value shown for a day was whichever of its mentions came last
+    """
+    tag_stats, where = tag_stats_query(filters, group_by=("date", "tag"))
+    rows = (await connection.query(
         f"""
         SELECT
             date,
-            key,
+            tag,
             round(
-                AVG(value) OVER (
-                    PARTITION BY key
-                    ORDER BY date
-                    ROWS BETWEEN 7 PRECEDING AND CURRENT ROW
-                ) * 50 + 50,
+                sum(sentiment_sum) OVER w / sum(mentions) OVER w * 50 + 50,
                 3
             ) AS avg_val
-        FROM comments
-        ARRAY JOIN
-            mapKeys(tags) AS key,
-            mapValues(tags) AS value
-        WHERE {generate_where_clause(filters)}
-        ORDER BY date, key
-        """
-    ).result_rows
+        FROM ({tag_stats})
+        WINDOW w AS (PARTITION BY tag ORDER BY date ROWS BETWEEN 7 PRECEDING AND CURRENT ROW)
+        ORDER BY date, tag
+        """,
+        **where.query_args(),
+    )).result_rows
 
     unique_keys = sorted({key for _, key, _ in rows if (filters.tags and key in filters.tags) or not filters.tags})
     series_defs = [
@@ -189,20 +189,15 @@ async def avg_tag_mark(
 
 
 @router.get("/key_rate_tags_mark_correlation")
+@cached("timeline/key_rate_tags_mark_correlation", tables=("comments", "key_rate"))
 async def key_rate_tags_mark_correlation(
         connection: Any = Depends(get_clickhouse),
         filters: Filters = Depends(get_filters),
 ):
+    tag_stats, where = tag_stats_query(filters, group_by=("date",))
+    date_where = generate_date_clause(filters)
 
-    def generate_where_date_clause(filt: Filters):
-        expr = []
-        if filt.start_date:
-            expr.append(f"toDate(date) >= '{filt.start_date}'")
-        if filt.end_date:
-            expr.append(f"toDate(date) <= '{filt.end_date}'")
-        return " AND ".join(expr) if len(expr) > 0 else "True"
-
-    clickhouse_rows = connection.query(
+    clickhouse_rows = (await connection.query(
         f"""
             SELECT
                 date,
@@ -214,21 +209,15 @@ async def key_rate_tags_mark_correlation(
                     ), 3
                 ) AS val
             FROM (
-                SELECT
-                    date,
-                    AVG(value * 50 + 50) AS avg_val
-                FROM comments
-                ARRAY JOIN
-                    mapKeys(tags) AS key,
-                    mapValues(tags) AS value
-                WHERE {generate_where_clause(filters)}
-                GROUP BY date
+                SELECT date, sentiment_sum / mentions * 50 + 50 AS avg_val
+                FROM ({tag_stats})
             ) t
             ORDER BY date
             UNION ALL
-            SELECT date, 'Ключевая ставка', rate FROM key_rate WHERE {generate_where_date_clause(filters)}
-            """
-    ).result_rows
+            SELECT date, 'Ключевая ставка', rate FROM key_rate WHERE {date_where}
+            """,
+            **where.query_args(**date_where.parameters),
+    )).result_rows
 
     rows = [
         {'date': data[0].strftime('%Y-%m-%d'), 'value': data[2], 'source': data[1]}
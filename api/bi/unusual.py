@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends
-from typing import Annotated, Any
+from typing import Annotated, Any, List
+from api.src.cache import cached
 from api.src.clickhouse import get_clickhouse
 from api.models.treemap import TreemapNode, TreemapResponse
 from api.models.pareto import ParetoRow, ParetoResponse
 from api.models.scatterplot import ScatterPoint, ScatterLegendItem, ScatterplotResponse
 from api.models.heatmap import HeatmapResponse, HeatmapCell
 from api.models.Wordcloud import Wordcloud, Word
-from api.utils.clauses_generation import generate_where_clause
+from api.utils.aggregations import TagStat, fetch_tag_stats
+from api.utils.clauses_generation import generate_where_clause, generate_tags_where_clause
 from api.models.Filter import Filters, get_filters
 from api.utils.other import sentiment_to_color, ratings_to_hex
 
@@ -15,6 +17,7 @@ router = APIRouter(prefix="/unusual_graphics")
 
 
 @router.get("/tags_treemap", response_model=TreemapResponse)
+@cached("unusual_graphics/tags_treemap")
 async def tags_treemap(
     connection: Annotated[Any, Depends(get_clickhouse)],
     filters: Filters = Depends(get_filters)
@@ -24,16 +27,11 @@ async def tags_treemap(
             tag,
             count(*) AS mentions,
             (avg(sentiment) * 50) + 50 AS sentiment_score
-        FROM
-        (
-            SELECT arrayJoin(mapKeys(tags)) AS tag,
-                   arrayJoin(mapValues(tags)) AS sentiment
-            FROM comments
-        )
+        FROM comment_tags
         GROUP BY tag
         ORDER BY mentions DESC
     """
-    rows = connection.query(query).result_rows
+    rows = (await connection.query(query)).result_rows
 
     total_mentions = sum(row[1] for row in rows) or 1
 
@@ -57,36 +55,17 @@ async def tags_treemap(
     return response
 
 
-@router.get("/pareto", response_model=ParetoResponse)
-async def negative_pareto(
-    connection: Annotated[Any, Depends(get_clickhouse)],
-    filters: Filters = Depends(get_filters)
-):
-    query = f"""
-        SELECT
-            tag,
-            sum(if(sentiment = -1, 1, 0)) AS negative_count
-        FROM
-        (
-            SELECT arrayJoin(mapKeys(tags)) AS tag,
-                   arrayJoin(mapValues(tags)) AS sentiment
-            FROM comments WHERE {generate_where_clause(filters)}
-        )
-        GROUP BY tag
-        HAVING negative_count > 0
-        ORDER BY negative_count DESC
-        LIMIT 5
-    """
-    rows = connection.query(query).result_rows
+def build_negative_pareto(stats: List[TagStat]) -> ParetoResponse:
+    rows = sorted((s for s in stats if s.negative > 0), key=lambda s: s.negative, reverse=True)[:5]
 
     cumulative = 0.0
     data = []
-    for name, negative_count in rows:
-        cumulative += negative_count
+    for s in rows:
+        cumulative += s.negative
         data.append(
             ParetoRow(
-                name=name,
-                negative=negative_count,
+                name=s.tag,
+                negative=s.negative,
                 cumulative=cumulative
             )
         )
@@ -101,26 +80,8 @@ async def negative_pareto(
     return response
 
 
-@router.get("/tags_scatter", response_model=ScatterplotResponse)
-async def tags_scatter(
-    connection: Annotated[Any, Depends(get_clickhouse)],
-    filters: Filters = Depends(get_filters)
-):
-    query = f"""
-        SELECT
-            tag,
-            count(*) AS mentions,
-            avg(sentiment) AS avg_sent
-        FROM
-        (
-            SELECT arrayJoin(mapKeys(tags)) AS tag,
-                   arrayJoin(mapValues(tags)) AS sentiment
-            FROM comments WHERE {generate_where_clause(filters)}
-        )
-        GROUP BY tag
-        ORDER BY mentions DESC
-    """
-    rows = connection.query(query).result_rows
+def build_tags_scatter(stats: List[TagStat]) -> ScatterplotResponse:
+    rows = [(s.tag, s.mentions, s.avg_sentiment) for s in stats]
 
     total_mentions = sum(r[1] for r in rows) or 1
     avg_sentiment = (
@@ -171,18 +132,33 @@ async def tags_scatter(
     )
 
 
+@router.get("/pareto", response_model=ParetoResponse)
+async def negative_pareto(
+    connection: Annotated[Any, Depends(get_clickhouse)],
+    filters: Filters = Depends(get_filters)
+):
+    return build_negative_pareto(await fetch_tag_stats(connection, filters))
+
+
+@router.get("/tags_scatter", response_model=ScatterplotResponse)
+async def tags_scatter(
+    connection: Annotated[Any, Depends(get_clickhouse)],
+    filters: Filters = Depends(get_filters)
+):
+    return build_tags_scatter(await fetch_tag_stats(connection, filters))
+
+
 @router.get("/tags_correlation", response_model=HeatmapResponse)
+@cached("unusual_graphics/tags_correlation")
 async def tags_correlation(
     connection: Annotated[Any, Depends(get_clickhouse)],
     filters: Filters = Depends(get_filters)
 ):
+    where = generate_tags_where_clause(filters)
     query = f"""
         WITH expanded AS (
-            SELECT
-                row_number() OVER () AS rid,
-                arrayJoin(mapKeys(tags)) AS tag,
-                arrayJoin(mapValues(tags)) AS sentiment
-            FROM comments WHERE {generate_where_clause(filters)}
+            SELECT comment_id, tag, sentiment
+            FROM comment_tags WHERE {where}
         )
         SELECT
             x.tag AS tag_x,
@@ -190,12 +166,12 @@ async def tags_correlation(
             coalesce(corr(x.sentiment, y.sentiment), 0) AS correlation
         FROM expanded AS x
         INNER JOIN expanded AS y
-            ON x.rid = y.rid
+            ON x.comment_id = y.comment_id
         WHERE x.tag < y.tag
         GROUP BY tag_x, tag_y
         ORDER BY tag_x, tag_y
     """
-    rows = connection.query(query).result_rows
+    rows = (await connection.query(query, **where.query_args())).result_rows
 
     tags = sorted(set([r[0] for r in rows] + [r[1] for r in rows]))
 
@@ -211,11 +187,24 @@ async def tags_correlation(
     )
 
 
+def build_word_cloud(rows) -> Wordcloud:
+    """
+    rows are (keyword, mentions, avg_rating)
+    """
+    if not rows:
+        return Wordcloud(words=[])
+    colors = ratings_to_hex([row[2] for row in rows])
+    return Wordcloud(words=[Word(word=row[0], mentions=row[1], avg_rating=round(row[2], 3),
+                                 color=colors[i]) for i, row in enumerate(rows)])
+
+
 @router.get("/wordcloud", response_model=Wordcloud)
+@cached("unusual_graphics/wordcloud")
 async def word_cloud(
     connection: Annotated[Any, Depends(get_clickhouse)],
     filters: Filters = Depends(get_filters)
 ):
+    where = generate_where_clause(filters)
     query = f"""
     SELECT
         keyword,
@@ -223,13 +212,11 @@ async def word_cloud(
         avg(rating) AS avg_rating
     FROM comments
     ARRAY JOIN keywords AS keyword
-    WHERE {generate_where_clause(filters)}
+    WHERE {where}
     GROUP BY keyword
     ORDER BY keyword_count DESC
     LIMIT 100
     """
-    rows = connection.query(query).result_rows
-    colors = ratings_to_hex([row[2] for row in rows])
-    return Wordcloud(words=[Word(word=row[0], mentions=row[1], avg_rating=round(row[2], 3),
-                                 color=colors[i]) for i, row in enumerate(rows)])
+    rows = (await connection.query(query, **where.query_args())).result_rows
+    return build_word_cloud(rows)
 
@@ -3,6 +3,7 @@ from typing import Annotated, Any, List
 
 from fastapi import APIRouter, Depends
 
+from api.src.cache import result_cache
 from api.src.clickhouse import get_clickhouse
 
 from pydantic import BaseModel
@@ -14,7 +15,7 @@ class KeyRateValue(BaseModel):
     rate: float
 
 @router.post("/key_rate_import")
-def import_key_rate_data(
+async def import_key_rate_data(
     connection: Annotated[Any, Depends(get_clickhouse)],
     items: List[KeyRateValue],
 ):
@@ -22,14 +23,23 @@ def import_key_rate_data(
         return {"status": "no data to import"}
 
     # очищаем таблицу
-    connection.query("TRUNCATE TABLE key_rate")
-
-    # формируем список значений в виде строки для одного INSERT
-    values_str = ", ".join(
-        f"('{item.date.strftime('%Y-%m-%d')}', {item.rate})" for item in items
+    await connection.command("TRUNCATE TABLE key_rate")
+
+    # выполняем bulk insert, значения передаются параметрами, а не склейкой в текст запроса
+    await connection.command(
+        """
+        INSERT INTO key_rate (date, rate)
+        SELECT date, rate
+        FROM (SELECT {dates:Array(Date)} AS date, {rates:Array(Float64)} AS rate)
+        ARRAY JOIN date, rate
+        """,
+        parameters={
+            "dates": [item.date.strftime('%Y-%m-%d') for item in items],
+            "rates": [item.rate for item in items],
+        },
     )
 
-    # выполняем bulk insert
-    connection.query(f"INSERT INTO key_rate (date, rate) VALUES {values_str}")
+    # сбрасываем закэшированные графики, зависящие от ключевой ставки
+    await result_cache.invalidate("key_rate")
 
     return {"status": "success", "inserted_rows": len(items)}
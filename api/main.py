@@ -1,11 +1,41 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from api.bi import routers
 from api.data_import import DATA_IMPORT_ROUTERS
 from api.ml_api.main import app as ml_api_app
 from api.events import events_router
+from api.monitoring import monitoring_router
+from api.src.amqp import publisher
+from api.src.cache import result_cache, cache_settings
+from api.src.clickhouse import PoolExhaustedError, ch_pool, export_pool
+from api.src.ml_service import ml_client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    cache_watcher = asyncio.create_task(result_cache.watch(cache_settings.cache_refresh_interval))
+    yield
+    cache_watcher.cancel()
+    with suppress(asyncio.CancelledError):
+        await cache_watcher
+    await result_cache.close()
+    await ml_client.close()
+    await publisher.close()
+    ch_pool.close()
+    export_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(PoolExhaustedError)
+async def pool_exhausted_handler(request: Request, exc: PoolExhaustedError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
 
-app = FastAPI()
 
 for route in routers:
     app.include_router(route, prefix="/api")
@@ -14,6 +44,7 @@ for route in DATA_IMPORT_ROUTERS:
     app.include_router(route, prefix="/api")
 
 app.include_router(events_router, prefix="/api")
+app.include_router(monitoring_router, prefix="/api")
 
 ALLOWED_ORIGINS = [
     "http://localhost:8080",
@@ -27,7 +58,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["*"],
+    expose_headers=["*", "X-Next-Cursor"],
     max_age=600,
 )
 
@@ -0,0 +1,100 @@
+-- Дневные агрегаты по отзывам и по упоминаниям тэгов.
+-- Поддерживаются materialized view на вставку в comments,
+-- rating входит в ключ, чтобы фильтры по рейтингу тоже обслуживались агрегатами.
+--
+-- Строки comments помечаются эпохой загрузки ingest_epoch. MV берут только строки новее эпохи миграции,
+-- разовый backfill - только старые, поэтому строка, вставленная во время миграции, попадает в агрегаты
+-- ровно один раз: пока создаются MV, вставки ещё получают старую эпоху, её поднимают перед backfill.
+-- Следующие миграции с MV и backfill повторяют это со своим номером эпохи.
+
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS ingest_epoch UInt32 DEFAULT 0;
+
+-- значение по умолчанию должно лечь в старые куски физически, иначе после смены DEFAULT оно поменяется и у них
+ALTER TABLE comments MATERIALIZE COLUMN ingest_epoch SETTINGS mutations_sync = 2;
+
+CREATE TABLE IF NOT EXISTS comments_daily
+(
+    bank LowCardinality(String),
+    service LowCardinality(String),
+    source LowCardinality(String),
+    date Date,
+    rating Float64,
+    comments UInt64
+)
+ENGINE = SummingMergeTree
+ORDER BY (bank, service, source, date, rating);
+
+CREATE TABLE IF NOT EXISTS comment_tags_daily
+(
+    bank LowCardinality(String),
+    service LowCardinality(String),
+    source LowCardinality(String),
+    date Date,
+    rating Float64,
+    tag LowCardinality(String),
+    sentiment Int8,
+    mentions UInt64
+)
+ENGINE = SummingMergeTree
+ORDER BY (bank, service, source, date, rating, tag, sentiment);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS comments_daily_mv TO comments_daily AS
+SELECT
+    bank,
+    service,
+    source,
+    toDate(date) AS date,
+    toFloat64(rating) AS rating,
+    count() AS comments
+FROM comments
+WHERE ingest_epoch >= 1
+GROUP BY bank, service, source, date, rating;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS comment_tags_daily_mv TO comment_tags_daily AS
+SELECT
+    bank,
+    service,
+    source,
+    toDate(date) AS date,
+    toFloat64(rating) AS rating,
+    tag,
+    toInt8(sentiment) AS sentiment,
+    count() AS mentions
+FROM comments
+ARRAY JOIN
+    mapKeys(tags) AS tag,
+    mapValues(tags) AS sentiment
+WHERE ingest_epoch >= 1
+GROUP BY bank, service, source, date, rating, tag, sentiment;
+
+-- с этого момента новые строки считают MV, всё вставленное раньше - backfill ниже
+ALTER TABLE comments MODIFY COLUMN ingest_epoch UInt32 DEFAULT 1;
+
+INSERT INTO comments_daily
+SELECT
+    bank,
+    service,
+    source,
+    toDate(date) AS date,
+    toFloat64(rating) AS rating,
+    count() AS comments
+FROM comments
+WHERE ingest_epoch < 1
+GROUP BY bank, service, source, date, rating;
+
+INSERT INTO comment_tags_daily
+SELECT
+    bank,
+    service,
+    source,
+    toDate(date) AS date,
+    toFloat64(rating) AS rating,
+    tag,
+    toInt8(sentiment) AS sentiment,
+    count() AS mentions
+FROM comments
+ARRAY JOIN
+    mapKeys(tags) AS tag,
+    mapValues(tags) AS sentiment
+WHERE ingest_epoch < 1
+GROUP BY bank, service, source, date, rating, tag, sentiment;
@@ -0,0 +1,51 @@
+-- Плоская таблица упоминаний тэгов: одна строка на пару (отзыв, тэг).
+-- Заменяет ARRAY JOIN по Map tags в аналитических запросах на обычный GROUP BY.
+-- MV и backfill делят строки по ingest_epoch, как в 001: эпоха 2 - после этой миграции.
+
+CREATE TABLE IF NOT EXISTS comment_tags
+(
+    comment_id String,
+    date Date,
+    bank LowCardinality(String),
+    service LowCardinality(String),
+    source LowCardinality(String),
+    rating Float64,
+    tag LowCardinality(String),
+    sentiment Int8
+)
+ENGINE = MergeTree
+ORDER BY (bank, source, date, tag, comment_id);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS comment_tags_mv TO comment_tags AS
+SELECT
+    toString(comment_id) AS comment_id,
+    toDate(date) AS date,
+    bank,
+    service,
+    source,
+    toFloat64(rating) AS rating,
+    tag,
+    toInt8(sentiment) AS sentiment
+FROM comments
+ARRAY JOIN
+    mapKeys(tags) AS tag,
+    mapValues(tags) AS sentiment
+WHERE ingest_epoch >= 2;
+
+ALTER TABLE comments MODIFY COLUMN ingest_epoch UInt32 DEFAULT 2;
+
+INSERT INTO comment_tags
+SELECT
+    toString(comment_id) AS comment_id,
+    toDate(date) AS date,
+    bank,
+    service,
+    source,
+    toFloat64(rating) AS rating,
+    tag,
+    toInt8(sentiment) AS sentiment
+FROM comments
+ARRAY JOIN
+    mapKeys(tags) AS tag,
+    mapValues(tags) AS sentiment
+WHERE ingest_epoch < 2;
@@ -0,0 +1,19 @@
+-- Проекции под сортировки таблицы отзывов (/table/comment_table_rows).
+-- Keyset-пагинация идёт по (date, rating, comment_id) или (rating, date, comment_id) внутри банка,
+-- с такими проекциями ClickHouse читает строки уже в нужном порядке и останавливается после LIMIT.
+
+ALTER TABLE comments ADD PROJECTION IF NOT EXISTS comments_by_date
+(
+    SELECT *
+    ORDER BY bank, date, rating, comment_id
+);
+
+ALTER TABLE comments ADD PROJECTION IF NOT EXISTS comments_by_rating
+(
+    SELECT *
+    ORDER BY bank, rating, date, comment_id
+);
+
+ALTER TABLE comments MATERIALIZE PROJECTION comments_by_date;
+
+ALTER TABLE comments MATERIALIZE PROJECTION comments_by_rating;
@@ -0,0 +1,17 @@
+-- Состояние инкрементального парсинга по источникам (parsers/crawl_state.py).
+-- kind = 'review': ключ уже опубликованного отзыва (id/url на сайте или хэш содержимого),
+-- kind = 'page': отпечаток страницы списка (хэш ключей отзывов на ней),
+-- kind = 'watermark': время самого свежего отзыва источника.
+-- ReplacingMergeTree оставляет последнюю запись по ключу, старые отзывы вычищаются по TTL.
+
+CREATE TABLE IF NOT EXISTS crawl_state
+(
+    source LowCardinality(String),
+    kind LowCardinality(String),
+    key String,
+    value String,
+    seen_at DateTime DEFAULT now()
+)
+ENGINE = ReplacingMergeTree(seen_at)
+ORDER BY (source, kind, key)
+TTL seen_at + INTERVAL 180 DAY DELETE WHERE kind = 'review';
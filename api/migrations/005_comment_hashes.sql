@@ -0,0 +1,33 @@
+-- Точное хранилище дедупликации отзывов (ml/dedup.py, parsers/dedup.py).
+-- hash - sha1 нормализованных (service, name, date, comment), пишет воркер после успешной обработки,
+-- уже загруженные отзывы заполняются ниже.
+
+CREATE TABLE IF NOT EXISTS comment_hashes
+(
+    hash FixedString(40),
+    service LowCardinality(String),
+    comment_id String,
+    first_seen DateTime DEFAULT now()
+)
+ENGINE = ReplacingMergeTree
+ORDER BY hash;
+
+-- уже загруженные отзывы: без них первый обход после выкладки не нашёл бы их и опубликовал бы историю заново.
+-- hash считается так же, как common/dedup.py content_hash: пробельные символы (как str.split) схлопываются,
+-- регистр понижается, части соединяются через \x1F, sha1 в hex нижним регистром
+INSERT INTO comment_hashes (hash, service, comment_id)
+SELECT
+    lower(hex(SHA1(arrayStringConcat(
+        arrayMap(
+            part -> lowerUTF8(trimBoth(replaceRegexpAll(
+                part,
+                '[\\s\\x{0B}\\x{1C}-\\x{1F}\\x{85}\\x{A0}\\x{1680}\\x{2000}-\\x{200A}\\x{2028}\\x{2029}\\x{202F}\\x{205F}\\x{3000}]+',
+                ' '
+            ))),
+            [toString(service), toString(name), toString(toDate(date)), toString(comment)]
+        ),
+        '\x1F'
+    )))) AS hash,
+    service,
+    toString(comment_id) AS comment_id
+FROM comments;
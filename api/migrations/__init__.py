@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from clickhouse_connect.driver.client import Client
+
+MIGRATIONS_DIR = Path(__file__).parent
+
+
+def split_statements(sql: str):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+
+
+def apply_migrations(client: Client):
+    """
+    applies every migrations/*.sql file not yet recorded in schema_migrations, in name order
+    """
+    client.command("""
+        CREATE TABLE IF NOT EXISTS schema_migrations
+        (
+            version String,
+            applied_at DateTime DEFAULT now()
+        )
+        ENGINE = MergeTree
+        ORDER BY version
+    """)
+    applied = {row[0] for row in client.query("SELECT version FROM schema_migrations").result_rows}
+
+    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        if path.stem in applied:
+            continue
+        print(f"applying migration {path.name}")
+        for statement in split_statements(path.read_text(encoding="utf-8")):
+            client.command(statement)
+        client.insert("schema_migrations", [[path.stem]], column_names=["version"])
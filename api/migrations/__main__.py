@@ -0,0 +1,7 @@
+from clickhouse_connect import get_client
+
+from api.migrations import apply_migrations
+from api.src.clickhouse import settings
+
+if __name__ == "__main__":
+    apply_migrations(get_client(dsn=settings.clickhouse_dsn))
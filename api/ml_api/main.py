@@ -1,8 +1,7 @@
 from fastapi import FastAPI, Body
 from typing import List
-import requests
-import json
-from api.ml_api.models import InferenceResponse, InferenceComment, InferenceRequest
+from api.ml_api.models import InferenceResponse, InferenceComment, InferenceRequest, ProcessedComment
+from api.src.ml_service import ml_client
 
 odd_example = {
     "example1": {
@@ -45,6 +44,5 @@ async def predict(data: InferenceRequest = Body(..., examples=odd_example)) -> I
     """
     Метод для получения предсказаний ML-модуля для набора отзывов.
     """
-    url = "http://188.225.34.42:8881/get_comments_predicts"
-    preds = requests.post(url, json=json.loads(data.json())).json()
-    return preds
+    results = await ml_client.predict([x.text for x in data.data])
+    return InferenceResponse(predictions=[ProcessedComment(id=x.id, **r) for x, r in zip(data.data, results)])
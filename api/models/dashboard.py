@@ -0,0 +1,37 @@
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Literal, Optional
+from api.models.Component import Component
+from api.models.Filter import Filters
+
+WidgetId = Literal[
+    "metrics/count_comments",
+    "metrics/average_sentiment",
+    "metrics/average_mark",
+    "metrics/most_liked_cluster",
+    "metrics/most_disliked_cluster",
+    "pie/sentiment_distribution",
+    "pie/service_distribution",
+    "histograms/tags_sentiment_histogram",
+    "histograms/fin_tags_sentiment_histogram",
+    "timeline/count_timeline",
+    "timeline/rating_timeline",
+    "timeline/tags_count_timeline",
+    "timeline/avg_tags_mark",
+    "timeline/key_rate_tags_mark_correlation",
+    "unusual_graphics/tags_treemap",
+    "unusual_graphics/pareto",
+    "unusual_graphics/tags_scatter",
+    "unusual_graphics/tags_correlation",
+    "unusual_graphics/wordcloud",
+]
+
+
+class DashboardBundleRequest(BaseModel):
+    filters: Filters = Field(default_factory=lambda: Filters(source=["parsing"], concurrent="газпромбанк"))
+    widgets: List[WidgetId]
+    # как query-параметр top_n у /histograms/tags_sentiment_histogram
+    top_n: Optional[int] = None
+
+
+class DashboardBundleResponse(Component):
+    widgets: Dict[str, Any]
@@ -0,0 +1,5 @@
+from .main import router as monitoring_router
+
+__all__ = [
+    monitoring_router,
+]
@@ -0,0 +1,33 @@
+from fastapi import APIRouter
+
+from api.src.amqp import publisher
+from api.src.cache import result_cache
+from api.src.clickhouse import ch_pool, export_pool
+from api.src.ml_service import ml_client
+
+router = APIRouter(prefix="/monitoring")
+
+
+@router.get("/clickhouse_pool")
+async def clickhouse_pool_stats():
+    return ch_pool.stats.snapshot()
+
+
+@router.get("/clickhouse_export_pool")
+async def clickhouse_export_pool_stats():
+    return export_pool.stats.snapshot()
+
+
+@router.get("/cache")
+async def cache_stats():
+    return result_cache.stats()
+
+
+@router.get("/ml_service")
+async def ml_service_stats():
+    return ml_client.stats()
+
+
+@router.get("/amqp")
+async def amqp_stats():
+    return publisher.stats()
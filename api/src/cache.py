@@ -0,0 +1,282 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import pickle
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from pydantic import BaseModel
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from api.src.clickhouse import ClickHousePool, ch_pool
+
+
+class CacheSettings(BaseSettings):
+    cache_enabled: bool = True
+    cache_max_entries: int = 2048
+    cache_default_ttl: float = 300.0
+    cache_ttls: Dict[str, float] = {}
+    cache_redis_dsn: Optional[str] = None
+    cache_refresh_interval: float = 15.0
+    # внешние источники версий (индекс эмбеддингов) опрашиваются отдельно и недолго
+    cache_source_timeout: float = 2.0
+
+    model_config = SettingsConfigDict(env_file=".env", env_prefix="", extra="ignore")
+
+
+cache_settings = CacheSettings()
+
+logger = logging.getLogger(__name__)
+
+# Tables whose data version participates in cache keys. The version is the row count plus the
+# highest block number of the active parts: an insert into `comments` (rows landing from the
+# processed-comments pipeline) or a TRUNCATE of `key_rate` changes it, a background merge does not
+# (it keeps both), so merges don't invalidate dependent entries.
+WATCHED_TABLES = ("comments", "key_rate")
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        value = value.model_dump(exclude_none=True)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in sorted(value.items()) if v is not None}
+    if isinstance(value, (set, frozenset)):
+        # только у множеств порядок не важен, порядок списка (например, тем) входит в ключ
+        return sorted((_normalize(v) for v in value), key=str)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def make_cache_key(endpoint: str, params: Dict[str, Any], versions: Iterable[str] = ()) -> str:
+    payload = json.dumps([_normalize(params), list(versions)], ensure_ascii=False, default=str, sort_keys=True)
+    return f"{endpoint}:{hashlib.sha1(payload.encode()).hexdigest()}"
+
+
+class ResultCache:
+    """
+    in-process LRU with TTLs and an optional shared redis backend.
+    keys embed the data version of every table an endpoint depends on,
+    versions are polled from system.parts and refreshed explicitly after imports
+    """
+
+    def __init__(self, pool: ClickHousePool, max_entries: int, default_ttl: float,
+                 ttls: Dict[str, float], redis_dsn: Optional[str] = None, source_timeout: float = 2.0):
+        self._pool = pool
+        self._source_timeout = source_timeout
+        self._max_entries = max_entries
+        self._default_ttl = default_ttl
+        self._ttls = ttls
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[str, ...], Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._versions: Dict[str, str] = {}
+        self._version_sources: Dict[str, Callable[[], Awaitable[str]]] = {}
+        self._redis = None
+        if redis_dsn:
+            from redis import asyncio as aioredis
+            self._redis = aioredis.from_url(redis_dsn)
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def ttl_for(self, endpoint: str, ttl: Optional[float]) -> float:
+        return self._ttls.get(endpoint, ttl if ttl is not None else self._default_ttl)
+
+    def _get_local(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _set_local(self, key: str, tables: Tuple[str, ...], value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, tables, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, endpoint: str, params: Dict[str, Any], tables: Tuple[str, ...],
+                             ttl: Optional[float], compute: Callable[[], Awaitable[Any]]) -> Any:
+        key = make_cache_key(endpoint, params, [self._versions.get(t, "") for t in tables])
+
+        entry = self._get_local(key)
+        if entry is not None:
+            self.hits[endpoint] += 1
+            return entry[2]
+
+        while key in self._inflight:
+            inflight = self._inflight[key]
+            try:
+                value = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # отменили ведущий запрос, а не этот: считаем сами вместо того, чтобы отменять всех ожидающих
+                if not inflight.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                continue
+            self.hits[endpoint] += 1
+            return value
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._get_shared(key)
+            if value is None:
+                self.misses[endpoint] += 1
+                value = await compute()
+                await self._set_shared(key, value, self.ttl_for(endpoint, ttl))
+            else:
+                self.hits[endpoint] += 1
+            self._set_local(key, tables, value, self.ttl_for(endpoint, ttl))
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _get_shared(self, key: str) -> Any:
+        if self._redis is None:
+            return None
+        raw = await self._redis.get(f"resflow:cache:{key}")
+        return pickle.loads(raw) if raw is not None else None
+
+    async def _set_shared(self, key: str, value: Any, ttl: float):
+        if self._redis is not None:
+            await self._redis.set(f"resflow:cache:{key}", pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def _apply_versions(self, versions: Dict[str, str]):
+        changed = [t for t in versions if self._versions.get(t) != versions[t]]
+        self._versions = {**self._versions, **versions}
+        self._drop(changed)
+
+    async def refresh_versions(self):
+        """
+        clickhouse table versions only, external sources are polled by watch_sources
+        """
+        rows = (await self._pool.query("""
+            SELECT table, toString(sum(rows)) || ':' || toString(max(max_block_number))
+            FROM system.parts
+            WHERE active AND database = currentDatabase() AND table IN {tables:Array(String)}
+            GROUP BY table
+        """, parameters={"tables": list(WATCHED_TABLES)})).result_rows
+        versions = {table: "" for table in WATCHED_TABLES}
+        versions.update(dict(rows))
+        self._apply_versions(versions)
+
+    async def refresh_sources(self):
+        async def poll(name: str, source: Callable[[], Awaitable[str]]):
+            try:
+                return name, await asyncio.wait_for(source(), self._source_timeout)
+            except Exception as exc:
+                # недоступный источник не должен сбрасывать кэш, оставляем прошлую версию
+                logger.warning("%s version refresh failed: %r", name, exc)
+                return name, self._versions.get(name, "")
+
+        results = await asyncio.gather(*[poll(name, source) for name, source in self._version_sources.items()])
+        self._apply_versions(dict(results))
+
+    def add_version_source(self, name: str, source: Callable[[], Awaitable[str]]):
+        """
+        data outside clickhouse (e.g. the vector index) versioned by a callback,
+        usable in `tables` of cached() like a watched table
+        """
+        self._version_sources[name] = source
+
+    def _drop(self, tables: Iterable[str]):
+        tables = set(tables)
+        if not tables:
+            return
+        for key in [k for k, (_, deps, _) in self._entries.items() if tables.intersection(deps)]:
+            del self._entries[key]
+
+    async def invalidate(self, *tables: str):
+        self._drop(tables)
+        await self.refresh_versions()
+
+    async def _watch_tables(self, interval: float):
+        while True:
+            try:
+                await self.refresh_versions()
+            except Exception as exc:
+                logger.warning("cache version refresh failed: %r", exc)
+            await asyncio.sleep(interval)
+
+    async def _watch_sources(self, interval: float):
+        while True:
+            await self.refresh_sources()
+            await asyncio.sleep(interval)
+
+    async def watch(self, interval: float):
+        """
+        polls clickhouse and the external sources in separate loops, a slow source never delays table versions
+        """
+        await asyncio.gather(self._watch_tables(interval), self._watch_sources(interval))
+
+    def stats(self) -> Dict[str, Any]:
+        endpoints = sorted(set(self.hits) | set(self.misses))
+        return {
+            "entries": len(self._entries),
+            "max_entries": self._max_entries,
+            "shared_backend": self._redis is not None,
+            "versions": self._versions,
+            "endpoints": {
+                e: {
+                    "hits": self.hits[e],
+                    "misses": self.misses[e],
+                    "ttl": self.ttl_for(e, None),
+                }
+                for e in endpoints
+            },
+        }
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+
+
+result_cache = ResultCache(
+    pool=ch_pool,
+    max_entries=cache_settings.cache_max_entries,
+    default_ttl=cache_settings.cache_default_ttl,
+    ttls=cache_settings.cache_ttls,
+    redis_dsn=cache_settings.cache_redis_dsn,
+    source_timeout=cache_settings.cache_source_timeout,
+)
+
+
+def cached(endpoint: str, ttl: Optional[float] = None, tables: Tuple[str, ...] = ("comments",),
+           ignore: Tuple[str, ...] = ()):
+    """
+    caches an async endpoint/fetcher by its arguments (except the connection and `ignore`, which must be
+    determined by the other arguments). keeps the wrapped signature so FastAPI still resolves dependencies
+    """
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if not cache_settings.cache_enabled:
+                return await fn(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = {k: v for k, v in bound.arguments.items() if k != "connection" and k not in ignore}
+            return await result_cache.get_or_compute(
+                endpoint, params, tables, ttl, lambda: fn(*args, **kwargs)
+            )
+
+        return wrapper
+
+    return decorator
@@ -1,17 +1,264 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from clickhouse_connect import get_client
+from clickhouse_connect.driver.client import Client
 
 
 class Settings(BaseSettings):
     clickhouse_dsn: str
+    clickhouse_pool_size: int = 8
+    clickhouse_checkout_timeout: float = 10.0
+    clickhouse_query_timeout: int = 30
+    clickhouse_rollups_enabled: bool = True
+    clickhouse_export_timeout: int = 600
+    # выгрузки держат клиента минутами, поэтому у них свой маленький пул, а не общий с дашбордами
+    clickhouse_export_pool_size: int = 2
+    clickhouse_export_chunk_size: int = 1 << 16
 
-    model_config = SettingsConfigDict(env_file=".env", env_prefix="")
+    model_config = SettingsConfigDict(env_file=".env", env_prefix="", extra="ignore")
 
 
 settings = Settings()
 
-ch_client = get_client(dsn=settings.clickhouse_dsn)
+
+class PoolExhaustedError(Exception):
+    """
+    no client became free within the checkout timeout, the api answers 503
+    """
+
+
+@dataclass
+class PoolStats:
+    size: int
+    created: int = 0
+    in_use: int = 0
+    peak_in_use: int = 0
+    checkouts: int = 0
+    waited: int = 0
+    timeouts: int = 0
+    wait_time_total: float = 0.0
+    wait_time_max: float = 0.0
+
+    def record_checkout(self, wait_time: float):
+        self.checkouts += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "created": self.created,
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+            "saturation": round(self.in_use / self.size, 3),
+            "checkouts": self.checkouts,
+            "waited": self.waited,
+            "timeouts": self.timeouts,
+            "wait_time_avg_ms": round(1000 * self.wait_time_total / self.checkouts, 3) if self.checkouts else 0.0,
+            "wait_time_max_ms": round(1000 * self.wait_time_max, 3),
+        }
+
+
+class ClickHousePool:
+    """
+    bounded pool of clickhouse clients.
+    every query checks out its own client and runs in a worker thread,
+    so slow queries don't block the event loop and concurrent requests don't share one http session
+    """
+
+    def __init__(self, dsn: str, size: int, checkout_timeout: float, query_timeout: int):
+        self._dsn = dsn
+        self._size = size
+        self._checkout_timeout = checkout_timeout
+        self._query_timeout = query_timeout
+        self._idle: asyncio.LifoQueue = asyncio.LifoQueue()
+        self._clients = []
+        # вызов, который сейчас выполняется на клиенте в потоке пула
+        self._busy: Dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="clickhouse")
+        self.stats = PoolStats(size=size)
+
+    def _connect(self) -> Client:
+        return get_client(dsn=self._dsn, send_receive_timeout=self._query_timeout + 5)
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def _acquire(self) -> Client:
+        started = time.perf_counter()
+        if self._idle.empty() and self.stats.created < self._size:
+            self.stats.created += 1
+            connecting = self._executor.submit(self._connect)
+            try:
+                client = await asyncio.wrap_future(connecting)
+            except asyncio.CancelledError:
+                # подключение доделается в потоке, такой клиент сразу попадёт в пул свободных
+                loop = asyncio.get_running_loop()
+                connecting.add_done_callback(lambda f: loop.call_soon_threadsafe(self._adopt, f))
+                raise
+            except Exception:
+                self.stats.created -= 1
+                raise
+            self._clients.append(client)
+        else:
+            if self._idle.empty():
+                self.stats.waited += 1
+            try:
+                client = await asyncio.wait_for(self._idle.get(), self._checkout_timeout)
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                raise PoolExhaustedError("ClickHouse connection pool is exhausted")
+        self.stats.record_checkout(time.perf_counter() - started)
+        return client
+
+    def _adopt(self, connecting: Future):
+        if connecting.exception() is not None:
+            self.stats.created -= 1
+            return
+        self._clients.append(connecting.result())
+        self._idle.put_nowait(connecting.result())
+
+    def _release(self, client: Client):
+        self.stats.in_use -= 1
+        self._idle.put_nowait(client)
+
+    async def _call(self, client: Client, fn, *args, **kwargs):
+        """
+        runs a blocking call on a checked-out client in a pool thread and remembers it,
+        so checkout() knows whether the thread is still using the client
+        """
+        future = self._executor.submit(functools.partial(fn, *args, **kwargs))
+        self._busy[id(client)] = future
+        return await asyncio.wrap_future(future)
+
+    @asynccontextmanager
+    async def checkout(self):
+        client = await self._acquire()
+        try:
+            yield client
+        finally:
+            busy = self._busy.pop(id(client), None)
+            if busy is not None and not busy.done():
+                # вызывающий отменён, а запрос ещё идёт в потоке: клиент вернётся в пул, когда поток закончит
+                loop = asyncio.get_running_loop()
+                busy.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release, client))
+            else:
+                self._release(client)
+
+    def _close_on_thread(self, client: Client, close):
+        """
+        closes a stream on a pool thread after the call still running on the client (if any) has returned.
+        the close becomes the client's pending call, so checkout() releases the client only after it
+        """
+        closed = Future()
+
+        def run(_=None):
+            try:
+                close()
+            except Exception:
+                pass
+            finally:
+                closed.set_result(None)
+
+        busy = self._busy.get(id(client))
+        if busy is not None and not busy.done():
+            busy.add_done_callback(lambda _: self._executor.submit(run))
+        else:
+            self._executor.submit(run)
+        self._busy[id(client)] = closed
+
+    def _settings(self, settings: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"max_execution_time": self._query_timeout, **(settings or {})}
+
+    async def query(self, query: str, parameters=None, settings=None, external_data=None):
+        async with self.checkout() as client:
+            return await self._call(
+                client, client.query, query,
+                parameters=parameters, settings=self._settings(settings), external_data=external_data,
+            )
+
+    async def stream_rows(self, query: str, parameters=None, settings=None, external_data=None):
+        """
+        yields row blocks as clickhouse sends them, holding one client for the whole stream
+        """
+        async with self.checkout() as client:
+            stream = await self._call(
+                client, client.query_row_block_stream, query,
+                parameters=parameters, settings=self._settings(settings), external_data=external_data,
+            )
+            stream.__enter__()
+            try:
+                while True:
+                    block = await self._call(client, next, stream, None)
+                    if block is None:
+                        break
+                    yield block
+            finally:
+                self._close_on_thread(client, lambda: stream.__exit__(None, None, None))
+
+    async def stream_raw(self, query: str, fmt: str, parameters=None, settings=None, external_data=None,
+                         chunk_size: int = 1 << 16):
+        """
+        yields the response body in a clickhouse output format (Parquet, ArrowStream, ...) chunk by chunk
+        """
+        async with self.checkout() as client:
+            stream = await self._call(
+                client, client.raw_stream, query,
+                parameters=parameters, settings=self._settings(settings), fmt=fmt, external_data=external_data,
+            )
+            try:
+                while True:
+                    chunk = await self._call(client, stream.read, chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                self._close_on_thread(client, stream.close)
+
+    async def command(self, cmd: str, parameters=None, settings=None):
+        async with self.checkout() as client:
+            return await self._call(
+                client, client.command, cmd, parameters=parameters, settings=self._settings(settings),
+            )
+
+    async def insert(self, table: str, data, column_names=None):
+        async with self.checkout() as client:
+            return await self._call(client, client.insert, table, data, column_names=column_names or "*")
+
+    def close(self):
+        for client in self._clients:
+            client.close()
+        self._executor.shutdown(wait=False)
+
+
+ch_pool = ClickHousePool(
+    dsn=settings.clickhouse_dsn,
+    size=settings.clickhouse_pool_size,
+    checkout_timeout=settings.clickhouse_checkout_timeout,
+    query_timeout=settings.clickhouse_query_timeout,
+)
+
+export_pool = ClickHousePool(
+    dsn=settings.clickhouse_dsn,
+    size=settings.clickhouse_export_pool_size,
+    checkout_timeout=settings.clickhouse_checkout_timeout,
+    query_timeout=settings.clickhouse_export_timeout,
+)
 
 
 async def get_clickhouse():
-    return ch_client
+    return ch_pool
+
+
+async def get_export_clickhouse():
+    return export_pool
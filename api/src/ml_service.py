@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import random
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+from fastapi import HTTPException
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class MLServiceSettings(BaseSettings):
+    # сервис ml из api/.kube/ml.yaml, адрес gpu-хоста задан там, локально переопределяется ML_SERVICE_URL
+    ml_service_url: str = "http://ml.resflow.svc.cluster.local"
+    ml_service_timeout: float = 30.0
+    ml_service_connect_timeout: float = 5.0
+    ml_service_max_connections: int = 32
+    ml_service_retries: int = 3
+    ml_service_backoff: float = 0.5
+    # большие запросы на разметку режутся на куски и отправляются параллельно
+    ml_predict_chunk_size: int = 256
+    ml_predict_concurrency: int = 4
+
+    model_config = SettingsConfigDict(env_file=".env", env_prefix="", extra="ignore")
+
+
+ml_settings = MLServiceSettings()
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class MLServiceClient:
+    """
+    async client for the ML service: one keep-alive connection pool per process,
+    retries with jittered exponential backoff, identical concurrent predict chunks share one backend call
+    """
+
+    def __init__(self, base_url: str, timeout: float, connect_timeout: float, max_connections: int,
+                 retries: int, backoff: float, chunk_size: int, concurrency: int):
+        self._base_url = base_url
+        self._timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._retries = retries
+        self._backoff = backoff
+        self._chunk_size = chunk_size
+        self._concurrency = concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+        self.retried = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # создаётся лениво: клиент привязан к event loop, а модуль импортируется до его запуска
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self._base_url, timeout=self._timeout, limits=self._limits)
+        return self._client
+
+    async def _request(self, method: str, path: str, retries: Optional[int] = None, **kwargs) -> Any:
+        retries = self._retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    response.raise_for_status()
+                    return response.json()
+            except httpx.TransportError as exc:
+                if attempt == retries:
+                    raise HTTPException(status_code=502, detail=f"ML service is unavailable: {exc!r}")
+            except httpx.HTTPStatusError as exc:
+                raise HTTPException(status_code=502, detail=f"ML service returned {exc.response.status_code}")
+            self.retried += 1
+            await asyncio.sleep(self._backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    async def nearest_comments(self, text: str, limit: Optional[int] = None,
+                               score_threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        params = {"comment": text, "limit": limit, "score_threshold": score_threshold}
+        response = await self._request("GET", "/embeddings", params={k: v for k, v in params.items() if v is not None})
+        return response["matches"]
+
+    async def index_version(self, timeout: float = 2.0) -> str:
+        # опрашивается фоном раз в несколько секунд: без повторов и с коротким таймаутом
+        return (await self._request("GET", "/embeddings/version", retries=0, timeout=timeout))["version"]
+
+    async def _predict_chunk(self, texts: Sequence[str]) -> List[Dict[str, Any]]:
+        payload = {"data": [{"id": i, "text": text} for i, text in enumerate(texts)]}
+        predictions = (await self._request("POST", "/get_comments_predicts", json=payload))["predictions"]
+        return sorted(predictions, key=lambda p: p["id"])
+
+    async def _predict_coalesced(self, texts: Sequence[str]) -> List[Dict[str, Any]]:
+        key = hashlib.sha1("\0".join(texts).encode()).hexdigest()
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._predict_chunk(texts)
+            future.set_result(result)
+            return result
+        except BaseException as exc:
+            if isinstance(exc, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(exc)
+                future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def predict(self, texts: Sequence[str]) -> List[Dict[str, Any]]:
+        """
+        topics and sentiments per text, in input order: [{"topics": [...], "sentiments": [...]}, ...]
+        """
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def run(chunk):
+            async with semaphore:
+                return await self._predict_coalesced(chunk)
+
+        chunks = [texts[i:i + self._chunk_size] for i in range(0, len(texts), self._chunk_size)]
+        results = await asyncio.gather(*[run(chunk) for chunk in chunks])
+        return [
+            {"topics": p["topics"], "sentiments": p["sentiments"]}
+            for chunk in results for p in chunk
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self._inflight), "coalesced": self.coalesced, "retried": self.retried}
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+ml_client = MLServiceClient(
+    base_url=ml_settings.ml_service_url,
+    timeout=ml_settings.ml_service_timeout,
+    connect_timeout=ml_settings.ml_service_connect_timeout,
+    max_connections=ml_settings.ml_service_max_connections,
+    retries=ml_settings.ml_service_retries,
+    backoff=ml_settings.ml_service_backoff,
+    chunk_size=ml_settings.ml_predict_chunk_size,
+    concurrency=ml_settings.ml_predict_concurrency,
+)
@@ -0,0 +1,95 @@
+from typing import List, NamedTuple
+
+from api.models.Filter import Filters
+from api.src.cache import cached
+from api.src.clickhouse import ClickHousePool
+from api.utils.planner import search_stats_query, service_stats_query, tag_stats_query
+
+
+class TagStat(NamedTuple):
+    tag: str
+    mentions: int
+    positive: int
+    neutral: int
+    negative: int
+    sentiment_sum: int
+    rating_sum: float
+
+    @property
+    def avg_sentiment(self) -> float:
+        return self.sentiment_sum / self.mentions if self.mentions else 0.0
+
+
+class ServiceStat(NamedTuple):
+    service: str
+    comments: int
+    rating_sum: float
+
+
+class KeywordStat(NamedTuple):
+    keyword: str
+    mentions: int
+    rating_sum: float
+
+    @property
+    def avg_rating(self) -> float:
+        return self.rating_sum / self.mentions if self.mentions else 0.0
+
+
+class SearchStats(NamedTuple):
+    tags: List[TagStat]
+    services: List[ServiceStat]
+    keywords: List[KeywordStat]
+
+
+@cached("aggregations/tag_stats")
+async def fetch_tag_stats(connection: ClickHousePool, filters: Filters) -> List[TagStat]:
+    """
+    one scan over tag mentions, shared by every per-tag widget
+    (histograms, pareto, scatter, sentiment pie, average sentiment, liked/disliked clusters)
+    """
+    query, where = tag_stats_query(filters)
+    rows = (await connection.query(query, **where.query_args())).result_rows
+    return [TagStat(*row) for row in rows]
+
+
+@cached("aggregations/service_stats")
+async def fetch_service_stats(connection: ClickHousePool, filters: Filters) -> List[ServiceStat]:
+    """
+    one scan over comments grouped by service, shared by comment counters, average mark and service pie
+    """
+    query, where = service_stats_query(filters)
+    rows = (await connection.query(query, **where.query_args())).result_rows
+    return [ServiceStat(*row) for row in rows]
+
+
+@cached("aggregations/positive_rating_share")
+async def fetch_positive_rating_share(connection: ClickHousePool, filters: Filters) -> float:
+    """
+    share of comments rated above 3 over the whole corpus, filters are intentionally ignored
+    """
+    return (await connection.query("""
+        SELECT
+            floor((SELECT COUNT(*) FROM comments WHERE rating > 3) / (SELECT COUNT(*) FROM comments) * 100)
+    """)).result_rows[0][0]
+
+
+@cached("aggregations/search_stats")
+async def fetch_search_stats(connection: ClickHousePool, filters: Filters) -> SearchStats:
+    """
+    tag, service and keyword stats of a (large) comment id set from one query,
+    so the id list is shipped to clickhouse once instead of once per widget
+    """
+    query, where = search_stats_query(filters)
+    rows = (await connection.query(query, **where.query_args())).result_rows
+    stats = SearchStats([], [], [])
+    for kind, key, n, positive, neutral, negative, sentiment_sum, rating_sum in rows:
+        if kind == "tag":
+            stats.tags.append(TagStat(key, n, positive, neutral, negative, sentiment_sum, rating_sum))
+        elif kind == "service":
+            stats.services.append(ServiceStat(key, n, rating_sum))
+        else:
+            stats.keywords.append(KeywordStat(key, n, rating_sum))
+    for items in stats:
+        items.sort(key=lambda x: x[1], reverse=True)
+    return stats
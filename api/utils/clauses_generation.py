@@ -1,33 +1,129 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from clickhouse_connect.driver.external import ExternalData
+
 from api.models.Filter import Filters
 
+DEFAULT_BANK = "газпромбанк"
+
+# id sets larger than this are sent as an external table instead of an Array parameter
+EXTERNAL_IDS_THRESHOLD = 500
+EXTERNAL_IDS_TABLE = "_filter_comment_ids"
+
+
+@dataclass
+class WhereClause:
+    """
+    SQL condition with server-side parameters ({name:Type}) and optional external tables.
+    the SQL text depends only on which filters are set, not on their values
+    """
+    sql: str
+    parameters: Dict[str, Any] = field(default_factory=dict)
+    external_data: Optional[ExternalData] = None
+
+    def __str__(self) -> str:
+        return self.sql
+
+    def query_args(self, **parameters) -> Dict[str, Any]:
+        return {
+            "parameters": {**self.parameters, **parameters},
+            "external_data": self.external_data,
+        }
+
+
+class WhereBuilder:
+    def __init__(self):
+        self._conditions: List[str] = []
+        self._parameters: Dict[str, Any] = {}
+        self._external_data: Optional[ExternalData] = None
+
+    def add(self, condition: str, **parameters) -> "WhereBuilder":
+        self._conditions.append(condition)
+        self._parameters.update(parameters)
+        return self
+
+    def add_ids(self, column: str, name: str, ids: List[str]) -> "WhereBuilder":
+        if len(ids) <= EXTERNAL_IDS_THRESHOLD:
+            return self.add(f"{column} IN {{{name}:Array(String)}}", **{name: list(ids)})
+        self._external_data = ExternalData(
+            file_name=EXTERNAL_IDS_TABLE,
+            data="\n".join(_escape_tsv(x) for x in ids).encode(),
+            fmt="TabSeparated",
+            structure=["comment_id String"],
+        )
+        self._conditions.append(f"{column} IN (SELECT comment_id FROM {EXTERNAL_IDS_TABLE})")
+        return self
+
+    def build(self) -> WhereClause:
+        sql = " AND ".join(self._conditions) if self._conditions else "True"
+        return WhereClause(sql, dict(self._parameters), self._external_data)
+
+
+def _escape_tsv(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
 
-def generate_where_clause(filters: Filters) -> str:
-    sql_filters = []
+
+def _add_common_filters(where: WhereBuilder, filters: Filters):
     if filters.service:
-        services_str = ','.join(f"'{s}'" for s in filters.service)
-        sql_filters.append(f"service IN ({services_str})")
+        where.add("service IN {f_service:Array(String)}", f_service=filters.service)
     if filters.start_date:
-        sql_filters.append(f"date >= '{filters.start_date}'")
+        where.add("date >= {f_start_date:Date}", f_start_date=filters.start_date)
     if filters.end_date:
-        sql_filters.append(f"date <= '{filters.end_date}'")
+        where.add("date <= {f_end_date:Date}", f_end_date=filters.end_date)
     if filters.min_rating:
-        sql_filters.append(f"rating >= {int(filters.min_rating)}")
+        where.add("rating >= {f_min_rating:Int32}", f_min_rating=int(filters.min_rating))
     if filters.max_rating:
-        sql_filters.append(f"rating <= {int(filters.max_rating)}")
+        where.add("rating <= {f_max_rating:Int32}", f_max_rating=int(filters.max_rating))
+    if filters.source:
+        where.add("source IN {f_source:Array(String)}", f_source=filters.source)
+
+    where.add("bank = {f_bank:String}", f_bank=filters.concurrent or DEFAULT_BANK)
+
+
+def generate_where_clause(filters: Filters) -> WhereClause:
+    """
+    condition over `comments` (and the daily rollups, which share its filter columns)
+    """
+    where = WhereBuilder()
+    _add_common_filters(where, filters)
     if filters.text:
-        sql_filters.append(f"comment ILIKE '%{filters.text}%'")
+        where.add("comment ILIKE concat('%', {f_text:String}, '%')", f_text=filters.text)
     if filters.tags:
-        sql_filters.append(f"hasAny(mapKeys(tags), {filters.tags})")
-    if filters.source:
-        source_str = ','.join(f"'{s}'" for s in filters.source)
-        sql_filters.append(f"source IN ({source_str})")
+        where.add("hasAny(mapKeys(tags), {f_tags:Array(String)})", f_tags=filters.tags)
+    if filters.comment_ids:
+        where.add_ids("comment_id", "f_comment_ids", filters.comment_ids)
+    return where.build()
 
-    if filters.concurrent:
-        sql_filters.append(f"bank = '{filters.concurrent}'")
-    else:
-        sql_filters.append(f"bank = 'газпромбанк'")
 
+def generate_tags_where_clause(filters: Filters) -> WhereClause:
+    """
+    the same filters over the flattened `comment_tags` table,
+    text and tag membership are resolved per comment through comment_id
+    """
+    where = WhereBuilder()
+    _add_common_filters(where, filters)
+    if filters.text:
+        where.add(
+            "comment_id IN (SELECT toString(comment_id) FROM comments "
+            "WHERE bank = {f_bank:String} AND comment ILIKE concat('%', {f_text:String}, '%'))",
+            f_text=filters.text,
+        )
+    if filters.tags:
+        where.add(
+            "comment_id IN (SELECT comment_id FROM comment_tags "
+            "WHERE bank = {f_bank:String} AND tag IN {f_tags:Array(String)})",
+            f_tags=filters.tags,
+        )
     if filters.comment_ids:
-        sql_filters.append(f'comment_id IN ({", ".join(["'" + id_ + "'" for id_ in filters.comment_ids])})')
-    where_clause = f"{' AND '.join(sql_filters)}" if sql_filters else "True"
-    return where_clause
+        where.add_ids("comment_id", "f_comment_ids", filters.comment_ids)
+    return where.build()
+
+
+def generate_date_clause(filters: Filters, column: str = "toDate(date)") -> WhereClause:
+    where = WhereBuilder()
+    if filters.start_date:
+        where.add(f"{column} >= {{f_start_date:Date}}", f_start_date=filters.start_date)
+    if filters.end_date:
+        where.add(f"{column} <= {{f_end_date:Date}}", f_end_date=filters.end_date)
+    return where.build()
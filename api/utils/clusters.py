@@ -1,22 +1,15 @@
-from clickhouse_connect.driver.client import Client
-from api.models.Filter import get_filters, Filters
-from api.utils.clauses_generation import generate_where_clause
+from typing import List
 
+from api.src.clickhouse import ClickHousePool
+from api.models.Filter import Filters
+from api.utils.aggregations import TagStat, fetch_tag_stats
 
-def get_cluster_info(connection: Client, filters: Filters, reversed=True):
-    data = connection.query(f"""
-        SELECT `key`, countIf(value=1)/COUNT(*) FROM (
-	        SELECT
-    	        key,
-    	        value
-	        FROM comments
-		        ARRAY JOIN
-    		        mapKeys(tags) AS key,
-    		        mapValues(tags) AS value
-    	    WHERE {generate_where_clause(filters)}
-        )
-        GROUP BY `key`
-    """).result_rows
-    t = list(map(lambda x: {'cluster': x[0], 'value': x[1]}, data))
+
+def cluster_info_from_stats(stats: List[TagStat], reversed=True):
+    t = [{'cluster': s.tag, 'value': s.positive / s.mentions} for s in stats if s.mentions]
     t.sort(key=lambda x: x['value'], reverse=reversed)
     return t
+
+
+async def get_cluster_info(connection: ClickHousePool, filters: Filters, reversed=True):
+    return cluster_info_from_stats(await fetch_tag_stats(connection, filters), reversed=reversed)
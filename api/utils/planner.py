@@ -0,0 +1,132 @@
+from typing import Sequence, Tuple
+
+from api.models.Filter import Filters
+from api.src.clickhouse import settings
+from api.utils.clauses_generation import WhereClause, generate_where_clause, generate_tags_where_clause
+
+
+def can_use_rollups(filters: Filters) -> bool:
+    """
+    daily rollups are keyed by (bank, service, source, date, rating),
+    filters on comment text, ids or tag membership need the raw rows
+    """
+    return settings.clickhouse_rollups_enabled and not (filters.text or filters.comment_ids or filters.tags)
+
+
+def daily_comments_query(filters: Filters) -> Tuple[str, WhereClause]:
+    """
+    per-day comment count and rating sum: (date, comments, rating_sum)
+    """
+    where = generate_where_clause(filters)
+    if can_use_rollups(filters):
+        return f"""
+            SELECT date, sum(comments) AS comments, sum(rating * comments) AS rating_sum
+            FROM comments_daily
+            WHERE {where}
+            GROUP BY date
+        """, where
+    return f"""
+        SELECT date, count() AS comments, sum(rating) AS rating_sum
+        FROM comments
+        WHERE {where}
+        GROUP BY date
+    """, where
+
+
+def service_stats_query(filters: Filters) -> Tuple[str, WhereClause]:
+    """
+    per-service comment count and rating sum: (service, comments, rating_sum)
+    """
+    where = generate_where_clause(filters)
+    if can_use_rollups(filters):
+        return f"""
+            SELECT service, sum(comments) AS comments, sum(rating * comments) AS rating_sum
+            FROM comments_daily
+            WHERE {where}
+            GROUP BY service
+            ORDER BY comments DESC
+        """, where
+    return f"""
+        SELECT service, count() AS comments, sum(rating) AS rating_sum
+        FROM comments
+        WHERE {where}
+        GROUP BY service
+        ORDER BY comments DESC
+    """, where
+
+
+def tag_stats_query(filters: Filters, group_by: Sequence[str] = ("tag",)) -> Tuple[str, WhereClause]:
+    """
+    per-tag mention counters grouped by `group_by` (tag, optionally date):
+    (*group_by, mentions, positive, neutral, negative, sentiment_sum, rating_sum)
+    """
+    keys = ", ".join(group_by)
+    if can_use_rollups(filters):
+        where = generate_where_clause(filters)
+        return f"""
+            SELECT
+                {keys},
+                sum(mentions) AS mentions,
+                sumIf(mentions, sentiment = 1) AS positive,
+                sumIf(mentions, sentiment = 0) AS neutral,
+                sumIf(mentions, sentiment = -1) AS negative,
+                sum(sentiment * mentions) AS sentiment_sum,
+                sum(rating * mentions) AS rating_sum
+            FROM comment_tags_daily
+            WHERE {where}
+            GROUP BY {keys}
+            ORDER BY mentions DESC
+        """, where
+    where = generate_tags_where_clause(filters)
+    return f"""
+        SELECT
+            {keys},
+            count() AS mentions,
+            countIf(sentiment = 1) AS positive,
+            countIf(sentiment = 0) AS neutral,
+            countIf(sentiment = -1) AS negative,
+            sum(sentiment) AS sentiment_sum,
+            sum(rating) AS rating_sum
+        FROM comment_tags
+        WHERE {where}
+        GROUP BY {keys}
+        ORDER BY mentions DESC
+    """, where
+
+
+def search_stats_query(filters: Filters, keywords_limit: int = 100) -> Tuple[str, WhereClause]:
+    """
+    service, tag and keyword counters for one comment id set in a single query, the ids travel once.
+    rows are (kind, key, count, positive, neutral, negative, sentiment_sum, rating_sum),
+    kind is 'service', 'tag' or 'keyword'
+    """
+    where = generate_where_clause(filters)
+    tags_where = generate_tags_where_clause(filters)
+    # оба условия ссылаются на одну и ту же внешнюю таблицу / параметр с id
+    combined = WhereClause(where.sql, {**tags_where.parameters, **where.parameters},
+                           where.external_data or tags_where.external_data)
+    return f"""
+        SELECT 'service' AS kind, service AS key, count() AS n,
+               toUInt64(0) AS positive, toUInt64(0) AS neutral, toUInt64(0) AS negative,
+               toInt64(0) AS sentiment_sum, toFloat64(sum(rating)) AS rating_sum
+        FROM comments
+        WHERE {where}
+        GROUP BY service
+        UNION ALL
+        SELECT 'tag', tag, count(), countIf(sentiment = 1), countIf(sentiment = 0), countIf(sentiment = -1),
+               toInt64(sum(sentiment)), toFloat64(sum(rating))
+        FROM comment_tags
+        WHERE {tags_where}
+        GROUP BY tag
+        UNION ALL
+        SELECT 'keyword', keyword, keyword_count, toUInt64(0), toUInt64(0), toUInt64(0), toInt64(0), rating_sum
+        FROM (
+            SELECT keyword, count() AS keyword_count, toFloat64(sum(rating)) AS rating_sum
+            FROM comments
+            ARRAY JOIN keywords AS keyword
+            WHERE {where}
+            GROUP BY keyword
+            ORDER BY keyword_count DESC
+            LIMIT {keywords_limit}
+        )
+    """, combined
@@ -0,0 +1,143 @@
+"""
+publishing to rabbitmq, shared by the api (api/src/amqp.py) and the parsers (parsers/publisher.py):
+each side builds a Publisher from its own settings. the ml worker unpacks gzip bodies by their content_encoding
+"""
+import asyncio
+import gzip
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+import aio_pika
+
+logger = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    """
+    publishing stopped part way: the first `published` messages were confirmed by the broker, the rest were not
+    """
+
+    def __init__(self, message: str, published: int):
+        super().__init__(message)
+        self.published = published
+
+
+class QueueFullError(PublishError):
+    pass
+
+
+class Publisher:
+    """
+    one robust connection per process and a small pool of confirm-mode channels.
+    a batch is published without awaiting each message and confirmed as a whole,
+    before each batch the queue depth is checked: a deep queue means the ml worker is behind and publishing waits
+    """
+
+    def __init__(self, dsn: str, pool_size: int, batch_size: int, compress: bool, compress_min_bytes: int,
+                 max_queue_depth: int, backpressure_poll: float, backpressure_timeout: float):
+        self._dsn = dsn
+        self._pool_size = pool_size
+        self._batch_size = batch_size
+        self._compress = compress
+        self._compress_min_bytes = compress_min_bytes
+        self._max_queue_depth = max_queue_depth
+        self._backpressure_poll = backpressure_poll
+        self._backpressure_timeout = backpressure_timeout
+        self._connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._channels: Optional[asyncio.Queue] = None
+        self.published = 0
+        self.throttled = 0.0
+
+    async def _connect(self) -> aio_pika.abc.AbstractRobustConnection:
+        # создаётся лениво: соединение привязано к event loop, а модуль импортируется до его запуска.
+        # у каждого запуска flow в prefect может быть свой loop, тогда соединение открывается заново
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._connection = None
+            self._connect_lock = asyncio.Lock()
+            self._channels = asyncio.Queue()
+            for _ in range(self._pool_size):
+                self._channels.put_nowait(None)
+        async with self._connect_lock:
+            if self._connection is None:
+                self._connection = await aio_pika.connect_robust(self._dsn)
+        return self._connection
+
+    @asynccontextmanager
+    async def channel(self):
+        connection = await self._connect()
+        channel = await self._channels.get()
+        try:
+            if channel is None or channel.is_closed:
+                channel = await connection.channel(publisher_confirms=True)
+            yield channel
+        finally:
+            self._channels.put_nowait(channel)
+
+    async def queue_depth(self, queue: str) -> int:
+        async with self.channel() as channel:
+            # passive: только узнать глубину, не создавая и не переобъявляя очередь (её объявляет воркер).
+            # если очереди нет, брокер закрывает канал, channel() откроет новый при следующем запросе
+            declared = await channel.declare_queue(queue, durable=True, passive=True)
+            return declared.declaration_result.message_count
+
+    async def _wait_for_room(self, queue: str, published: int):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while await self.queue_depth(queue) > self._max_queue_depth:
+            if loop.time() - started > self._backpressure_timeout:
+                raise QueueFullError(f"queue {queue} is full, try again later", published)
+            logger.info("queue %s is over %d messages, waiting", queue, self._max_queue_depth)
+            await asyncio.sleep(self._backpressure_poll)
+        self.throttled += loop.time() - started
+
+    def _message(self, body: bytes) -> aio_pika.Message:
+        if self._compress and len(body) >= self._compress_min_bytes:
+            return aio_pika.Message(
+                body=gzip.compress(body, compresslevel=1),
+                content_encoding="gzip",
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            )
+        return aio_pika.Message(body=body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+
+    async def publish(self, queue: str, bodies: Iterable[bytes]) -> int:
+        """
+        publishes bodies to `queue` through the default exchange, returns once the broker confirmed all of them.
+        raises PublishError (QueueFullError on backpressure timeout) with the number of confirmed messages
+        """
+        bodies: List[bytes] = list(bodies)
+        for start in range(0, len(bodies), self._batch_size):
+            batch = bodies[start:start + self._batch_size]
+            try:
+                await self._wait_for_room(queue, start)
+                async with self.channel() as channel:
+                    await asyncio.gather(*[
+                        channel.default_exchange.publish(self._message(body), routing_key=queue) for body in batch
+                    ])
+            except PublishError:
+                raise
+            except Exception as exc:
+                # в упавшей пачке часть сообщений могла дойти, но подтверждены только предыдущие пачки
+                raise PublishError(f"publishing to {queue} failed: {exc!r}", start) from exc
+            self.published += len(batch)
+        return len(bodies)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connected": self._connection is not None and not self._connection.is_closed,
+            "idle_channels": self._channels.qsize() if self._channels is not None else self._pool_size,
+            "published": self.published,
+            "throttled_seconds": round(self.throttled, 3),
+        }
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+            self._loop = None
+            self._connect_lock = None
+            self._channels = None
@@ -0,0 +1,14 @@
+"""
+content hash of a review, shared by the parsers (parsers/dedup.py) and the ml worker (ml/dedup.py),
+so both sides look up the same keys in comment_hashes
+"""
+import hashlib
+
+
+def content_hash(service: str, name: str, date: str, comment: str) -> str:
+    """
+    sha1 of the normalized (service, author, day, text); api/migrations/005_comment_hashes.sql computes
+    the same value in sql for the backfill
+    """
+    parts = [service, name, str(date).strip()[:10], comment]
+    return hashlib.sha1("\x1f".join(" ".join(str(p).split()).lower() for p in parts).encode()).hexdigest()
@@ -0,0 +1,130 @@
+"""
+embeds comments already stored in clickhouse and upserts them into the qdrant `comments` collection:
+
+    python backfill_embeddings.py [--chunk-size 2048] [--reset]
+    python backfill_embeddings.py --missing [--days 3]
+
+rows are read in (date, comment_id) order, one page per query: the result is fetched before encoding starts,
+so a slow encoder never holds a clickhouse stream open. the last written key is checkpointed after every page,
+so an interrupted run continues where it stopped.
+--missing doesn't use the checkpoint: it re-checks comments of the last `days` days (0 - all) against qdrant
+and embeds only those without a point, e.g. after upserts that failed in the queue worker. run it on a schedule.
+with EMBEDDING_INDEX=local both modes append the vectors to the local index as well
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from clickhouse_connect import get_client
+from qdrant_client import QdrantClient
+from sentence_transformers import SentenceTransformer
+
+from embeddings import EMBEDDING_INDEX, EmbeddingService, LocalIndex, ensure_collection, upsert_embeddings
+from engine import DEVICE
+
+COLLECTION = "comments"
+CHECKPOINT = Path(os.getenv("EMBEDDING_BACKFILL_CHECKPOINT", "./bin/embedding_backfill.json"))
+
+PAGE_QUERY = """
+    SELECT toString(comment_id), comment, bank, service, source, toString(toDate(date))
+    FROM comments
+    WHERE (toDate(date), toString(comment_id)) > ({date:Date}, {comment_id:String})
+        AND ({days:UInt32} = 0 OR toDate(date) >= today() - {days:UInt32})
+    ORDER BY toDate(date), toString(comment_id)
+    LIMIT {limit:UInt32}
+"""
+
+
+def pages(clickhouse, page_size: int, date: str = "1970-01-01", comment_id: str = "", days: int = 0):
+    """
+    pages of rows after the (date, comment_id) key, each fetched completely by its own query
+    """
+    while True:
+        rows = clickhouse.query(PAGE_QUERY, parameters={
+            "date": date, "comment_id": comment_id, "days": days, "limit": page_size,
+        }).result_rows
+        if not rows:
+            return
+        yield rows
+        date, comment_id = rows[-1][5], rows[-1][0]
+
+
+def write_vectors(qdrant, local_index: Optional[LocalIndex], rows, vectors):
+    payloads = [{"bank": bank, "service": svc, "source": source, "date": date}
+                for _, _, bank, svc, source, date in rows]
+    ids = [row[0] for row in rows]
+    upsert_embeddings(qdrant, COLLECTION, ids, vectors, payloads)
+    if local_index is not None:
+        local_index.add(ids, vectors)
+
+
+def read_checkpoint() -> dict:
+    if CHECKPOINT.exists():
+        return json.loads(CHECKPOINT.read_text())
+    return {"date": "1970-01-01", "comment_id": "", "done": 0}
+
+
+def write_checkpoint(state: dict):
+    tmp = CHECKPOINT.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state))
+    tmp.replace(CHECKPOINT)
+
+
+def backfill(clickhouse, qdrant, service: EmbeddingService, chunk_size: int,
+             local_index: Optional[LocalIndex] = None):
+    state = read_checkpoint()
+    ensure_collection(qdrant, COLLECTION, service.encoder.get_sentence_embedding_dimension())
+
+    for rows in pages(clickhouse, chunk_size, state["date"], state["comment_id"]):
+        write_vectors(qdrant, local_index, rows, service.encode([row[1] for row in rows]))
+        state.update(date=rows[-1][5], comment_id=rows[-1][0], done=state["done"] + len(rows))
+        write_checkpoint(state)
+        print(f"{state['done']} comments, last {state['date']} {state['comment_id']}")
+
+
+def existing_ids(qdrant, ids) -> set:
+    points = qdrant.retrieve(collection_name=COLLECTION, ids=ids, with_payload=False, with_vectors=False)
+    return {str(point.id) for point in points}
+
+
+def backfill_missing(clickhouse, qdrant, service: EmbeddingService, chunk_size: int, days: int,
+                     local_index: Optional[LocalIndex] = None):
+    ensure_collection(qdrant, COLLECTION, service.encoder.get_sentence_embedding_dimension())
+    checked = embedded = 0
+    for rows in pages(clickhouse, chunk_size, days=days):
+        checked += len(rows)
+        present = existing_ids(qdrant, [row[0] for row in rows])
+        rows = [row for row in rows if row[0] not in present]
+        if rows:
+            write_vectors(qdrant, local_index, rows, service.encode([row[1] for row in rows]))
+        embedded += len(rows)
+    print(f"{checked} comments checked, {embedded} missing embedded")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk-size", type=int, default=2048)
+    parser.add_argument("--reset", action="store_true", help="start over, ignoring the saved checkpoint")
+    parser.add_argument("--missing", action="store_true", help="embed only comments that have no qdrant point")
+    parser.add_argument("--days", type=int, default=3, help="with --missing: how far back to check, 0 - all")
+    args = parser.parse_args()
+
+    if args.reset:
+        CHECKPOINT.unlink(missing_ok=True)
+    CHECKPOINT.parent.mkdir(parents=True, exist_ok=True)
+
+    clickhouse = get_client(dsn=os.environ["CLICKHOUSE_DSN"])
+    qdrant = QdrantClient(url=os.getenv("QDRANT_HOST"), api_key=os.getenv("QDRANT_API_KEY"))
+    # кэш не нужен: в выгрузке каждый текст встречается один раз
+    service = EmbeddingService(SentenceTransformer("./bin/embeddings_extractor").to(DEVICE), cache_size=0)
+    local_index = LocalIndex() if EMBEDDING_INDEX == "local" else None
+    if args.missing:
+        backfill_missing(clickhouse, qdrant, service, args.chunk_size, args.days, local_index)
+    else:
+        backfill(clickhouse, qdrant, service, args.chunk_size, local_index)
+
+
+if __name__ == "__main__":
+    main()
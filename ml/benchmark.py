@@ -0,0 +1,64 @@
+"""
+latency / throughput of the inference runtimes on the same comments:
+
+    ML_DEVICE=cpu python benchmark.py comments.jsonl --runtimes torch torch-int8 onnx --batch-size 16
+
+labels of every runtime are compared with the first one
+"""
+import argparse
+import statistics
+import time
+
+from pipeline import TopicSentimentPipeline
+from regression import read_comments
+from runtime import load_classifiers
+
+
+def run(pipe: TopicSentimentPipeline, texts, batch_size: int, warmup: int = 2):
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    for batch in batches[:warmup]:
+        pipe.predict(batch)
+
+    latencies, outputs = [], []
+    started = time.perf_counter()
+    for batch in batches:
+        t = time.perf_counter()
+        outputs.extend(pipe.predict(batch))
+        latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - started
+    return outputs, latencies, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("--runtimes", nargs="+", default=["torch", "torch-int8", "onnx"])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-length", type=int, default=1215)
+    args = parser.parse_args()
+
+    texts = read_comments(args.input)
+    reference = None
+    print(f"{len(texts)} comments, batch size {args.batch_size}")
+    print(f"{'runtime':<12}{'p50 ms':>10}{'p95 ms':>10}{'comments/s':>12}{'agreement':>12}")
+    for runtime in args.runtimes:
+        tokenizer, model, tokenizer_clf, clf = load_classifiers(runtime, args.device)
+        pipe = TopicSentimentPipeline(
+            tokenizer, model, tokenizer_clf, clf, args.device,
+            max_length=args.max_length, sentiment_max_length=args.max_length,
+        )
+        outputs, latencies, total = run(pipe, texts, args.batch_size)
+        if reference is None:
+            reference = outputs
+        agreement = sum(a == b for a, b in zip(outputs, reference)) / len(texts)
+        latencies_ms = sorted(1000 * x for x in latencies)
+        p95 = latencies_ms[min(len(latencies_ms) - 1, int(0.95 * len(latencies_ms)))]
+        print(
+            f"{runtime:<12}{statistics.median(latencies_ms):>10.1f}{p95:>10.1f}"
+            f"{len(texts) / total:>12.1f}{agreement:>12.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
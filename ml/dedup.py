@@ -0,0 +1,119 @@
+"""
+content-hash deduplication in front of inference: a bloom filter in memory answers "definitely new"
+for almost every fresh comment, only its "maybe seen" answers are confirmed in the exact clickhouse store.
+the worker is the only writer: a hash is recorded after its comment was processed and published
+"""
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Sequence, Set
+
+DEDUP_CAPACITY = int(os.getenv("DEDUP_CAPACITY", "2000000"))
+DEDUP_ERROR_RATE = float(os.getenv("DEDUP_ERROR_RATE", "0.001"))
+# как часто подтягивать хэши, записанные другими репликами воркера
+DEDUP_REFRESH_SECONDS = float(os.getenv("DEDUP_REFRESH_SECONDS", "30"))
+
+
+def comment_id_for(hash_: str) -> str:
+    """
+    stable comment_id derived from the content hash, so a reprocessed comment keeps its id (and its qdrant point)
+    """
+    return str(uuid.UUID(hash_[:32]))
+
+
+class BloomFilter:
+    def __init__(self, capacity: int = DEDUP_CAPACITY, error_rate: float = DEDUP_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, hash_: str):
+        # double hashing поверх уже посчитанного sha1: два 64-битных числа дают k позиций
+        h1, h2 = int(hash_[:16], 16), int(hash_[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, hash_: str):
+        for pos in self._positions(hash_):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hash_: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(hash_))
+
+
+class DedupStore:
+    def __init__(self, client, capacity: int = DEDUP_CAPACITY, refresh_seconds: float = DEDUP_REFRESH_SECONDS):
+        self._client = client
+        self._refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self.bloom = BloomFilter(capacity)
+        self._refreshed_at = 0.0
+        self.exact_checks = 0
+        self.duplicates = 0
+        self._load(0)
+
+    def _load(self, since: int):
+        started = time.time()
+        with self._client.query_row_block_stream(
+            "SELECT hash FROM comment_hashes WHERE first_seen >= toDateTime({since:UInt32})", parameters={"since": since},
+        ) as stream:
+            for block in stream:
+                for (hash_,) in block:
+                    self.bloom.add(hash_.decode() if isinstance(hash_, bytes) else hash_)
+        self._refreshed_at = started
+
+    def _refresh(self):
+        if time.time() - self._refreshed_at >= self._refresh_seconds:
+            # с запасом на рассинхрон часов и вставки, которые ещё не видны
+            self._load(max(0, int(self._refreshed_at) - 60))
+
+    def seen(self, hashes: Sequence[str]) -> Set[str]:
+        """
+        hashes already processed earlier (not counting repeats inside `hashes` itself)
+        """
+        with self._lock:
+            self._refresh()
+            maybe = [h for h in set(hashes) if h in self.bloom]
+        if not maybe:
+            return set()
+        self.exact_checks += len(maybe)
+        rows = self._client.query(
+            "SELECT hash FROM comment_hashes WHERE hash IN {hashes:Array(String)}", parameters={"hashes": maybe},
+        ).result_rows
+        found = {h.decode() if isinstance(h, bytes) else h for (h,) in rows}
+        self.duplicates += len(found)
+        return found
+
+    def add(self, records: Iterable[Dict[str, str]]):
+        """
+        records are {"hash", "service", "comment_id"}
+        """
+        records = list(records)
+        if not records:
+            return
+        self._client.insert(
+            "comment_hashes",
+            [[r["hash"], r["service"], r["comment_id"]] for r in records],
+            column_names=["hash", "service", "comment_id"],
+        )
+        with self._lock:
+            for r in records:
+                self.bloom.add(r["hash"])
+
+    def stats(self) -> Dict[str, int]:
+        return {"bloom_items": self.bloom.count, "exact_checks": self.exact_checks, "duplicates": self.duplicates}
+
+
+def split_duplicates(hashes: List[str], seen: Set[str]) -> List[int]:
+    """
+    indices of the first occurrence of every hash that was not seen before
+    """
+    keep, batch = [], set()
+    for i, h in enumerate(hashes):
+        if h not in seen and h not in batch:
+            batch.add(h)
+            keep.append(i)
+    return keep
@@ -0,0 +1,388 @@
+"""
+embedding service layer: batch encoding with a text-hash cache and an in-process IVF index
+over a memory-mapped float16 matrix.
+
+    python embeddings.py build          # fill the local index from the qdrant collection
+    python embeddings.py train          # (re)train IVF centroids over everything in the index
+"""
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# qdrant - поиск в коллекции qdrant (как раньше), local - IVF индекс в памяти процесса
+EMBEDDING_INDEX = os.getenv("EMBEDDING_INDEX", "qdrant")
+INDEX_DIR = Path(os.getenv("EMBEDDING_INDEX_DIR", "./bin/embedding_index"))
+IVF_LISTS = int(os.getenv("EMBEDDING_IVF_LISTS", "256"))
+IVF_PROBES = int(os.getenv("EMBEDDING_IVF_PROBES", "16"))
+
+
+def text_key(text: str) -> str:
+    # только схлопываем пробелы: регистр меняет вектор энкодера, поэтому тексты с разным регистром - разные ключи
+    return hashlib.sha1(" ".join(text.split()).encode()).hexdigest()
+
+
+class EmbeddingService:
+    """
+    batch encoding through one sentence-transformers encoder, repeated texts are served from an LRU keyed by text hash
+    """
+
+    def __init__(self, encoder, cache_size: int = EMBEDDING_CACHE_SIZE, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        keys = [text_key(t) for t in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+
+        missing = list({key: text for key, text in zip(keys, texts) if key not in found}.items())
+        self.hits += sum(key in found for key in keys)
+        self.misses += len(missing)
+        if missing:
+            vectors = self.encoder.encode(
+                [text for _, text in missing],
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+            ).astype(np.float32)
+            with self._lock:
+                for (key, _), vector in zip(missing, vectors):
+                    found[key] = vector
+                    self._cache[key] = vector
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+
+        return np.stack([found[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+    def stats(self) -> Dict[str, int]:
+        return {"cache_entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    spherical k-means over normalized vectors
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=min(k, len(data)), replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        for c in range(len(centroids)):
+            members = data[assign == c]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+    return centroids
+
+
+class LocalIndex:
+    """
+    IVF index over a float16 matrix memory-mapped from disk. rows are append-only: re-adding an id appends a new row
+    and hides the old one, so the index can be extended as comments arrive without a rebuild.
+    the directory is shared between processes (the queue worker appends, the api searches): writes hold an
+    exclusive flock and every instance picks up rows and centroids written by the others before it reads.
+    an append becomes visible only when the row count in `rows` is replaced after both files were written,
+    a writer that died half way leaves a tail that readers ignore and the next writer cuts off.
+    until centroids are trained (train()), search scans every row
+    """
+
+    def __init__(self, path: Path = INDEX_DIR, probes: int = IVF_PROBES):
+        self.path = path
+        self.probes = probes
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._vectors_file = self.path / "vectors.f16"
+        self._ids_file = self.path / "ids.txt"
+        self._assign_file = self.path / "assign.i32"
+        self._centroids_file = self.path / "centroids.npy"
+        self._rows_file = self.path / "rows"
+        self._lock_file = self.path / "index.lock"
+
+        self.ids: List[str] = []
+        self.row_of: Dict[str, int] = {}
+        self.dim: Optional[int] = None
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: Dict[int, List[np.ndarray]] = {}
+        # сколько байт ids.txt и строк assign.i32 уже прочитано, mtime загруженных центроидов
+        self._ids_offset = 0
+        self._assigned = 0
+        self._centroids_mtime: Optional[int] = None
+        self._matrix = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self.row_of)
+
+    @contextmanager
+    def _file_lock(self, mode: int):
+        with open(self._lock_file, "a") as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _committed(self) -> Tuple[int, Optional[int]]:
+        """
+        (rows, dim) of the last completed append
+        """
+        if self._rows_file.exists():
+            rows, dim = self._rows_file.read_text().split()
+            return int(rows), int(dim)
+        if not self._ids_file.exists():
+            return 0, None
+        # индекс, собранный до появления файла rows: ids дописывались вторыми, им и верим
+        rows = self._ids_file.read_bytes().count(b"\n")
+        return rows, (self._vectors_file.stat().st_size // 2 // rows if rows else None)
+
+    def _commit(self):
+        tmp = self._rows_file.with_suffix(".tmp")
+        tmp.write_text(f"{len(self.ids)} {self.dim}")
+        tmp.replace(self._rows_file)
+
+    def _changed(self) -> bool:
+        centroids_mtime = self._centroids_file.stat().st_mtime_ns if self._centroids_file.exists() else None
+        return self._committed()[0] != len(self.ids) or centroids_mtime != self._centroids_mtime
+
+    def refresh(self):
+        """
+        picks up rows and centroids written to the directory by other processes
+        """
+        with self._lock:
+            if not self._changed():
+                return
+            with self._file_lock(fcntl.LOCK_SH):
+                self._load()
+
+    def _load(self):
+        rows, dim = self._committed()
+        if rows > len(self.ids):
+            with open(self._ids_file, "rb") as f:
+                f.seek(self._ids_offset)
+                tail = f.read()
+            # строки сверх закоммиченного числа - недописанный хвост упавшего процесса
+            for line in tail.split(b"\n")[:rows - len(self.ids)]:
+                self._ids_offset += len(line) + 1
+                id_ = line.decode()
+                self.row_of[id_] = len(self.ids)
+                self.ids.append(id_)
+            self.dim = self.dim or dim
+
+        if self._centroids_file.exists():
+            mtime = self._centroids_file.stat().st_mtime_ns
+            if mtime != self._centroids_mtime:
+                # центроиды переобучены - списки строятся заново
+                self.centroids = np.load(self._centroids_file)
+                self._centroids_mtime = mtime
+                self._lists = {c: [] for c in range(len(self.centroids))}
+                self._assigned = 0
+        if self.centroids is not None and self._assigned < len(self.ids):
+            stored = self._stored_assign(self._assigned)[:len(self.ids) - self._assigned]
+            # assign.i32 может отставать от ids (потерян, скопирован без него) - остаток раскладывается заново
+            computed = self._assign_rows(self._assigned + len(stored), len(self.ids))
+            self._extend_lists(self._assigned, np.concatenate([stored, computed]))
+            self._assigned = len(self.ids)
+
+    def _stored_assign(self, start: int) -> np.ndarray:
+        if not self._assign_file.exists() or self._assign_file.stat().st_size <= start * 4:
+            return np.zeros(0, dtype=np.int32)
+        return np.fromfile(self._assign_file, dtype=np.int32, offset=start * 4)
+
+    def _assign_rows(self, start: int, stop: int, chunk: int = 65536) -> np.ndarray:
+        if start >= stop:
+            return np.zeros(0, dtype=np.int32)
+        vectors = self._vectors()
+        return np.concatenate([
+            np.argmax(np.asarray(vectors[i:min(i + chunk, stop)], dtype=np.float32) @ self.centroids.T, axis=1)
+            for i in range(start, stop, chunk)
+        ]).astype(np.int32)
+
+    def _extend_lists(self, start: int, assign: np.ndarray):
+        rows = np.arange(start, start + len(assign))
+        for c in np.unique(assign):
+            self._lists.setdefault(int(c), []).append(rows[assign == c])
+
+    def _vectors(self) -> np.ndarray:
+        if self._matrix is None or len(self._matrix) != len(self.ids):
+            self._matrix = np.memmap(self._vectors_file, dtype=np.float16, mode="r", shape=(len(self.ids), self.dim))
+        return self._matrix
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(ids):
+            return
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            # сначала строки других процессов, иначе номера новых строк разъедутся с файлами
+            self._load()
+            self.dim = self.dim or vectors.shape[1]
+            start = len(self.ids)
+            self._truncate(start)
+            with open(self._vectors_file, "ab") as f:
+                f.write(vectors.astype(np.float16).tobytes())
+            lines = "".join(f"{id_}\n" for id_ in ids).encode()
+            with open(self._ids_file, "ab") as f:
+                f.write(lines)
+            self._ids_offset += len(lines)
+            for offset, id_ in enumerate(ids):
+                self.row_of[str(id_)] = start + offset
+            self.ids.extend(str(id_) for id_ in ids)
+            if self.centroids is not None:
+                assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+                stored = self._assign_file.stat().st_size // 4 if self._assign_file.exists() else 0
+                with open(self._assign_file, "ab") as f:
+                    # дописываем и пропущенные строки, чтобы assign.i32 снова совпадал с ids построчно
+                    f.write(self._assign_rows(stored, start).tobytes())
+                    f.write(assign.tobytes())
+                self._extend_lists(start, assign)
+                self._assigned = len(self.ids)
+            self._commit()
+
+    def _truncate(self, rows: int):
+        """
+        cuts off what a crashed writer appended after the last commit, so new rows start at `rows` in every file
+        """
+        for path, size in ((self._vectors_file, rows * self.dim * 2), (self._ids_file, self._ids_offset),
+                           (self._assign_file, rows * 4)):
+            if path.exists() and path.stat().st_size > size:
+                os.truncate(path, size)
+
+    def train(self, lists: int = IVF_LISTS, sample: int = 50000):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._load()
+            if not self.ids:
+                return
+            vectors = self._vectors()
+            rows = np.random.default_rng(0).choice(len(vectors), size=min(sample, len(vectors)), replace=False)
+            self.centroids = kmeans(np.asarray(vectors[np.sort(rows)], dtype=np.float32), lists)
+            assign = self._assign_rows(0, len(self.ids))
+            assign.tofile(self._assign_file)
+            np.save(self._centroids_file, self.centroids)
+            self._centroids_mtime = self._centroids_file.stat().st_mtime_ns
+            self._lists = {c: [] for c in range(len(self.centroids))}
+            self._extend_lists(0, assign)
+            self._assigned = len(self.ids)
+
+    def search(self, query: np.ndarray, limit: int, score_threshold: float = 0.0,
+               chunk: int = 65536) -> List[Tuple[str, float]]:
+        query = np.asarray(query, dtype=np.float32)
+        self.refresh()
+        with self._lock:
+            if not self.ids:
+                return []
+            vectors = self._vectors()
+            if self.centroids is None:
+                candidates = np.arange(len(self.ids))
+            else:
+                probe = np.argsort(self.centroids @ query)[-self.probes:]
+                candidates = np.sort(np.concatenate([part for c in probe for part in self._lists.get(int(c), [])]))
+            ids = self.ids
+            row_of = self.row_of
+
+        found_rows, found_scores = [], []
+        for i in range(0, len(candidates), chunk):
+            rows = candidates[i:i + chunk]
+            scores = np.asarray(vectors[rows], dtype=np.float32) @ query
+            keep = scores >= score_threshold
+            found_rows.append(rows[keep])
+            found_scores.append(scores[keep])
+        rows = np.concatenate(found_rows) if found_rows else np.array([], dtype=np.int64)
+        scores = np.concatenate(found_scores) if found_scores else np.array([], dtype=np.float32)
+
+        order = np.argsort(-scores)
+        results = []
+        for j in order:
+            id_ = ids[rows[j]]
+            # строка устарела, если id потом добавили заново
+            if row_of.get(id_) != rows[j]:
+                continue
+            results.append((id_, float(scores[j])))
+            if len(results) >= limit:
+                break
+        return results
+
+    def stats(self) -> Dict[str, object]:
+        self.refresh()
+        return {
+            "vectors": len(self.row_of),
+            "rows": len(self.ids),
+            "dim": self.dim,
+            "lists": 0 if self.centroids is None else len(self.centroids),
+            "probes": self.probes,
+        }
+
+
+def ensure_collection(client, collection: str, dim: int):
+    from qdrant_client import models
+
+    if not client.collection_exists(collection):
+        client.create_collection(
+            collection_name=collection,
+            vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE),
+        )
+
+
+def upsert_embeddings(client, collection: str, ids: Sequence[str], vectors: np.ndarray,
+                      payloads: Optional[Sequence[dict]] = None, batch: int = 256):
+    """
+    bulk upsert keyed by comment_id, so reprocessing a comment overwrites its point
+    """
+    from qdrant_client import models
+
+    for i in range(0, len(ids), batch):
+        client.upsert(
+            collection_name=collection,
+            points=models.Batch(
+                ids=list(ids[i:i + batch]),
+                vectors=vectors[i:i + batch].tolist(),
+                payloads=list(payloads[i:i + batch]) if payloads is not None else None,
+            ),
+            wait=True,
+        )
+
+
+def build_from_qdrant(index: LocalIndex, client, collection: str, batch: int = 1024):
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection, limit=batch, offset=offset, with_vectors=True, with_payload=False,
+        )
+        if points:
+            index.add([str(p.id) for p in points], np.array([p.vector for p in points], dtype=np.float32))
+            print(f"{len(index)} vectors")
+        if offset is None:
+            break
+
+
+if __name__ == "__main__":
+    import sys
+
+    local_index = LocalIndex()
+    if sys.argv[1:] == ["build"]:
+        from qdrant_client import QdrantClient
+
+        qdrant = QdrantClient(url=os.getenv("QDRANT_HOST"), api_key=os.getenv("QDRANT_API_KEY"))
+        build_from_qdrant(local_index, qdrant, "comments")
+        local_index.train()
+    elif sys.argv[1:] == ["train"]:
+        local_index.train()
+    else:
+        print(__doc__)
+        sys.exit(1)
+    print(local_index.stats())
@@ -0,0 +1,237 @@
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import torch
+
+
+def select_device() -> str:
+    """
+    ML_DEVICE=cuda|cpu, по умолчанию cuda если она есть
+    """
+    device = os.getenv("ML_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+    if device == "cpu" and os.getenv("ML_CPU_THREADS"):
+        torch.set_num_threads(int(os.getenv("ML_CPU_THREADS")))
+    return device
+
+
+DEVICE = select_device()
+
+MAX_BATCH_SIZE = int(os.getenv("ML_MAX_BATCH_SIZE", "32"))
+MAX_WAIT_MS = float(os.getenv("ML_MAX_WAIT_MS", "20"))
+# batch_size * longest_sequence: attention cost of a batch grows with the padded length, not the item count
+MAX_BATCH_TOKENS = int(os.getenv("ML_MAX_BATCH_TOKENS", "16384"))
+# on CPU one replica already uses every core through intra-op threads
+NUM_WORKERS = int(os.getenv("ML_WORKERS", "2" if DEVICE == "cuda" else "1"))
+LENGTH_BUCKET = int(os.getenv("ML_LENGTH_BUCKET", "32"))
+
+
+def plan_batches(lengths: Sequence[int], max_batch_size: int = MAX_BATCH_SIZE,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS) -> List[List[int]]:
+    """
+    indices sorted by length and cut into batches limited by item count and padded token budget
+    """
+    batches, batch, longest = [], [], 0
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        if batch and (len(batch) >= max_batch_size or max(longest, lengths[i]) * (len(batch) + 1) > max_batch_tokens):
+            batches.append(batch)
+            batch, longest = [], 0
+        batch.append(i)
+        longest = max(longest, lengths[i])
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@dataclass
+class _Item:
+    payload: Any
+    length: int
+    future: Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class BatcherStats:
+    items: int = 0
+    batches: int = 0
+    full_batches: int = 0
+    deadline_batches: int = 0
+    tokens: int = 0
+    padded_tokens: int = 0
+    # сумма по воркерам; при нескольких воркерах больше реального времени, поэтому пропускная способность
+    # считается по wall_busy_time - времени, когда хотя бы один воркер был занят
+    busy_time: float = 0.0
+    wall_busy_time: float = 0.0
+    recent: deque = field(default_factory=lambda: deque(maxlen=50))
+    _running: int = 0
+    _running_since: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def batch_started(self) -> float:
+        now = time.perf_counter()
+        with self._lock:
+            if not self._running:
+                self._running_since = now
+            self._running += 1
+        return now
+
+    def batch_finished(self, started: float):
+        now = time.perf_counter()
+        with self._lock:
+            self.busy_time += now - started
+            self._running -= 1
+            if not self._running:
+                self.wall_busy_time += now - self._running_since
+
+    def record(self, lengths: List[int], full: bool):
+        padded = max(lengths) * len(lengths)
+        self.items += len(lengths)
+        self.batches += 1
+        self.full_batches += full
+        self.deadline_batches += not full
+        self.tokens += sum(lengths)
+        self.padded_tokens += padded
+        self.recent.append({
+            "size": len(lengths),
+            "max_length": max(lengths),
+            "tokens": sum(lengths),
+            "padding_waste": round(1 - sum(lengths) / padded, 4) if padded else 0.0,
+        })
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "items": self.items,
+            "batches": self.batches,
+            "full_batches": self.full_batches,
+            "deadline_batches": self.deadline_batches,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "padding_ratio": round(1 - self.tokens / self.padded_tokens, 4) if self.padded_tokens else 0.0,
+            "items_per_second": round(self.items / self.wall_busy_time, 2) if self.wall_busy_time else 0.0,
+            "busy_seconds": round(self.wall_busy_time, 3),
+            "worker_busy_seconds": round(self.busy_time, 3),
+            "recent_batches": list(self.recent),
+        }
+
+
+class DynamicBatcher:
+    """
+    long-lived dynamic batching scheduler.
+    inputs are bucketed by token length; a bucket is sent to the workers as soon as it holds max_batch_size items
+    or its padded size (items * longest) reaches max_batch_tokens, otherwise everything pending is flushed
+    (sorted by length, cut by the same limits) once the oldest item waited max_wait_ms.
+    workers are persistent threads, each owning one model replica (worker_id is passed to predict_batch)
+    """
+
+    def __init__(self, predict_batch: Callable[[int, List[Any]], List[Any]], workers: int = NUM_WORKERS,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS, length_bucket: int = LENGTH_BUCKET,
+                 name: str = "inference"):
+        self._predict_batch = predict_batch
+        self._max_batch_size = max_batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self._max_wait = max_wait_ms / 1000
+        self._length_bucket = length_bucket
+        self._inbox: "queue.Queue[Optional[_Item]]" = queue.Queue()
+        self._batches: "queue.Queue[Optional[List[_Item]]]" = queue.Queue(maxsize=2 * workers)
+        self._pending: Dict[int, List[_Item]] = defaultdict(list)
+        self._closed = False
+        self.stats = BatcherStats()
+
+        self._threads = [threading.Thread(target=self._schedule, name=f"{name}-scheduler", daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._work, args=(i,), name=f"{name}-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, payloads: Sequence[Any], lengths: Sequence[int]) -> List[Future]:
+        if self._closed:
+            raise RuntimeError("batcher is closed")
+        futures = []
+        for payload, length in zip(payloads, lengths):
+            future = Future()
+            self._inbox.put(_Item(payload, length, future))
+            futures.append(future)
+        return futures
+
+    def predict(self, payloads: Sequence[Any], lengths: Sequence[int]) -> List[Any]:
+        return [f.result() for f in self.submit(payloads, lengths)]
+
+    def _oldest(self) -> Optional[float]:
+        return min((bucket[0].enqueued_at for bucket in self._pending.values() if bucket), default=None)
+
+    def _emit(self, batch: List[_Item], full: bool):
+        self.stats.record([item.length for item in batch], full)
+        self._batches.put(batch)
+
+    def _fits(self, batch: List[_Item], item: _Item) -> bool:
+        longest = max(item.length, *(x.length for x in batch)) if batch else item.length
+        # одиночный элемент длиннее бюджета всё равно уходит отдельным батчем
+        return not batch or (len(batch) < self._max_batch_size and longest * (len(batch) + 1) <= self._max_batch_tokens)
+
+    def _add(self, item: _Item):
+        bucket = self._pending[item.length // self._length_bucket]
+        if not self._fits(bucket, item):
+            self._emit(list(bucket), full=True)
+            bucket.clear()
+        bucket.append(item)
+        if len(bucket) >= self._max_batch_size:
+            self._emit(list(bucket), full=True)
+            bucket.clear()
+
+    def _flush(self):
+        items = [item for bucket in self._pending.values() for item in bucket]
+        self._pending.clear()
+        for batch in plan_batches([item.length for item in items], self._max_batch_size, self._max_batch_tokens):
+            self._emit([items[i] for i in batch], full=False)
+
+    def _schedule(self):
+        while True:
+            oldest = self._oldest()
+            timeout = None if oldest is None else max(0.0, oldest + self._max_wait - time.monotonic())
+            closing = False
+            try:
+                item = self._inbox.get(timeout=timeout)
+                # забираем всё, что уже лежит в очереди (bulk запрос приходит пачкой)
+                while item is not None:
+                    self._add(item)
+                    item = self._inbox.get_nowait()
+                closing = True
+            except queue.Empty:
+                pass
+            if closing:
+                self._flush()
+                for _ in self._threads[1:]:
+                    self._batches.put(None)
+                return
+            oldest = self._oldest()
+            if oldest is not None and time.monotonic() - oldest >= self._max_wait:
+                self._flush()
+
+    def _work(self, worker_id: int):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+            started = self.stats.batch_started()
+            try:
+                results = self._predict_batch(worker_id, [item.payload for item in batch])
+                for item, result in zip(batch, results):
+                    item.future.set_result(result)
+            except Exception as exc:
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(exc)
+            self.stats.batch_finished(started)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._inbox.put(None)
@@ -0,0 +1,62 @@
+"""
+exports the fine-tuned classifiers to ONNX and quantizes them to int8 (dynamic, per-channel weights):
+
+    python export_onnx.py [--output ./bin/onnx]
+
+produces topics.onnx / sentiment.onnx and their *.int8.onnx versions used by ML_RUNTIME=onnx
+"""
+import argparse
+from pathlib import Path
+
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+
+from runtime import ONNX_DIR, load_tokenizers, load_torch_models
+
+OPSET = 17
+
+
+class LogitsOnly(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        return self.model(*inputs).logits
+
+
+def export(model, tokenizer, input_names, path: Path):
+    sample = tokenizer(["пример отзыва", "ещё один пример отзыва о банке"], padding=True, return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    torch.onnx.export(
+        LogitsOnly(model),
+        tuple(sample[name] for name in input_names),
+        str(path),
+        input_names=input_names,
+        output_names=["logits"],
+        dynamic_axes=dynamic_axes,
+        opset_version=OPSET,
+    )
+    quantized = path.with_suffix(".int8.onnx")
+    quantize_dynamic(str(path), str(quantized), weight_type=QuantType.QInt8, per_channel=True)
+    print(f"{path} -> {quantized}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=str(ONNX_DIR))
+    args = parser.parse_args()
+
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    tokenizer, tokenizer_clf = load_tokenizers()
+    model, clf = load_torch_models()
+    with torch.no_grad():
+        export(model, tokenizer, ["input_ids", "attention_mask"], output / "topics.onnx")
+        export(clf, tokenizer_clf, ["input_ids", "attention_mask", "token_type_ids"], output / "sentiment.onnx")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import pickle
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List
+
+import pymorphy3
+
+LEMMA_CACHE_SIZE = int(os.getenv("LEMMA_CACHE_SIZE", "200000"))
+
+morph = pymorphy3.MorphAnalyzer()
+# список ключевых слов из pickle превращаем в frozenset: проверка вхождения O(1) вместо O(n)
+keywords: FrozenSet[str] = frozenset(pickle.load(open("./keywords_list.pickle", "rb")))
+
+TOKEN_SEPARATORS = re.compile(r"[0-9:,\.!?()-/+*;•$&%]")
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def normal_form(word: str) -> str:
+    return morph.parse(word)[0].normal_form
+
+
+def tokenize(text: str) -> List[str]:
+    if text is None:
+        return []
+    return TOKEN_SEPARATORS.sub(" ", text.replace("\n", " ").lower()).split()
+
+
+def text_lemmatizing(text: str) -> str:
+    return " ".join(x for x in map(normal_form, tokenize(text)) if len(x) > 3)
+
+
+def extract_keywords(texts: Iterable[str]) -> List[List[str]]:
+    """
+    keywords for a whole batch: every distinct word of the batch is lemmatized once
+    """
+    tokens = [tokenize(text) for text in texts]
+    lemmas = {word: normal_form(word) for word in set().union(*tokens)} if tokens else {}
+    return [[lemmas[word] for word in words if len(lemmas[word]) > 3 and lemmas[word] in keywords] for words in tokens]
+
+
+class StageTimer:
+    """
+    accumulated wall time per pipeline stage
+    """
+
+    def __init__(self):
+        self.total: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.total[name] += time.perf_counter() - started
+            self.calls[name] += 1
+
+    def report(self) -> str:
+        cache = normal_form.cache_info()
+        stages = ", ".join(f"{name}={1000 * self.total[name]:.1f}ms" for name in self.total)
+        hit_rate = cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0.0
+        return f"{stages}, lemma cache {cache.currsize}/{cache.maxsize} hit={hit_rate:.1%}"
+
+    def reset(self):
+        self.total.clear()
+        self.calls.clear()
@@ -1,14 +1,18 @@
 import os
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager
 from typing import List
-from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI
-import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from fastapi import FastAPI, HTTPException
 from sentence_transformers import SentenceTransformer
 from qdrant_client import QdrantClient
 
 from models import *
+from embeddings import EMBEDDING_INDEX, EmbeddingService, LocalIndex
+from engine import DEVICE, NUM_WORKERS, DynamicBatcher
+from pipeline import TopicSentimentPipeline
+from replicas import REPLICA_MODE, ReplicaError, ReplicaPool
+from runtime import RUNTIME, load_classifiers
 
 QDRANT_HOST = os.getenv("QDRANT_HOST")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
@@ -19,150 +23,140 @@ qdrant_client = QdrantClient(
     api_key=QDRANT_API_KEY,
 )
 
-CLASSES = [
-    "Дебетовые карты",
-    "Мобильное приложение",
-    "Премиум подписка",
-    "Вклады",
-    "Ипотека",
-    "Эквайринг",
-    "Кредитные карты",
-    "Обслуживание в офисе",
-    "Дистанционное обслуживание",
-    "Кредиты наличными",
-    "Банкоматы",
-    "Денежные переводы",
-    "Обмен валют",
-    "Рефинансирование",
-    "Автокредиты",
-]
-
-MODEL_ARCH = "ai-forever/ruT5-base"
-SENTIMENT_MODEL = "sergeyzh/rubert-mini-frida"
-NUM_WORKERS = 2
+MAX_LENGTH = 1215
 
 sentiment_map = {0: "отрицательно", 1: "нейтрально", 2: "положительно"}
 
 
 def load_models():
-    tokenizer_main = AutoTokenizer.from_pretrained(MODEL_ARCH, use_fast=True)
-    if tokenizer_main.pad_token is None:
-        tokenizer_main.add_special_tokens({"pad_token": tokenizer_main.eos_token})
-
-    tokenizer_clf = AutoTokenizer.from_pretrained(SENTIMENT_MODEL, use_fast=True)
-
     models_pool = []
     for i in range(NUM_WORKERS):
-        model = AutoModelForSequenceClassification.from_pretrained(
-            MODEL_ARCH,
-            num_labels=len(CLASSES),
-            problem_type="multi_label_classification",
-        )
-        state = torch.load("./bin/checkpoint_t5_2/mm2.pt", map_location="cpu")
-        model.load_state_dict(state)
-        model = model.to("cuda").eval()
-
-        clf = AutoModelForSequenceClassification.from_pretrained(
-            "./bin/sentiment_clf",
-            num_labels=3,
-            problem_type="single_label_classification",
-        )
-        clf = clf.to("cuda").eval()
-
-        models_pool.append((tokenizer_main, model, tokenizer_clf, clf))
+        tokenizer_main, model, tokenizer_clf, clf = load_classifiers(RUNTIME, DEVICE)
+        models_pool.append(TopicSentimentPipeline(
+            tokenizer_main, model, tokenizer_clf, clf, DEVICE,
+            max_length=MAX_LENGTH, sentiment_max_length=MAX_LENGTH,
+        ))
 
     return models_pool
 
 
-models_pool = load_models()
-encoder = SentenceTransformer("./bin/embeddings_extractor")
-encoder = encoder.to("cuda")
+if REPLICA_MODE == "process":
+    models_pool = []
+    replica_pool = ReplicaPool(NUM_WORKERS, DEVICE, RUNTIME, max_length=MAX_LENGTH, sentiment_max_length=MAX_LENGTH)
+    text_encoder = replica_pool.encoder
+elif REPLICA_MODE == "thread":
+    models_pool = load_models()
+    replica_pool = None
+    text_encoder = models_pool[0]
+else:
+    raise ValueError(f"unknown ML_REPLICA_MODE: {REPLICA_MODE}")
 
+encoder = SentenceTransformer("./bin/embeddings_extractor")
+encoder = encoder.to(DEVICE)
+embedding_service = EmbeddingService(encoder)
+local_index = LocalIndex() if EMBEDDING_INDEX == "local" else None
 
-def worker_predict(comments: List[InferenceComment], worker_id: int):
-    tokenizer, model, tokenizer_clf, clf = models_pool[worker_id]
 
-    ids = [x.id for x in comments]
-    out = tokenizer(
-        [x.text for x in comments],
-        truncation=True,
-        padding=True,
-        return_tensors="pt",
-        max_length=1215,
-    ).to("cuda")
-    with torch.no_grad():
-        logits = model(**out).logits.detach().cpu()
-        preds = torch.sigmoid(logits).numpy()
+def worker_predict(worker_id: int, texts: List[str]):
+    # в режиме process worker_id не важен: пул сам выбирает наименее загруженную реплику
+    predicted = replica_pool.predict(texts) if replica_pool else models_pool[worker_id].predict(texts)
+    results = []
+    for pairs in predicted:
+        results.append({
+            "topics": [topic for topic, _ in pairs],
+            "sentiments": [sentiment_map[label] for _, label in pairs],
+        })
+    return results
 
-    all_clusters = []
-    for row in preds:
-        clusters = [CLASSES[i] for i in range(len(CLASSES)) if row[i] > 0.5]
-        all_clusters.append(clusters)
 
-    sentiment_inputs = []
-    cluster_indices = []
-    for id_, clusters, comment in zip(ids, all_clusters, comments):
-        for c in clusters:
-            sentiment_inputs.append(c + " [CLS] " + comment.text)
-            cluster_indices.append((id_, c))
+batcher = DynamicBatcher(worker_predict, workers=NUM_WORKERS, name="predicts")
 
-    results = {id_: {"id": id_, "topics": [], "sentiments": []} for id_ in ids}
 
-    if sentiment_inputs:
-        batch = tokenizer_clf(
-            sentiment_inputs,
-            padding=True,
-            truncation=True,
-            max_length=1215,
-            return_tensors="pt",
-        ).to("cuda")
+def token_lengths(texts: List[str]) -> List[int]:
+    ids = text_encoder.tokenizer(texts, truncation=True, max_length=MAX_LENGTH)["input_ids"]
+    return [len(x) for x in ids]
 
-        with torch.no_grad():
-            logits = clf(**batch).logits.detach().cpu().numpy()
-            labels = logits.argmax(axis=1)
 
-        for (id_, cluster), label in zip(cluster_indices, labels):
-            results[id_]["topics"].append(cluster)
-            results[id_]["sentiments"].append(sentiment_map[label])
-    return list(results.values())
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    batcher.close()
+    if replica_pool:
+        replica_pool.close()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/get_comments_predicts")
 def get_comments_predicts(req: InferenceRequest):
-    comments = req.data
-    n = NUM_WORKERS
-    batch_size = 3
-    chunks = [comments[i : i + batch_size] for i in range(0, len(comments), batch_size)]
-
-    results = []
-    for i in range(0, len(chunks), NUM_WORKERS):
-        subchunk = chunks[i : i + NUM_WORKERS]
-        with ThreadPoolExecutor(max_workers=n) as executor:
-            futures = [
-                executor.submit(worker_predict, ch, j) for j, ch in enumerate(subchunk)
-            ]
-            for f in futures:
-                results.extend(f.result())
-
-    return {"predictions": results}
-
-
-@app.get("/embeddings")
-def calculate_embedding_for_comment(comment: str):
-    emb = encoder.encode(
-        [comment], normalize_embeddings=True, convert_to_numpy=True
-    ).tolist()[0]
+    texts = [x.text for x in req.data]
+    try:
+        results = batcher.predict(texts, token_lengths(texts))
+    except (ReplicaError, FutureTimeoutError) as exc:
+        # реплика упала или перезапускается: клиент повторит запрос
+        raise HTTPException(status_code=503, detail=str(exc) or "model replica did not answer in time")
+    return {"predictions": [{"id": x.id, **r} for x, r in zip(req.data, results)]}
+
+
+@app.get("/engine/stats")
+def engine_stats():
+    return {
+        "device": DEVICE,
+        "runtime": RUNTIME,
+        "workers": NUM_WORKERS,
+        "replicas": replica_pool.stats() if replica_pool else {"mode": "thread"},
+        "predicts": batcher.stats.snapshot(),
+    }
+
+
+def search_nearest(embedding, limit: int, score_threshold: float):
+    if local_index is not None:
+        return [{"id": id_, "score": score} for id_, score in local_index.search(embedding, limit, score_threshold)]
 
     results = qdrant_client.search(
         collection_name=QDRANT_COLLECTION_NAME,
-        query_vector=emb,
-        limit=4000,
-        score_threshold=0.9,
+        query_vector=embedding.tolist(),
+        limit=limit,
+        score_threshold=score_threshold,
     )
+    return [{"id": r.id, "score": r.score} for r in results]
 
-    matches = [{"id": r.id, "score": r.score} for r in results]
 
-    return {"embedding": emb, "matches": matches}
+@app.get("/embeddings")
+def calculate_embedding_for_comment(comment: str, limit: int = 4000, score_threshold: float = 0.9):
+    emb = embedding_service.encode([comment])[0]
+    matches = search_nearest(emb, limit, score_threshold)
+    return {"embedding": emb.tolist(), "matches": matches}
+
+
+@app.post("/embeddings/batch")
+def calculate_embeddings(req: EmbeddingBatchRequest):
+    return {"embeddings": embedding_service.encode(req.texts).tolist()}
+
+
+@app.post("/embeddings/index")
+def index_comments(req: IndexUpsertRequest):
+    if local_index is None:
+        raise HTTPException(status_code=409, detail="local embedding index is disabled (EMBEDDING_INDEX=qdrant)")
+    local_index.add([x.id for x in req.items], embedding_service.encode([x.text for x in req.items]))
+    return {"indexed": len(req.items), "total": len(local_index)}
+
+
+@app.get("/embeddings/version")
+def embeddings_version():
+    """
+    changes whenever vectors are added to the index, clients poll it to drop cached neighbour sets
+    """
+    if local_index is not None:
+        return {"version": f"local:{local_index.stats()['rows']}"}
+    return {"version": f"qdrant:{qdrant_client.get_collection(QDRANT_COLLECTION_NAME).points_count}"}
+
+
+@app.get("/embeddings/stats")
+def embeddings_stats():
+    return {
+        "index": EMBEDDING_INDEX,
+        "cache": embedding_service.stats(),
+        "local_index": local_index.stats() if local_index is not None else None,
+    }
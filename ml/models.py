@@ -32,3 +32,16 @@ class InferenceComment(BaseModel):
 
 class InferenceRequest(BaseModel):
     data: List[InferenceComment]
+
+
+class EmbeddingBatchRequest(BaseModel):
+    texts: List[str]
+
+
+class IndexItem(BaseModel):
+    id: str
+    text: str
+
+
+class IndexUpsertRequest(BaseModel):
+    items: List[IndexItem]
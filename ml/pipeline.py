@@ -0,0 +1,215 @@
+import hashlib
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import torch
+
+CLASSES = [
+    "Дебетовые карты",
+    "Мобильное приложение",
+    "Премиум подписка",
+    "Вклады",
+    "Ипотека",
+    "Эквайринг",
+    "Кредитные карты",
+    "Обслуживание в офисе",
+    "Дистанционное обслуживание",
+    "Кредиты наличными",
+    "Банкоматы",
+    "Денежные переводы",
+    "Обмен валют",
+    "Рефинансирование",
+    "Автокредиты",
+]
+
+TOPIC_THRESHOLD = 0.5
+
+# как обрезать отзывы длиннее max_length:
+# head - только начало (как раньше), head_tail - начало и конец, chunk - окна по max_length с агрегацией
+TRUNCATION = os.getenv("ML_TRUNCATION", "head")
+HEAD_SHARE = float(os.getenv("ML_TRUNCATION_HEAD_SHARE", "0.5"))
+MAX_CHUNKS = int(os.getenv("ML_MAX_CHUNKS", "4"))
+# логиты кросс-энкодера по (тема, окно отзыва): повторный отзыв не проходит через энкодер заново
+SENTIMENT_CACHE_SIZE = int(os.getenv("ML_SENTIMENT_CACHE_SIZE", "20000"))
+
+
+def fit_ids(ids: List[int], limit: int, policy: str = TRUNCATION) -> List[List[int]]:
+    """
+    token ids -> one or more windows of at most `limit` tokens
+    """
+    if len(ids) <= limit:
+        return [ids]
+    if policy == "head_tail":
+        head = int(limit * HEAD_SHARE)
+        return [ids[:head] + ids[len(ids) - (limit - head):]]
+    if policy == "chunk":
+        return [ids[i:i + limit] for i in range(0, len(ids), limit)][:MAX_CHUNKS]
+    return [ids[:max(0, limit)]]
+
+
+class TopicSentimentPipeline:
+    """
+    topic classifier (T5) + sentiment classifier over the sentiment BERT encoder.
+
+    every comment is tokenized once per model. the fine-tuned cross-encoder scores [CLS] topic [CLS] comment [SEP],
+    assembled from token ids with the topic part cached per class (same ids as tokenizing the concatenated string).
+    its comment states depend on the topic prefix (full attention), so they can't be shared between topics without
+    changing labels; instead every distinct (topic, comment window) row is encoded once: repeats within a batch
+    share one encoder row and logits are kept in an LRU, so comments seen before skip the encoder
+    """
+
+    def __init__(self, tokenizer, model, tokenizer_clf, clf, device: str,
+                 max_length: Optional[int] = None, sentiment_max_length: int = 1250, truncation: str = TRUNCATION,
+                 sentiment_cache_size: int = SENTIMENT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.tokenizer_clf = tokenizer_clf
+        self.clf = clf
+        self.device = device
+        self.max_length = max_length
+        self.sentiment_max_length = sentiment_max_length
+        self.truncation = truncation
+        self.truncated_texts = 0
+        self._sentiment_cache_size = sentiment_cache_size
+        self._sentiment_cache: "OrderedDict[bytes, torch.Tensor]" = OrderedDict()
+        self._sentiment_lock = threading.Lock()
+        self.encoded_rows = 0
+        self.cached_rows = 0
+        self._topic_ids: Dict[str, List[int]] = {
+            topic: tokenizer_clf(topic, add_special_tokens=False)["input_ids"] for topic in CLASSES
+        }
+
+    def topic_inputs(self, texts: List[str]) -> Dict[str, torch.Tensor]:
+        """
+        padded topic-model inputs. with head_tail/chunk truncation long texts may produce several windows,
+        "owners" maps every row back to its text
+        """
+        if self.truncation == "head":
+            return dict(self.tokenizer(
+                texts,
+                truncation=True,
+                padding=True,
+                return_tensors="pt",
+                max_length=self.max_length,
+            ))
+
+        limit = (self.max_length or self.tokenizer.model_max_length) - 1
+        rows, owners = [], []
+        for i, ids in enumerate(self.tokenizer(texts, add_special_tokens=False)["input_ids"]):
+            windows = fit_ids(ids, limit, self.truncation)
+            self.truncated_texts += len(ids) > limit
+            rows += [window + [self.tokenizer.eos_token_id] for window in windows]
+            owners += [i] * len(windows)
+        inputs = dict(self.tokenizer.pad({"input_ids": rows}, padding=True, return_tensors="pt"))
+        inputs["owners"] = torch.tensor(owners)
+        return inputs
+
+    def comment_ids(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer_clf(texts, add_special_tokens=False)["input_ids"]
+
+    def topics_from_inputs(self, inputs: Dict[str, torch.Tensor]) -> List[List[str]]:
+        inputs = dict(inputs)
+        owners = inputs.pop("owners", None)
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            probs = torch.sigmoid(self.model(**inputs).logits).detach().cpu().float()
+        if owners is not None:
+            # тема есть у отзыва, если она нашлась хотя бы в одном окне
+            merged = torch.zeros((int(owners.max()) + 1, probs.shape[1]))
+            probs = merged.scatter_reduce(0, owners[:, None].expand_as(probs), probs, reduce="amax")
+        return [[CLASSES[i] for i in range(len(CLASSES)) if row[i] > TOPIC_THRESHOLD] for row in probs.numpy()]
+
+    def predict_topics(self, texts: List[str]) -> List[List[str]]:
+        return self.topics_from_inputs(self.topic_inputs(texts))
+
+    def sentiment_windows(self, topic: str, comment_ids: List[int]) -> List[List[int]]:
+        cls_id, sep_id = self.tokenizer_clf.cls_token_id, self.tokenizer_clf.sep_token_id
+        topic_ids = self._topic_ids[topic]
+        budget = self.sentiment_max_length - len(topic_ids) - 3
+        return [[cls_id, *topic_ids, cls_id, *window, sep_id] for window in fit_ids(comment_ids, budget, self.truncation)]
+
+    def sentiment_input_ids(self, topic: str, comment_ids: List[int]) -> List[int]:
+        return self.sentiment_windows(topic, comment_ids)[0]
+
+    def clf_batch(self, rows: List[List[int]]) -> Dict[str, torch.Tensor]:
+        batch = self.tokenizer_clf.pad({"input_ids": rows}, padding=True, return_tensors="pt")
+        if "token_type_ids" in self.tokenizer_clf.model_input_names:
+            batch["token_type_ids"] = torch.zeros_like(batch["input_ids"])
+        return batch.to(self.device)
+
+    @staticmethod
+    def average_windows(logits: torch.Tensor, owners: List[int], count: int) -> torch.Tensor:
+        # логиты всех окон одного отзыва (chunk) усредняются
+        if len(owners) == count:
+            return logits
+        owners = torch.tensor(owners)
+        summed = torch.zeros((count, *logits.shape[1:])).index_add_(0, owners, logits)
+        return summed / torch.bincount(owners, minlength=count).view(-1, *[1] * (logits.dim() - 1))
+
+    @staticmethod
+    def row_key(row: List[int]) -> bytes:
+        return hashlib.sha1(array("i", row).tobytes()).digest()
+
+    def row_logits(self, rows: List[List[int]]) -> torch.Tensor:
+        """
+        cross-encoder logits (rows, labels); only rows that are neither cached nor repeated in `rows` hit the encoder
+        """
+        keys = [self.row_key(row) for row in rows]
+        found: Dict[bytes, torch.Tensor] = {}
+        with self._sentiment_lock:
+            for key in keys:
+                if key in self._sentiment_cache:
+                    self._sentiment_cache.move_to_end(key)
+                    found[key] = self._sentiment_cache[key]
+        missing = {key: row for key, row in zip(keys, rows) if key not in found}
+        self.cached_rows += len(rows) - len(missing)
+        self.encoded_rows += len(missing)
+        if missing:
+            with torch.no_grad():
+                logits = self.clf(**self.clf_batch(list(missing.values()))).logits.detach().cpu().float()
+            found.update(zip(missing, logits))
+            with self._sentiment_lock:
+                for key, row_logits in zip(missing, logits):
+                    self._sentiment_cache[key] = row_logits
+                while len(self._sentiment_cache) > self._sentiment_cache_size:
+                    self._sentiment_cache.popitem(last=False)
+        return torch.stack([found[key] for key in keys])
+
+    def pair_logits(self, comment_ids: Mapping[int, List[int]], pairs: List[Tuple[int, str]]) -> torch.Tensor:
+        """
+        cross-encoder logits (pairs, labels) of (text index, topic) pairs
+        """
+        rows, owners = [], []
+        for n, (i, topic) in enumerate(pairs):
+            windows = self.sentiment_windows(topic, comment_ids[i])
+            rows += windows
+            owners += [n] * len(windows)
+        return self.average_windows(self.row_logits(rows), owners, len(pairs))
+
+    def sentiments_from_ids(self, comment_ids: Mapping[int, List[int]],
+                            topics: List[List[str]]) -> List[List[Tuple[str, int]]]:
+        """
+        comment_ids: sentiment-tokenizer ids (without special tokens) of every text that has topics
+        """
+        results: List[List[Tuple[str, int]]] = [[] for _ in topics]
+        pairs = [(i, topic) for i, text_topics in enumerate(topics) for topic in text_topics]
+        if not pairs:
+            return results
+        labels = self.pair_logits(comment_ids, pairs).numpy().argmax(axis=1)
+        for (i, topic), label in zip(pairs, labels):
+            results[i].append((topic, int(label)))
+        return results
+
+    def predict_sentiments(self, texts: List[str], topics: List[List[str]]) -> List[List[Tuple[str, int]]]:
+        needed = [i for i, text_topics in enumerate(topics) if text_topics]
+        comment_ids = dict(zip(needed, self.comment_ids([texts[i] for i in needed]))) if needed else {}
+        return self.sentiments_from_ids(comment_ids, topics)
+
+    def predict(self, texts: List[str]) -> List[List[Tuple[str, int]]]:
+        """
+        [(topic, sentiment label id), ...] for every text, label ids follow the sentiment head (0 neg, 1 neu, 2 pos)
+        """
+        return self.predict_sentiments(texts, self.predict_topics(texts))
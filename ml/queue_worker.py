@@ -1,170 +1,238 @@
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    AutoModelForSequenceClassification,
-)
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    TrainingArguments,
-    Trainer,
-    AutoModel,
-)
-import torch.nn.functional as F
-from peft import PeftModel, PeftConfig
-from bitsandbytes.nn import Linear4bit
-import torch
-import time
-import torch.nn as nn
-from models import RawComment, Comment
-import glob
-import datetime
-import pika
+import asyncio
+import gzip
 import json
+import logging
 import os
-import pickle
-import pymorphy3
-import re
-import uuid
-
-morph = pymorphy3.MorphAnalyzer()
-keywords_list = pickle.load(open("./keywords_list.pickle", "rb"))
-
-
-def text_lemmatizing(text: str) -> str:
-    if text is None:
-        return ""
-    text = text.replace("\n", " ")
-    text = re.sub("[0-9:,\.!?()-/+*;•$&%]", " ", text.lower())
-    text = [morph.parse(word)[0].normal_form for word in text.split()]
-    text = " ".join([x for x in text if len(x) > 3])
-    return text
-
-
-CLASSES = [
-    "Дебетовые карты",
-    "Мобильное приложение",
-    "Премиум подписка",
-    "Вклады",
-    "Ипотека",
-    "Эквайринг",
-    "Кредитные карты",
-    "Обслуживание в офисе",
-    "Дистанционное обслуживание",
-    "Кредиты наличными",
-    "Банкоматы",
-    "Денежные переводы",
-    "Обмен валют",
-    "Рефинансирование",
-    "Автокредиты",
-]
-
-MODEL_ARCH = "ai-forever/ruT5-base"
-
-tokenizer = AutoTokenizer.from_pretrained(MODEL_ARCH, use_fast=True)
-if tokenizer.pad_token is None:
-    tokenizer.add_special_tokens({"pad_token": tokenizer.eos_token})
-
-model = AutoModelForSequenceClassification.from_pretrained(
-    MODEL_ARCH, num_labels=len(CLASSES), problem_type="multi_label_classification"
+from typing import List
+
+import aio_pika
+from clickhouse_connect import get_client
+from clickhouse_connect.driver.exceptions import OperationalError
+from qdrant_client import QdrantClient
+from sentence_transformers import SentenceTransformer
+
+from common.dedup import content_hash
+from dedup import DedupStore, comment_id_for, split_duplicates
+from embeddings import EMBEDDING_INDEX, EmbeddingService, LocalIndex, ensure_collection, upsert_embeddings
+from engine import DEVICE, plan_batches
+from keywords import StageTimer, extract_keywords
+from models import Comment
+from pipeline import TopicSentimentPipeline
+from runtime import RUNTIME, load_classifiers
+
+logger = logging.getLogger("queue_worker")
+
+tokenizer, model, tokenizer_clf, clf = load_classifiers(RUNTIME, DEVICE)
+pipeline = TopicSentimentPipeline(
+    tokenizer, model, tokenizer_clf, clf, DEVICE, sentiment_max_length=1250,
 )
 
-state = torch.load("./bin/checkpoint_t5_2/mm2.pt", map_location="cpu")
-model.load_state_dict(state)
-
-model = model.to("cuda")
-model.eval()
+QDRANT_COLLECTION_NAME = "comments"
+EMBED_COMMENTS = os.getenv("WORKER_EMBED_COMMENTS", "true").lower() == "true"
+EMBED_RETRIES = int(os.getenv("WORKER_EMBED_RETRIES", "2"))
 
-tokenizer_clf = AutoTokenizer.from_pretrained(
-    "sergeyzh/rubert-mini-frida", use_fast=True
-)
-clf = AutoModelForSequenceClassification.from_pretrained(
-    "./bin/sentiment_clf",
-    num_labels=3,
-    problem_type="single_label_classification",
-    device_map="cuda",
-)
-clf = clf.to("cuda").eval()
+qdrant_client = QdrantClient(url=os.getenv("QDRANT_HOST"), api_key=os.getenv("QDRANT_API_KEY"))
+embedding_service = EmbeddingService(SentenceTransformer("./bin/embeddings_extractor").to(DEVICE), cache_size=0)
+if EMBED_COMMENTS:
+    ensure_collection(
+        qdrant_client, QDRANT_COLLECTION_NAME, embedding_service.encoder.get_sentence_embedding_dimension()
+    )
+# api (main.py) ищет по тем же файлам в ./bin и подхватывает дописанные воркером строки
+local_index = LocalIndex() if EMBED_COMMENTS and EMBEDDING_INDEX == "local" else None
 
+DEDUP_ENABLED = os.getenv("WORKER_DEDUP", "true").lower() == "true"
+dedup_store = DedupStore(get_client(dsn=os.getenv("CLICKHOUSE_DSN"))) if DEDUP_ENABLED else None
 
-def get_predict(comment: str):
-    out = tokenizer([comment], truncation=True, return_tensors="pt")
-    with torch.no_grad():
-        out["input_ids"] = out["input_ids"].to("cuda")
-        out["attention_mask"] = out["attention_mask"].to("cuda")
-        logits = model(**out).logits[0].detach().cpu()
-        preds = torch.sigmoid(logits).numpy()
-        print("logits:", preds)
-
-    clusters = [CLASSES[i] for i in range(len(CLASSES)) if preds[i] > 0.5]
-    if len(clusters) > 0:
-        cluster_batch = tokenizer_clf(
-            [clusters[i] + " [CLS] " + comment for i in range(len(clusters))],
-            padding=True,
-            truncation=True,
-            max_length=1250,
-            return_tensors="pt",
-        )
-        with torch.no_grad():
-            cluster_batch["input_ids"] = cluster_batch["input_ids"].to("cuda")
-            cluster_batch["attention_mask"] = cluster_batch["attention_mask"].to("cuda")
-            cluster_batch["token_type_ids"] = cluster_batch["token_type_ids"].to("cuda")
-            logits = clf(**cluster_batch).logits.detach().cpu().numpy().argmax(axis=1)
-            cls = [{0: "negative", 1: "neutral", 2: "positive"}[l] for l in logits]
-
-        return {"tags": {clusters[i]: cls[i] for i in range(len(clusters))}}
-    return {"tags": {}}
-
-
-def on_message(ch, method, properties, body):
-    try:
-        msg = json.loads(body)
-        clusters = get_predict(msg["comment"])
-        kws = [
-            x for x in text_lemmatizing(msg["comment"]).split() if x in keywords_list
-        ]
-        clusters = {
-            k: {"negative": -1, "neutral": 0, "positive": 1}[v]
-            for k, v in clusters["tags"].items()
-        }
-        result = Comment(
-            date=msg["date"].split("T")[0],
-            comment=msg["comment"],
-            name=msg["name"],
-            rating=msg["rating"],
-            bank=msg["bank"],
-            service=msg["service"],
-            tags=clusters,
-            keywords=kws,
-            source=msg.get("source") or "parsing",
-        )
-        print(result)
-        result = result.model_dump_json()
-
-        ch.basic_publish(exchange="", routing_key="processed-comments", body=result)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    except Exception as e:
-        print("queue_error:", e)
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "32"))
+BATCH_LINGER_MS = float(os.getenv("WORKER_BATCH_LINGER_MS", "200"))
+PREFETCH_COUNT = int(os.getenv("WORKER_PREFETCH_COUNT", str(2 * BATCH_SIZE)))
+RETRY_DELAY = float(os.getenv("WORKER_RETRY_DELAY", "5"))
 
+# сбои clickhouse, rabbitmq и сети ничего не говорят о самих сообщениях: их возвращаем в очередь, а не теряем
+TRANSIENT_ERRORS = (OSError, TimeoutError, asyncio.TimeoutError, aio_pika.exceptions.AMQPError, OperationalError)
 
-def start_consumer():
-    connection = pika.BlockingConnection(pika.URLParameters(os.getenv("AMQP_DSN")))
+SENTIMENT_LABELS = {0: "negative", 1: "neutral", 2: "positive"}
+SENTIMENT_VALUES = {"negative": -1, "neutral": 0, "positive": 1}
 
-    channel = connection.channel()
 
-    try:
-        channel.queue_declare(queue="comments", durable=True)
-        channel.queue_declare(queue="processed-comments", durable=True)
-    except Exception as exc:
-        print(exc)
+def get_predicts(comments: List[str]) -> List[dict]:
+    """
+    the batch is split by token length, so one long review doesn't pad every other comment to its size
+    """
+    lengths = [len(x) for x in pipeline.tokenizer(comments, truncation=True)["input_ids"]]
+    results = [None] * len(comments)
+    for batch in plan_batches(lengths):
+        for i, pairs in zip(batch, pipeline.predict([comments[i] for i in batch])):
+            results[i] = {"tags": {topic: SENTIMENT_LABELS[label] for topic, label in pairs}}
+    return results
 
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue="comments", on_message_callback=on_message)
 
-    print("[*] start listening")
-    channel.start_consuming()
+def get_predict(comment: str):
+    return get_predicts([comment])[0]
+
+
+def index_comments(results: List[Comment]):
+    """
+    embeds the batch and upserts it into qdrant keyed by comment_id, and into the local index when it is enabled
+    """
+    vectors = embedding_service.encode([r.comment for r in results])
+    payloads = [{"bank": r.bank, "service": r.service, "source": r.source, "date": r.date.isoformat()} for r in results]
+    ids = [r.comment_id for r in results]
+    upsert_embeddings(qdrant_client, QDRANT_COLLECTION_NAME, ids, vectors, payloads)
+    if local_index is not None:
+        local_index.add(ids, vectors)
+
+
+def message_hash(msg: dict) -> str:
+    return content_hash(msg["service"], msg["name"], msg["date"], msg["comment"])
+
+
+def build_result(msg: dict, prediction: dict, keywords: List[str]) -> Comment:
+    return Comment(
+        comment_id=comment_id_for(message_hash(msg)),
+        date=msg["date"].split("T")[0],
+        comment=msg["comment"],
+        name=msg["name"],
+        rating=msg["rating"],
+        bank=msg["bank"],
+        service=msg["service"],
+        tags={k: SENTIMENT_VALUES[v] for k, v in prediction["tags"].items()},
+        keywords=keywords,
+        source=msg.get("source") or "parsing",
+    )
+
+
+async def run_batch(channel: aio_pika.abc.AbstractChannel, parsed: List[dict], timer: StageTimer):
+    loop = asyncio.get_running_loop()
+    total = len(parsed)
+    if dedup_store is not None:
+        # повторы (перезапуски парсеров, пересекающиеся окна дат) не доходят до модели
+        with timer.stage("dedup"):
+            hashes = [message_hash(msg) for msg in parsed]
+            seen = await loop.run_in_executor(None, dedup_store.seen, hashes)
+            parsed = [parsed[i] for i in split_duplicates(hashes, seen)]
+        if len(parsed) < total:
+            logger.info("skipped %d duplicate comments", total - len(parsed))
+        if not parsed:
+            return
+    texts = [msg["comment"] for msg in parsed]
+    with timer.stage("inference"):
+        predictions = await loop.run_in_executor(None, get_predicts, texts)
+    with timer.stage("keywords"):
+        kws = await loop.run_in_executor(None, extract_keywords, texts)
+    results = [build_result(*args) for args in zip(parsed, predictions, kws)]
+    if EMBED_COMMENTS:
+        with timer.stage("embeddings"):
+            for attempt in range(EMBED_RETRIES + 1):
+                try:
+                    await loop.run_in_executor(None, index_comments, results)
+                    break
+                except Exception as e:
+                    if attempt == EMBED_RETRIES:
+                        # отзывы всё равно уходят в clickhouse, векторы без точки в qdrant
+                        # находит и досчитывает backfill_embeddings.py --missing (по расписанию)
+                        logger.error("embedding failed after %d attempts, leaving it to the backfill: %r",
+                                     attempt + 1, e)
+                    else:
+                        logger.warning("embedding attempt %d failed, retrying: %r", attempt + 1, e)
+                        await asyncio.sleep(2 ** attempt)
+    # с publisher confirms каждый publish ждёт подтверждения брокера, поэтому отправляем пачку параллельно
+    with timer.stage("publish"):
+        await asyncio.gather(*[
+            channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=result.model_dump_json().encode(),
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key="processed-comments",
+            )
+            for result in results
+        ])
+    if dedup_store is not None:
+        with timer.stage("dedup"):
+            try:
+                await loop.run_in_executor(None, dedup_store.add, [
+                    {"hash": message_hash(msg), "service": r.service, "comment_id": r.comment_id}
+                    for msg, r in zip(parsed, results)
+                ])
+            except Exception as e:
+                # отзывы уже опубликованы, без записи хэша повтор просто пройдёт ещё раз
+                logger.warning("dedup hashes were not recorded: %r", e)
+
+
+async def settle(channel: aio_pika.abc.AbstractChannel, messages: List[aio_pika.abc.AbstractIncomingMessage],
+                 parsed: List[dict], timer: StageTimer):
+    """
+    processes and acks the messages. an infrastructure error requeues all of them,
+    any other error splits the batch, so only the messages that fail on their own are dead-lettered
+    """
+    try:
+        await run_batch(channel, parsed, timer)
+    except TRANSIENT_ERRORS as e:
+        logger.warning("%r, requeueing %d comments", e, len(messages))
+        await asyncio.sleep(RETRY_DELAY)
+        for message in messages:
+            await message.nack(requeue=True)
+        return
+    except Exception as e:
+        if len(messages) == 1:
+            logger.error("dead-lettering a comment: %r", e)
+            await messages[0].nack(requeue=False)
+            return
+        logger.warning("%r, retrying %d comments one by one", e, len(messages))
+        for message, msg in zip(messages, parsed):
+            await settle(channel, [message], [msg], timer)
+        return
+
+    # сообщения обрабатываются строго по очереди, так что ack последнего подтверждает всю пачку
+    await messages[-1].ack(multiple=True)
+
+
+async def process_batch(channel: aio_pika.abc.AbstractChannel, messages: List[aio_pika.abc.AbstractIncomingMessage]):
+    timer = StageTimer()
+    parsed, valid = [], []
+    with timer.stage("decode"):
+        for message in messages:
+            try:
+                # парсеры и api могут сжимать тело, см. AMQP_COMPRESS
+                body = gzip.decompress(message.body) if message.content_encoding == "gzip" else message.body
+                parsed.append(json.loads(body))
+                valid.append(message)
+            except Exception as e:
+                logger.error("dead-lettering an undecodable message: %r", e)
+                await message.nack(requeue=False)
+    if not valid:
+        return
+
+    await settle(channel, valid, parsed, timer)
+    logger.info("processed %d comments: %s", len(valid), timer.report())
+
+
+async def start_consumer():
+    connection = await aio_pika.connect_robust(os.getenv("AMQP_DSN"))
+    async with connection:
+        channel = await connection.channel(publisher_confirms=True)
+        await channel.set_qos(prefetch_count=PREFETCH_COUNT)
+
+        queue = await channel.declare_queue("comments", durable=True)
+        await channel.declare_queue("processed-comments", durable=True)
+
+        inbox: asyncio.Queue = asyncio.Queue()
+        await queue.consume(inbox.put)
+
+        logger.info("start listening")
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await inbox.get()]
+            deadline = loop.time() + BATCH_LINGER_MS / 1000
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(inbox.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            await process_batch(channel, batch)
 
 
 if __name__ == "__main__":
-    start_consumer()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(start_consumer())
@@ -0,0 +1,122 @@
+"""
+regression harness for the inference pipeline.
+
+    python regression.py comments.jsonl                      # compare the pipeline with the legacy per-pair path
+    python regression.py comments.jsonl --save baseline.json  # store current outputs
+    python regression.py comments.jsonl --baseline baseline.json
+
+labels must match the reference exactly, any difference fails the run.
+input: one comment per line, either plain text or a json object with a "comment" field
+"""
+import argparse
+import json
+import sys
+from typing import List, Tuple
+
+import torch
+
+from engine import DEVICE
+from pipeline import CLASSES, TopicSentimentPipeline
+from runtime import RUNTIME, load_classifiers
+
+
+def read_comments(path: str) -> List[str]:
+    comments = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                comments.append(json.loads(line)["comment"])
+            except (ValueError, KeyError, TypeError):
+                comments.append(line)
+    return comments
+
+
+def legacy_predict(pipe: TopicSentimentPipeline, texts: List[str]) -> List[List[Tuple[str, int]]]:
+    """
+    the previous implementation: sentiment inputs are built as strings and tokenized per (topic, comment) pair
+    """
+    results = []
+    for text, topics in zip(texts, pipe.predict_topics(texts)):
+        if not topics:
+            results.append([])
+            continue
+        batch = pipe.tokenizer_clf(
+            [topic + " [CLS] " + text for topic in topics],
+            padding=True,
+            truncation=True,
+            max_length=pipe.sentiment_max_length,
+            return_tensors="pt",
+        ).to(pipe.device)
+        with torch.no_grad():
+            labels = pipe.clf(**batch).logits.detach().cpu().numpy().argmax(axis=1)
+        results.append([(topic, int(label)) for topic, label in zip(topics, labels)])
+    return results
+
+
+def check_input_ids(pipe: TopicSentimentPipeline, texts: List[str]) -> int:
+    mismatches = 0
+    for text in texts:
+        comment_ids = pipe.tokenizer_clf(text, add_special_tokens=False)["input_ids"]
+        for topic in CLASSES:
+            expected = pipe.tokenizer_clf(
+                topic + " [CLS] " + text, truncation=True, max_length=pipe.sentiment_max_length
+            )["input_ids"]
+            if pipe.sentiment_input_ids(topic, comment_ids) != expected:
+                mismatches += 1
+                print(f"input ids differ: topic={topic!r} text={text[:80]!r}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--save")
+    parser.add_argument("--baseline")
+    # 1250 как в queue_worker, сервис использует 1215
+    parser.add_argument("--sentiment-max-length", type=int, default=1250)
+    args = parser.parse_args()
+
+    # только модели: без clickhouse, qdrant и эмбеддингов, которые поднимает queue_worker при импорте
+    tokenizer, model, tokenizer_clf, clf = load_classifiers(RUNTIME, DEVICE)
+    pipe = TopicSentimentPipeline(
+        tokenizer, model, tokenizer_clf, clf, DEVICE, sentiment_max_length=args.sentiment_max_length,
+    )
+
+    texts = read_comments(args.input)
+    failures = check_input_ids(pipe, texts)
+    print(f"input ids: {len(texts) * len(CLASSES)} pairs checked, {failures} mismatches")
+
+    current = []
+    for i in range(0, len(texts), args.batch_size):
+        current.extend(pipe.predict(texts[i:i + args.batch_size]))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            reference = [[tuple(pair) for pair in row] for row in json.load(f)]
+        name = args.baseline
+    else:
+        reference = []
+        for i in range(0, len(texts), args.batch_size):
+            reference.extend(legacy_predict(pipe, texts[i:i + args.batch_size]))
+        name = "legacy"
+
+    diff = [i for i, (a, b) in enumerate(zip(current, reference)) if a != b]
+    for i in diff:
+        print(f"#{i}: {reference[i]} -> {current[i]} | {texts[i][:80]!r}")
+    print(f"labels vs {name}: {len(texts) - len(diff)}/{len(texts)} identical")
+    print(f"sentiment rows: {pipe.encoded_rows} encoded, {pipe.cached_rows} reused")
+    failures += len(diff)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
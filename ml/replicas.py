@@ -0,0 +1,253 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Set, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+from pipeline import TopicSentimentPipeline
+from runtime import load_classifiers, load_tokenizers
+
+# process - отдельный процесс на реплику, thread - запасной вариант: все реплики в одном процессе под GIL
+REPLICA_MODE = os.getenv("ML_REPLICA_MODE", "process")
+# загрузка моделей на CPU может занимать минуты
+READY_TIMEOUT = float(os.getenv("ML_REPLICA_READY_TIMEOUT", "600"))
+PREDICT_TIMEOUT = float(os.getenv("ML_REPLICA_PREDICT_TIMEOUT", "120"))
+MONITOR_INTERVAL = float(os.getenv("ML_REPLICA_MONITOR_INTERVAL", "1"))
+MAX_RESPAWN_DELAY = 60.0
+
+
+class ReplicaError(RuntimeError):
+    pass
+
+
+def split_cores(replicas: int) -> List[List[int]]:
+    cores = sorted(os.sched_getaffinity(0))
+    per_replica = max(1, len(cores) // replicas)
+    return [cores[i * per_replica:(i + 1) * per_replica] or cores for i in range(replicas)]
+
+
+def replica_device(device: str, replica_id: int) -> str:
+    if device == "cuda" and torch.cuda.device_count() > 1:
+        return f"cuda:{replica_id % torch.cuda.device_count()}"
+    return device
+
+
+def pack_ids(ids: List[List[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+    lengths = torch.tensor([len(x) for x in ids], dtype=torch.int32)
+    packed = torch.zeros((len(ids), int(lengths.max()) if ids else 0), dtype=torch.int32)
+    for i, row in enumerate(ids):
+        packed[i, :len(row)] = torch.tensor(row, dtype=torch.int32)
+    return packed, lengths
+
+
+def unpack_ids(packed: torch.Tensor, lengths: torch.Tensor) -> List[List[int]]:
+    return [packed[i, :n].tolist() for i, n in enumerate(lengths.tolist())]
+
+
+def _replica_main(replica_id: int, device: str, cores: List[int], runtime: str,
+                  max_length: Optional[int], sentiment_max_length: int, tasks, results):
+    if device == "cpu":
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    try:
+        tokenizer, model, tokenizer_clf, clf = load_classifiers(runtime, device)
+        pipe = TopicSentimentPipeline(
+            tokenizer, model, tokenizer_clf, clf, device,
+            max_length=max_length, sentiment_max_length=sentiment_max_length,
+        )
+    except Exception as exc:
+        # исключение может не пережить pickle, родителю достаточно текста
+        results.put((None, replica_id, ReplicaError(f"replica {replica_id} failed to load: {exc!r}")))
+        return
+    results.put((None, replica_id, "ready"))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, inputs, packed, lengths = task
+        try:
+            topics = pipe.topics_from_inputs(inputs)
+            output = pipe.sentiments_from_ids(unpack_ids(packed, lengths), topics)
+            results.put((job_id, replica_id, output))
+        except Exception as exc:
+            results.put((job_id, replica_id, exc))
+
+
+class ReplicaPool:
+    """
+    one model replica per process, pinned to its own core set (cpu) or device (cuda).
+    tokenization happens in the dispatcher; token tensors travel to the replica through shared memory
+    (torch.multiprocessing queues), each batch goes to the ready replica with the fewest batches in flight.
+    a monitor thread fails the batches of a replica that died and starts a new one in its place
+    """
+
+    def __init__(self, replicas: int, device: str, runtime: str,
+                 max_length: Optional[int] = None, sentiment_max_length: int = 1250):
+        self._ctx = mp.get_context("spawn")
+        tokenizer, tokenizer_clf = load_tokenizers()
+        # без моделей: в диспетчере нужна только токенизация
+        self.encoder = TopicSentimentPipeline(
+            tokenizer, None, tokenizer_clf, None, "cpu",
+            max_length=max_length, sentiment_max_length=sentiment_max_length,
+        )
+
+        self._device = device
+        self._runtime = runtime
+        self._max_length = max_length
+        self._sentiment_max_length = sentiment_max_length
+        self._cores = split_cores(replicas)
+        self._results = self._ctx.Queue()
+        self._tasks: List = [None] * replicas
+        self._processes: List = [None] * replicas
+        self._ready = [False] * replicas
+        self._assigned: List[Set[int]] = [set() for _ in range(replicas)]
+        self._restarts = [0] * replicas
+        # подряд идущие падения, от них растёт пауза перед перезапуском
+        self._crashes = [0] * replicas
+        # время запланированного перезапуска упавшей реплики, None - реплика не ждёт перезапуска
+        self._respawn_at: List[Optional[float]] = [None] * replicas
+        self._futures: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._job_ids = itertools.count()
+
+        for i in range(replicas):
+            self._spawn(i)
+        try:
+            self._wait_ready()
+        except Exception:
+            self._terminate()
+            raise
+
+        self._dispatcher = threading.Thread(target=self._collect, name="replica-results", daemon=True)
+        self._dispatcher.start()
+        self._monitor_thread = threading.Thread(target=self._monitor, name="replica-monitor", daemon=True)
+        self._monitor_thread.start()
+
+    def _spawn(self, replica: int):
+        # задачи, оставшиеся в очереди упавшей реплики, монитор уже завершил ошибкой
+        self._tasks[replica] = self._ctx.Queue()
+        self._ready[replica] = False
+        process = self._ctx.Process(
+            target=_replica_main,
+            args=(replica, replica_device(self._device, replica), self._cores[replica], self._runtime,
+                  self._max_length, self._sentiment_max_length, self._tasks[replica], self._results),
+            name=f"replica-{replica}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[replica] = process
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + READY_TIMEOUT
+        while not all(self._ready):
+            try:
+                _, replica, output = self._results.get(timeout=MONITOR_INTERVAL)
+            except queue.Empty:
+                for i, process in enumerate(self._processes):
+                    if not self._ready[i] and not process.is_alive():
+                        raise ReplicaError(f"replica {i} exited with code {process.exitcode} while loading")
+                if time.monotonic() > deadline:
+                    pending = [i for i, ready in enumerate(self._ready) if not ready]
+                    raise ReplicaError(f"replicas {pending} not ready after {READY_TIMEOUT:.0f}s")
+                continue
+            if isinstance(output, Exception):
+                raise output
+            self._ready[replica] = True
+
+    def submit(self, texts: List[str]) -> Future:
+        inputs = self.encoder.topic_inputs(texts)
+        packed, lengths = pack_ids(self.encoder.comment_ids(texts))
+        future = Future()
+        with self._lock:
+            # упавшие реплики до перезапуска не получают задач, загружающиеся - только если нет готовых
+            candidates = [i for i, at in enumerate(self._respawn_at) if at is None]
+            if not candidates:
+                raise ReplicaError("no live model replicas, restarting")
+            replica = min(candidates, key=lambda i: (not self._ready[i], len(self._assigned[i])))
+            job_id = next(self._job_ids)
+            self._assigned[replica].add(job_id)
+            self._futures[job_id] = future
+            tasks = self._tasks[replica]
+        tasks.put((job_id, inputs, packed, lengths))
+        return future
+
+    def predict(self, texts: List[str], timeout: Optional[float] = PREDICT_TIMEOUT):
+        return self.submit(texts).result(timeout=timeout)
+
+    def _collect(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            job_id, replica, output = item
+            if job_id is None:
+                # сообщение о загрузке перезапущенной реплики
+                if isinstance(output, Exception):
+                    print(output)
+                else:
+                    self._ready[replica] = True
+                    self._crashes[replica] = 0
+                continue
+            with self._lock:
+                self._assigned[replica].discard(job_id)
+                future = self._futures.pop(job_id, None)
+            # задача могла быть уже завершена ошибкой монитором
+            if future is None or future.done():
+                continue
+            if isinstance(output, Exception):
+                future.set_exception(output)
+            else:
+                future.set_result(output)
+
+    def _monitor(self):
+        while not self._closed.wait(MONITOR_INTERVAL):
+            for i, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                if self._respawn_at[i] is None:
+                    with self._lock:
+                        self._ready[i] = False
+                        lost = [self._futures.pop(job_id, None) for job_id in self._assigned[i]]
+                        self._assigned[i] = set()
+                        self._respawn_at[i] = time.monotonic() + min(MAX_RESPAWN_DELAY, 2 ** self._crashes[i] - 1)
+                        self._crashes[i] += 1
+                        self._restarts[i] += 1
+                    error = ReplicaError(f"replica {i} exited with code {process.exitcode}")
+                    for future in lost:
+                        if future is not None and not future.done():
+                            future.set_exception(error)
+                    print(f"{error}, failed {len(lost)} batches, restarting")
+                if time.monotonic() >= self._respawn_at[i] and not self._closed.is_set():
+                    with self._lock:
+                        # очередь пересоздаётся: умерший процесс мог держать её блокировку на чтение
+                        self._spawn(i)
+                        self._respawn_at[i] = None
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "replicas": len(self._processes),
+            "alive": sum(p.is_alive() for p in self._processes),
+            "ready": sum(self._ready),
+            "restarts": list(self._restarts),
+            "inflight": [len(jobs) for jobs in self._assigned],
+        }
+
+    def _terminate(self):
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+    def close(self):
+        self._closed.set()
+        for tasks in self._tasks:
+            tasks.put(None)
+        self._results.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
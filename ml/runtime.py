@@ -0,0 +1,88 @@
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from pipeline import CLASSES
+
+# torch - fp32 как раньше, torch-int8 - динамическая int8 квантизация Linear слоёв,
+# onnx - квантованные модели из export_onnx.py в onnxruntime (только CPU)
+RUNTIME = os.getenv("ML_RUNTIME", "torch")
+ONNX_DIR = Path(os.getenv("ML_ONNX_DIR", "./bin/onnx"))
+
+MODEL_ARCH = "ai-forever/ruT5-base"
+SENTIMENT_MODEL = "sergeyzh/rubert-mini-frida"
+TOPIC_CHECKPOINT = "./bin/checkpoint_t5_2/mm2.pt"
+SENTIMENT_CHECKPOINT = "./bin/sentiment_clf"
+
+
+def load_tokenizers():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_ARCH, use_fast=True)
+    if tokenizer.pad_token is None:
+        tokenizer.add_special_tokens({"pad_token": tokenizer.eos_token})
+    tokenizer_clf = AutoTokenizer.from_pretrained(SENTIMENT_MODEL, use_fast=True)
+    return tokenizer, tokenizer_clf
+
+
+def load_torch_models():
+    model = AutoModelForSequenceClassification.from_pretrained(
+        MODEL_ARCH, num_labels=len(CLASSES), problem_type="multi_label_classification"
+    )
+    model.load_state_dict(torch.load(TOPIC_CHECKPOINT, map_location="cpu"))
+
+    clf = AutoModelForSequenceClassification.from_pretrained(
+        SENTIMENT_CHECKPOINT, num_labels=3, problem_type="single_label_classification"
+    )
+    return model.eval(), clf.eval()
+
+
+class OnnxClassifier:
+    """
+    onnxruntime session with the call convention of a transformers classifier: model(**batch).logits
+    """
+
+    def __init__(self, path: Path):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if os.getenv("ML_CPU_THREADS"):
+            options.intra_op_num_threads = int(os.getenv("ML_CPU_THREADS"))
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {x.name for x in self.session.get_inputs()}
+
+    def __call__(self, **inputs):
+        feed = {k: v.cpu().numpy() for k, v in inputs.items() if k in self.input_names}
+        return SimpleNamespace(logits=torch.from_numpy(self.session.run(["logits"], feed)[0]))
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+def load_classifiers(runtime: str = RUNTIME, device: str = "cpu"):
+    """
+    (tokenizer, topic model, sentiment tokenizer, sentiment model) for the configured runtime
+    """
+    tokenizer, tokenizer_clf = load_tokenizers()
+
+    if runtime == "onnx":
+        if device != "cpu":
+            raise ValueError("onnx runtime is CPU only, set ML_DEVICE=cpu")
+        model = OnnxClassifier(ONNX_DIR / "topics.int8.onnx")
+        clf = OnnxClassifier(ONNX_DIR / "sentiment.int8.onnx")
+        return tokenizer, model, tokenizer_clf, clf
+
+    model, clf = load_torch_models()
+    if runtime == "torch-int8":
+        if device != "cpu":
+            raise ValueError("torch-int8 runtime is CPU only, set ML_DEVICE=cpu")
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        clf = torch.quantization.quantize_dynamic(clf, {torch.nn.Linear}, dtype=torch.qint8)
+    elif runtime != "torch":
+        raise ValueError(f"unknown ML_RUNTIME: {runtime}")
+    return tokenizer, model.to(device), tokenizer_clf, clf.to(device)
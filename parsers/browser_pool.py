@@ -0,0 +1,117 @@
+"""
+one chromium per flow run with N isolated contexts working through a queue of urls.
+images, fonts, media and analytics are aborted at the route level, waits are event driven
+(selectors, network idle, item counts) instead of fixed sleeps:
+
+    async with BrowserPool(pages=4) as pool:
+        results = await pool.map(urls, parse_detail)
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, Iterable, List, Optional, TypeVar, Union
+from urllib.parse import urlsplit
+
+from playwright.async_api import Page, Route, async_playwright
+
+BROWSER_PAGES = int(os.getenv("BROWSER_PAGES", "4"))
+BLOCKED_RESOURCES = {"image", "font", "media"}
+BLOCKED_HOSTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "mc.yandex.ru",
+    "top-fwz1.mail.ru",
+    "vk.com",
+    "facebook.net",
+)
+
+T = TypeVar("T")
+
+
+def proxy_settings() -> Optional[dict]:
+    if not os.getenv("PROXY_HOST"):
+        return None
+    return {
+        "server": os.getenv("PROXY_HOST"),
+        "username": os.getenv("PROXY_USER"),
+        "password": os.getenv("PROXY_PASSWORD"),
+    }
+
+
+async def block_heavy_requests(route: Route):
+    request = route.request
+    host = urlsplit(request.url).hostname or ""
+    if request.resource_type in BLOCKED_RESOURCES or any(host.endswith(h) for h in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def scroll_until_stable(page: Page, item_selector: str, max_rounds: int = 30,
+                              idle_timeout: float = 5_000,
+                              until: Optional[Callable[[Page], Awaitable[bool]]] = None) -> int:
+    """
+    scrolls to the bottom until the number of `item_selector` elements stops growing (or `until(page)` is true),
+    each round waits for new items to appear (not a fixed sleep); returns the final count
+    """
+    count = await page.locator(item_selector).count()
+    for _ in range(max_rounds):
+        if until is not None and await until(page):
+            break
+        await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+        try:
+            await page.wait_for_function(
+                "([selector, count]) => document.querySelectorAll(selector).length > count",
+                arg=[item_selector, count],
+                timeout=idle_timeout,
+            )
+        except Exception:
+            break
+        count = await page.locator(item_selector).count()
+    return count
+
+
+class BrowserPool:
+    def __init__(self, pages: int = BROWSER_PAGES, headless: bool = True, proxy: Optional[dict] = None):
+        self._size = pages
+        self._headless = headless
+        self._proxy = proxy if proxy is not None else proxy_settings()
+        self._playwright = None
+        self._browser = None
+        self._pages: "asyncio.Queue[Page]" = asyncio.Queue()
+        self._contexts = []
+
+    async def __aenter__(self) -> "BrowserPool":
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(headless=self._headless, proxy=self._proxy)
+        for _ in range(self._size):
+            context = await self._browser.new_context()
+            await context.route("**/*", block_heavy_requests)
+            self._contexts.append(context)
+            self._pages.put_nowait(await context.new_page())
+        return self
+
+    async def __aexit__(self, *exc):
+        for context in self._contexts:
+            await context.close()
+        await self._browser.close()
+        await self._playwright.stop()
+
+    async def run(self, fn: Callable[[Page], Awaitable[T]]) -> T:
+        """
+        runs fn on a free page of the pool
+        """
+        page = await self._pages.get()
+        try:
+            return await fn(page)
+        finally:
+            self._pages.put_nowait(page)
+
+    async def map(self, urls: Iterable[str], fn: Callable[[Page, str], Awaitable[T]]) -> List[Union[T, Exception]]:
+        """
+        fn(page, url) for every url on up to `pages` pages at once, results keep the order of urls.
+        a failed url yields its exception instead of failing the whole run
+        """
+        return await asyncio.gather(
+            *[self.run(lambda page, url=url: fn(page, url)) for url in urls], return_exceptions=True,
+        )
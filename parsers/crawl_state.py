@@ -0,0 +1,134 @@
+"""
+per-source state of incremental crawling, stored in clickhouse `crawl_state`:
+keys of reviews already published, fingerprints of list pages and the newest review time.
+
+    state = await CrawlState.load("banki")
+    comments = await crawler.crawl(page_urls(), parse_page, stop=state.list_stop(comment_key, comment_day))
+    fresh = state.new(comments, comment_key)
+    ... publish fresh ...
+    await state.commit(fresh, comment_key, date=lambda c: c.date)
+
+list pagination stops at the first page that is unchanged since the last run, already holds a known review
+or reaches reviews older than the watermark day,
+detail pages of known reviews are not fetched at all
+"""
+import asyncio
+import datetime
+import hashlib
+from typing import Callable, Dict, Iterable, List, Optional, Set, TypeVar
+
+from parsers.dao import clickhouse
+
+T = TypeVar("T")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def review_key(*parts) -> str:
+    """
+    key for sites without review ids: hash of the fields that identify a review
+    """
+    return hashlib.sha1("\x1f".join(" ".join(str(p).split()).lower() for p in parts).encode()).hexdigest()
+
+
+def comment_key(comment) -> str:
+    return review_key(comment.date.date(), comment.name, comment.comment)
+
+
+def comment_day(comment) -> datetime.date:
+    return comment.date.date()
+
+
+def fingerprint(keys: Iterable[str]) -> str:
+    return hashlib.sha1("\n".join(keys).encode()).hexdigest()
+
+
+class CrawlState:
+    def __init__(self, source: str, known: Set[str], pages: Dict[str, str], watermark: datetime.datetime):
+        self.source = source
+        self.known = known
+        self.pages = pages
+        self.watermark = watermark
+        self._seen_pages: Dict[str, str] = {}
+
+    @classmethod
+    async def load(cls, source: str) -> "CrawlState":
+        def query():
+            rows = clickhouse().query(
+                "SELECT kind, key, value FROM crawl_state FINAL WHERE source = {source:String}",
+                parameters={"source": source},
+            ).result_rows
+            # до первого сохранения состояния опираемся на последнюю дату в comments
+            last_date = clickhouse().query(
+                "SELECT MAX(date) FROM comments WHERE service = {source:String}",
+                parameters={"source": source},
+            ).result_rows[0][0]
+            return rows, last_date
+
+        rows, last_date = await asyncio.to_thread(query)
+        known = {key for kind, key, _ in rows if kind == "review"}
+        pages = {key: value for kind, key, value in rows if kind == "page"}
+        watermarks = [datetime.datetime.fromisoformat(value) for kind, _, value in rows if kind == "watermark"]
+        if not isinstance(last_date, datetime.datetime):
+            last_date = datetime.datetime.combine(last_date, datetime.time()) if last_date else EPOCH
+        return cls(source, known, pages, max(watermarks + [last_date]))
+
+    @property
+    def since(self) -> datetime.date:
+        """
+        day of the newest known review, same-day reviews are told apart by their keys
+        """
+        return self.watermark.date()
+
+    def is_known(self, key: str) -> bool:
+        return key in self.known
+
+    def reached_known(self, url: str, keys: List[str]) -> bool:
+        """
+        true when the list page at `url` did not change since the last run or shows an already published review
+        """
+        page_print = fingerprint(keys)
+        self._seen_pages[url] = page_print
+        return self.pages.get(url) == page_print or any(k in self.known for k in keys)
+
+    def list_stop(self, key: Callable[[T], str],
+                  day: Callable[[T], datetime.date]) -> Callable[[str, List[T]], bool]:
+        """
+        stop predicate for Crawler.crawl: known content, or reviews dated before `since`.
+        the date cut applies on every run, not only before the first saved state: lists are sorted by date,
+        so older reviews were either published already or are deliberately not re-crawled
+        """
+
+        def stop(url: str, items: List[T]) -> bool:
+            known = self.reached_known(url, [key(x) for x in items])
+            return known or any(day(x) < self.since for x in items)
+
+        return stop
+
+    def new(self, items: Iterable[T], key: Callable[[T], str]) -> List[T]:
+        fresh, keys = [], set()
+        for item in items:
+            k = key(item)
+            if k not in self.known and k not in keys:
+                keys.add(k)
+                fresh.append(item)
+        return fresh
+
+    async def commit(self, items: Iterable[T], key: Callable[[T], str],
+                     date: Optional[Callable[[T], datetime.datetime]] = None):
+        """
+        records published items, the list pages seen in this run and the new watermark.
+        call after publishing, so a failed run is simply repeated next time
+        """
+        items = list(items)
+        rows = [[self.source, "review", key(x), ""] for x in items]
+        rows += [[self.source, "page", url, value] for url, value in self._seen_pages.items()]
+        if date is not None and items:
+            self.watermark = max([self.watermark] + [date(x) for x in items])
+        rows.append([self.source, "watermark", "", self.watermark.isoformat()])
+
+        await asyncio.to_thread(
+            clickhouse().insert, "crawl_state", rows, column_names=["source", "kind", "key", "value"],
+        )
+        self.known.update(r[2] for r in rows if r[1] == "review")
+        self.pages.update(self._seen_pages)
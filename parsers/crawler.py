@@ -0,0 +1,213 @@
+"""
+shared async crawling engine for the requests-based parser flows:
+one keep-alive httpx client, bounded concurrency and a minimal interval between requests per host,
+retries with jittered backoff and an ETag / Last-Modified cache for list pages.
+
+a flow plugs in only its page urls and a parse function:
+
+    async with Crawler(headers=HEADERS) as crawler:
+        comments = await crawler.crawl(page_urls, parse_page, stop=lambda url, items: is_old(items))
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+CRAWLER_PER_HOST = int(os.getenv("CRAWLER_PER_HOST", "4"))
+CRAWLER_RATE = float(os.getenv("CRAWLER_RATE", "8"))  # запросов в секунду на хост
+CRAWLER_RETRIES = int(os.getenv("CRAWLER_RETRIES", "4"))
+CRAWLER_BACKOFF = float(os.getenv("CRAWLER_BACKOFF", "0.5"))
+CRAWLER_TIMEOUT = float(os.getenv("CRAWLER_TIMEOUT", "20"))
+CRAWLER_CACHE_DIR = Path(os.getenv("CRAWLER_CACHE_DIR", "/tmp/resflow_crawler_cache"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+
+
+@dataclass
+class Page:
+    url: str
+    text: str
+    status: int
+    # ответ 304: страница не изменилась с прошлого запуска, text взят из кэша
+    not_modified: bool = False
+
+
+def detect_encoding(content: bytes) -> str:
+    """
+    the same guess as requests' apparent_encoding, for sites that do not declare a charset
+    """
+    import charset_normalizer
+
+    match = charset_normalizer.from_bytes(content).best()
+    return match.encoding if match else "utf-8"
+
+
+class HostLimiter:
+    """
+    per-host semaphore plus a minimal interval between request starts
+    """
+
+    def __init__(self, concurrency: int, rate: float):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._interval = 1 / rate if rate > 0 else 0.0
+        self._lock = asyncio.Lock()
+        self._next_at = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        async with self._lock:
+            delay = self._next_at - time.monotonic()
+            self._next_at = max(self._next_at, time.monotonic()) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, *exc):
+        self._semaphore.release()
+
+
+class ResponseCache:
+    """
+    validators and bodies of list pages on disk, so the next run can send conditional requests
+    """
+
+    def __init__(self, path: Path = CRAWLER_CACHE_DIR):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, url: str) -> Path:
+        return self.path / f"{hashlib.sha1(url.encode()).hexdigest()}.json"
+
+    def get(self, url: str) -> Optional[dict]:
+        file = self._file(url)
+        if not file.exists():
+            return None
+        try:
+            return json.loads(file.read_text(encoding="utf-8"))
+        except ValueError:
+            return None
+
+    def put(self, url: str, response: httpx.Response, text: str):
+        validators = {k: response.headers[k] for k in ("etag", "last-modified") if k in response.headers}
+        if validators:
+            self._file(url).write_text(json.dumps({**validators, "text": text}, ensure_ascii=False), encoding="utf-8")
+
+    @staticmethod
+    def conditional_headers(entry: Optional[dict]) -> Dict[str, str]:
+        if not entry:
+            return {}
+        headers = {}
+        if "etag" in entry:
+            headers["If-None-Match"] = entry["etag"]
+        if "last-modified" in entry:
+            headers["If-Modified-Since"] = entry["last-modified"]
+        return headers
+
+
+class Crawler:
+    def __init__(self, headers: Optional[Dict[str, str]] = None, per_host: int = CRAWLER_PER_HOST,
+                 rate: float = CRAWLER_RATE, retries: int = CRAWLER_RETRIES, backoff: float = CRAWLER_BACKOFF,
+                 timeout: float = CRAWLER_TIMEOUT, cache: Optional[ResponseCache] = None,
+                 default_encoding: Union[str, Callable[[bytes], str]] = "utf-8"):
+        self._per_host = per_host
+        self._retries = retries
+        self._backoff = backoff
+        self._limiters: Dict[str, HostLimiter] = defaultdict(lambda: HostLimiter(per_host, rate))
+        self._cache = cache if cache is not None else ResponseCache()
+        self._client = httpx.AsyncClient(
+            headers=headers,
+            timeout=timeout,
+            follow_redirects=True,
+            default_encoding=default_encoding,
+            limits=httpx.Limits(max_connections=4 * per_host, max_keepalive_connections=4 * per_host),
+        )
+        self.requests = 0
+        self.not_modified = 0
+
+    async def __aenter__(self) -> "Crawler":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self._client.aclose()
+
+    async def fetch(self, url: str, method: str = "GET", cached: bool = False) -> Page:
+        """
+        cached=True sends If-None-Match / If-Modified-Since from the previous run (meant for list pages)
+        """
+        entry = self._cache.get(url) if cached else None
+        limiter = self._limiters[urlsplit(url).netloc]
+        for attempt in range(self._retries + 1):
+            try:
+                async with limiter:
+                    self.requests += 1
+                    response = await self._client.request(
+                        method, url, headers=self._cache.conditional_headers(entry),
+                    )
+                if response.status_code == 304 and entry:
+                    self.not_modified += 1
+                    return Page(url, entry["text"], 304, not_modified=True)
+                if response.status_code not in RETRY_STATUSES or attempt == self._retries:
+                    response.raise_for_status()
+                    text = response.text
+                    if cached:
+                        self._cache.put(url, response, text)
+                    return Page(url, text, response.status_code)
+                retry_after = response.headers.get("retry-after", "")
+            except httpx.TransportError:
+                if attempt == self._retries:
+                    raise
+                retry_after = ""
+            delay = float(retry_after) if retry_after.isdigit() else self._backoff * 2 ** attempt
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    async def fetch_all(self, urls: Iterable[str], parse: Callable[[Page], Union[T, Awaitable[T]]],
+                        cached: bool = False) -> List[Union[T, Exception]]:
+        """
+        fetches and parses independent pages (e.g. review details) concurrently, results keep the order of urls.
+        a failed page yields its exception instead of failing the whole batch
+        """
+
+        async def run(url):
+            page = await self.fetch(url, cached=cached)
+            result = parse(page)
+            return await result if asyncio.iscoroutine(result) else result
+
+        return await asyncio.gather(*[run(url) for url in urls], return_exceptions=True)
+
+    async def crawl(self, pages: Iterable[str], parse: Callable[[Page], List[T]],
+                    stop: Optional[Callable[[str, List[T]], bool]] = None, window: Optional[int] = None,
+                    cached: bool = True) -> List[T]:
+        """
+        paginated listing: fetches `window` pages at a time (in order) and stops after the first window
+        in which `stop(page url, items of the page)` is true or a page came back empty
+        """
+        window = window or self._per_host
+        pages = iter(pages)
+        items: List[T] = []
+        while True:
+            urls = [url for _, url in zip(range(window), pages)]
+            if not urls:
+                return items
+            done = False
+            for url, result in zip(urls, await self.fetch_all(urls, parse, cached=cached)):
+                if isinstance(result, Exception):
+                    raise result
+                items.extend(result)
+                # stop вызывается для каждой страницы окна: он может запоминать увиденные страницы
+                page_done = stop is not None and stop(url, result)
+                done = done or not result or page_done
+            if done:
+                return items
@@ -1,13 +1,12 @@
+import functools
 import os
 
-from prefect import task
 from clickhouse_connect import get_client
 
 
-@task
-async def fetch_last_parsing_date(service):
-    ch_client = get_client(dsn=os.getenv("CLICKHOUSE_DSN"))
-    dt = ch_client.query(
-        f"SELECT MAX(date) FROM comments WHERE service = '{service}'"
-    ).result_rows[0][0]
-    return dt
+@functools.lru_cache(maxsize=1)
+def clickhouse():
+    """
+    one client per worker process, shared by every task of the flow run
+    """
+    return get_client(dsn=os.getenv("CLICKHOUSE_DSN"))
@@ -0,0 +1,36 @@
+import asyncio
+from typing import List
+
+from common.dedup import content_hash
+from parsers.dao import clickhouse
+from parsers.models import RawComment
+
+
+def comment_hash(comment: RawComment) -> str:
+    return content_hash(comment.service, comment.name, comment.date.isoformat(), comment.comment)
+
+
+async def drop_duplicates(comments: List[RawComment]) -> List[RawComment]:
+    """
+    drops comments the worker has already processed (comment_hashes) and repeats within the run.
+    one run publishes at most a few thousand comments, so a single exact lookup is enough here,
+    the bloom filter lives in the worker, which sees every message
+    """
+    hashes = [comment_hash(c) for c in comments]
+    if not hashes:
+        return comments
+    rows = await asyncio.to_thread(
+        lambda: clickhouse().query(
+            "SELECT hash FROM comment_hashes WHERE hash IN {hashes:Array(String)}",
+            parameters={"hashes": list(set(hashes))},
+        ).result_rows
+    )
+    seen = {h.decode() if isinstance(h, bytes) else h for (h,) in rows}
+    fresh = []
+    for comment, h in zip(comments, hashes):
+        if h not in seen:
+            seen.add(h)
+            fresh.append(comment)
+    if len(fresh) < len(comments):
+        print(f"dropped {len(comments) - len(fresh)} duplicate comments")
+    return fresh
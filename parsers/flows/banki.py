@@ -1,71 +1,67 @@
 import datetime
 import json
-import os
+from typing import List
 
 from prefect import flow, task
-import requests
 from bs4 import BeautifulSoup
-import aio_pika
 
+from parsers.crawler import Crawler, Page
 from parsers.models import RawComment
-from parsers.dao import fetch_last_parsing_date
+from parsers.dedup import drop_duplicates
+from parsers.publisher import publish_comments
+from parsers.crawl_state import CrawlState, comment_day, comment_key
 
 
-# move to env
-RABBITMQ_URL = os.getenv("AMQP_DSN")
-QUEUE_NAME = "comments"
+BASE_URL = "https://www.banki.ru/services/responses/bank/gazprombank/"
+PAGE_COUNT = 29
 
 
-@task
-async def parse_comments(last_parsing_date):
+def page_urls():
+    for page in range(1, PAGE_COUNT + 1):
+        yield f"{BASE_URL}?page={page}&is_countable=on"
+
+
+def parse_page(page: Page) -> List[RawComment]:
+    soup = BeautifulSoup(page.text, "html.parser")
+    scripts = soup.find_all("script", {"type": "application/ld+json"})
     comments = []
-    for page in range(1, 30):
-        cont = requests.post(
-            f"https://www.banki.ru/services/responses/bank/gazprombank/?page={page}&is_countable=on"
-        ).content
-        soup = BeautifulSoup(cont, "html.parser")
-        scripts = soup.find_all("script", {"type": "application/ld+json"})
-        for rev in json.loads(scripts[0].text.strip())["review"]:
-            date, comment, rating, name = (
-                rev["datePublished"],
-                rev["description"],
-                rev["reviewRating"]["ratingValue"],
-                rev["name"],
-            )
-            date = datetime.datetime.strptime(date.split()[0], "%Y-%m-%d").date()
-            rating = float(rating) if rating is not None else 4
-            if date < last_parsing_date:
-                return comments
-            msg = RawComment(
-                comment=comment,
-                date=date,
-                name=name,
-                rating=rating,
-                bank="газпромбанк",
-                service="banki",
-                source="parsing",
-            )
-            comments.append(msg)
+    for rev in json.loads(scripts[0].text.strip())["review"]:
+        date, comment, rating, name = (
+            rev["datePublished"],
+            rev["description"],
+            rev["reviewRating"]["ratingValue"],
+            rev["name"],
+        )
+        comments.append(RawComment(
+            comment=comment,
+            date=datetime.datetime.strptime(date.split()[0], "%Y-%m-%d"),
+            name=name,
+            rating=float(rating) if rating is not None else 4,
+            bank="газпромбанк",
+            service="banki",
+            source="parsing",
+        ))
     return comments
 
 
+@task
+async def parse_comments(state: CrawlState):
+    async with Crawler() as crawler:
+        comments = await crawler.crawl(page_urls(), parse_page, stop=state.list_stop(comment_key, comment_day))
+    return state.new([c for c in comments if comment_day(c) >= state.since], comment_key)
+
+
 @flow(
     name="banki.ru",
     log_prints=True,
 )
 async def parse_banki_ru():
-    last_parsing_date = await fetch_last_parsing_date("banki")
-    comments = await parse_comments(last_parsing_date)
+    state = await CrawlState.load("banki")
+    comments = await parse_comments(state)
 
     print(f"banki.ru parsed {len(comments)} comments")
+    fresh = await drop_duplicates(comments)
 
-    connection = await aio_pika.connect_robust(RABBITMQ_URL)
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue(QUEUE_NAME, durable=True)
+    await publish_comments(fresh)
 
-        for comm in comments:
-            await channel.default_exchange.publish(
-                aio_pika.Message(body=comm.model_dump_json().encode()),
-                routing_key=queue.name,
-            )
+    await state.commit(comments, comment_key, date=lambda c: c.date)
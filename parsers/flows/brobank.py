@@ -1,68 +1,70 @@
 import datetime
-import os
+from typing import List
 
-import aio_pika
 from prefect import flow, task
-import requests
 from bs4 import BeautifulSoup
 
+from parsers.crawler import Crawler, Page
 from parsers.models import RawComment
-from parsers.dao import fetch_last_parsing_date
+from parsers.dedup import drop_duplicates
+from parsers.publisher import publish_comments
+from parsers.crawl_state import CrawlState, comment_day, comment_key
 
 
-@task
-async def parse_comments(last_parsing_date):
+PAGE_COUNT = 3
+
+
+def page_urls():
+    for p in range(1, PAGE_COUNT + 1):
+        yield f"https://brobank.ru/banki/gazprombank/comments/comment-page-{p}/"
+
+
+def parse_page(page: Page) -> List[RawComment]:
+    soup = BeautifulSoup(page.text, "html.parser")
+    comms = soup.find_all(class_="comment", attrs={"itemprop": "comment"})
     dataset = []
-    for p in range(1, 4):
-        cont = requests.post(
-            f"https://brobank.ru/banki/gazprombank/comments/comment-page-{p}/#comments"
-        ).content
-        soup = BeautifulSoup(cont, "html.parser")
-        comms = soup.find_all(class_="comment", attrs={"itemprop": "comment"})
-        for rev in comms:
-            try:
-                comment, date, rating, name = (
-                    rev.find("p").get_text(),
-                    rev.find("time", {"itemprop": "datePublished"}).get_text(),
-                    rev.find("span", "new-card__rating_num").get("data-count"),
-                    rev.find("cite", {"itemprop": "creator"}).get_text(),
-                )
-                date = date.replace("Отзыв от", "").replace("в", "").strip()
-                date = datetime.datetime.strptime(date.split()[0], "%d.%m.%Y")
-                if date < last_parsing_date:
-                    return
-                msg = RawComment(
-                    comment=comment,
-                    date=date,
-                    name=name,
-                    rating=rating,
-                    bank="газпромбанк",
-                    service="brobank",
-                    source="parsing",
-                )
-                dataset.append(msg)
-            except:
-                continue
+    for rev in comms:
+        try:
+            comment, date, rating, name = (
+                rev.find("p").get_text(),
+                rev.find("time", {"itemprop": "datePublished"}).get_text(),
+                rev.find("span", "new-card__rating_num").get("data-count"),
+                rev.find("cite", {"itemprop": "creator"}).get_text(),
+            )
+            date = date.replace("Отзыв от", "").replace("в", "").strip()
+            date = datetime.datetime.strptime(date.split()[0], "%d.%m.%Y")
+            dataset.append(RawComment(
+                comment=comment,
+                date=date,
+                name=name,
+                rating=rating,
+                bank="газпромбанк",
+                service="brobank",
+                source="parsing",
+            ))
+        except Exception:
+            continue
     return dataset
 
 
+@task
+async def parse_comments(state: CrawlState):
+    async with Crawler() as crawler:
+        comments = await crawler.crawl(page_urls(), parse_page, stop=state.list_stop(comment_key, comment_day))
+    return state.new([c for c in comments if comment_day(c) >= state.since], comment_key)
+
+
 @flow(
     name="brobank.ru",
     log_prints=True,
 )
 async def parse_brobank_ru():
-    last_parsing_date = await fetch_last_parsing_date("brobank")
-    comments = await parse_comments(last_parsing_date)
+    state = await CrawlState.load("brobank")
+    comments = await parse_comments(state)
 
     print(f"brobank.ru parsed {len(comments)} comments")
+    fresh = await drop_duplicates(comments)
 
-    connection = await aio_pika.connect_robust(os.getenv("AMQP_DSN"))
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue("comments", durable=True)
+    await publish_comments(fresh)
 
-        for comm in comments:
-            await channel.default_exchange.publish(
-                aio_pika.Message(body=comm.model_dump_json().encode()),
-                routing_key=queue.name,
-            )
+    await state.commit(comments, comment_key, date=lambda c: c.date)
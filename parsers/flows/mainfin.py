@@ -1,89 +1,77 @@
-import asyncio
 from datetime import datetime
-import os
 
-import aio_pika
 from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright
+from playwright.async_api import Page
 from prefect import flow, task
 
-from parsers.dao import fetch_last_parsing_date
+from parsers.browser_pool import BrowserPool
+from parsers.dedup import drop_duplicates
+from parsers.publisher import publish_comments
+from parsers.crawl_state import CrawlState, comment_day, comment_key
 from parsers.models import RawComment
 
 
-@task
-async def task_workflow(last_parsing_date):
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            proxy={
-                "server": os.getenv("PROXY_HOST"),
-                "username": os.getenv("PROXY_USER"),
-                "password": os.getenv("PROXY_PASSWORD"),
-            },
-        )
-
-        page = await browser.new_page()
-
-        dataset = []
-
-        await page.goto(
-            f"https://mainfin.ru/bank/gazprombank/otzyvy",
-            timeout=100_000,
-            wait_until="domcontentloaded",
-        )
-
-        count = 0
-        while True:
-            await page.evaluate("window.scrollBy(0, 250)")
-            await asyncio.sleep(1)
-            button = page.locator(
-                "a.load-more-reviews.btn.btn--transparent-blue.btn--min-width.btn--margin-t"
-            )
-            await asyncio.sleep(1)
-            if await button.is_visible():
-                print("next")
-                await button.click()
-                count = 0
-            else:
-                await page.evaluate("window.scrollBy(0, -500)")
-                count += 1
-            if count > 3:
-                break
-
-        text = page.locator("div.reviews-item")
-        count = await text.count()
-
-        for i in range(count):
-            html = await text.nth(i).inner_html()
-            soup = BeautifulSoup(html, "html.parser")
-            comment = soup.find(class_="reviews-item__text").get_text()
-            rating = soup.find("div", class_="reviews-item__rate").get_text()
-            date = (
-                soup.find("div", class_="reviews-item__info-desc").get_text().split()[0]
-            )
-            name = soup.find("div", class_="reviews-item__info").get_text().split()[0]
-            tag = soup.find("a", class_="tag").get_text()
-            parsed_date = datetime.strptime(date, "%d.%m.%Y")
-            if parsed_date.date() < last_parsing_date:
-                print("already parsed")
-                break
-
-            dataset.append(
-                RawComment(
-                    date=parsed_date,
-                    comment=comment,
-                    name=name,
-                    rating=rating,
-                    bank="газпромбанк",
-                    service="mainfin",
-                    source="parsing",
-                )
+ITEM_SELECTOR = "div.reviews-item"
+LOAD_MORE_SELECTOR = "a.load-more-reviews.btn.btn--transparent-blue.btn--min-width.btn--margin-t"
+
+
+def parse_item(html: str):
+    soup = BeautifulSoup(html, "html.parser")
+    comment = soup.find(class_="reviews-item__text").get_text()
+    rating = soup.find("div", class_="reviews-item__rate").get_text()
+    date = (
+        soup.find("div", class_="reviews-item__info-desc").get_text().split()[0]
+    )
+    name = soup.find("div", class_="reviews-item__info").get_text().split()[0]
+    return RawComment(
+        date=datetime.strptime(date, "%d.%m.%Y"),
+        comment=comment,
+        name=name,
+        rating=rating,
+        bank="газпромбанк",
+        service="mainfin",
+        source="parsing",
+    )
+
+
+async def load_reviews(page: Page, state: CrawlState, max_clicks: int = 200):
+    await page.goto(
+        "https://mainfin.ru/bank/gazprombank/otzyvy",
+        timeout=60_000,
+        wait_until="domcontentloaded",
+    )
+    await page.wait_for_selector(ITEM_SELECTOR, timeout=30_000)
+    items = page.locator(ITEM_SELECTOR)
+    button = page.locator(LOAD_MORE_SELECTOR)
+
+    for _ in range(max_clicks):
+        count = await items.count()
+        # отзывы идут от новых к старым: если последний загруженный уже опубликован или старый, дальше листать незачем
+        last = parse_item(await items.nth(count - 1).inner_html())
+        if state.is_known(comment_key(last)) or comment_day(last) < state.since:
+            break
+        if not await button.is_visible():
+            break
+        await button.click()
+        try:
+            await page.wait_for_function(
+                "([selector, count]) => document.querySelectorAll(selector).length > count",
+                arg=[ITEM_SELECTOR, count],
+                timeout=15_000,
             )
+        except Exception:
+            break
 
-        return dataset
+    return [await items.nth(i).inner_html() for i in range(await items.count())]
 
-    await browser.close()
+
+@task
+async def task_workflow(state: CrawlState):
+    async with BrowserPool(pages=1) as pool:
+        items = await pool.run(lambda page: load_reviews(page, state))
+
+    comments = [parse_item(html) for html in items]
+    return state.new([c for c in comments if comment_day(c) >= state.since], comment_key)
 
 
 @flow(
@@ -91,18 +79,12 @@ async def task_workflow(last_parsing_date):
     log_prints=True,
 )
 async def parse_mainfin_ru():
-    last_parsing_date = await fetch_last_parsing_date("mainfin")
-    comments = await task_workflow(last_parsing_date)
+    state = await CrawlState.load("mainfin")
+    comments = await task_workflow(state)
 
     print(f"mainfin.ru parsed {len(comments)} comments")
+    fresh = await drop_duplicates(comments)
 
-    connection = await aio_pika.connect_robust(os.getenv("AMQP_DSN"))
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue("comments", durable=True)
+    await publish_comments(fresh)
 
-        for comm in comments:
-            await channel.default_exchange.publish(
-                aio_pika.Message(body=comm.model_dump_json().encode()),
-                routing_key=queue.name,
-            )
+    await state.commit(comments, comment_key, date=lambda c: c.date)
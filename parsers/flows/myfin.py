@@ -1,64 +1,55 @@
-import os
 from datetime import datetime
 
-from playwright.async_api import async_playwright
+from playwright.async_api import Page
 from bs4 import BeautifulSoup
 from prefect import flow, task
-import aio_pika
 
+from parsers.browser_pool import BrowserPool
 from parsers.models import RawComment
-from parsers.dao import fetch_last_parsing_date
-
-QUEUE_NAME = "comments"
+from parsers.dedup import drop_duplicates
+from parsers.publisher import publish_comments
+from parsers.crawl_state import CrawlState, comment_key
 
 
 @task
-async def parse_data(last_parsing_date):
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=False,
-            proxy={
-                "server": os.getenv("PROXY_HOST"),
-                "username": os.getenv("PROXY_USER"),
-                "password": os.getenv("PROXY_PASSWORD"),
-            },
-        )
-        page = await browser.new_page()
-        dataset = []
-
+async def parse_data(state: CrawlState):
+    async def load(page: Page):
         await page.goto(
-            f"https://ru.myfin.by/bank/gazprombank/otzyvy?limit=50",
-            timeout=100_000,
+            "https://ru.myfin.by/bank/gazprombank/otzyvy?limit=50",
+            timeout=60_000,
             wait_until="domcontentloaded",
         )
         await page.wait_for_selector("div.reviews-list__item")
         text = page.locator("div.reviews-list__item")
-        count = await text.count()
+        return [await text.nth(i).inner_html() for i in range(await text.count())]
 
-        for i in range(count):
-            html = await text.nth(i).inner_html()
-            soup = BeautifulSoup(html, "html.parser")
-            name = soup.find(class_="review-author__name").get_text()
-            comment = soup.find(class_="review-block__text").get_text()
-            date = soup.find(class_="review-info__date").get_text().strip()
-            date = datetime.strptime(date, "%d.%m.%Y")
-            if date < last_parsing_date:
-                return dataset
+    # headless=False оставлен как было в этом потоке
+    async with BrowserPool(pages=1, headless=False) as pool:
+        items = await pool.run(load)
 
-            rating = soup.find(class_="star-rating__text").get_text()
-            dataset.append(
-                RawComment(
-                    comment=comment,
-                    date=date,
-                    name=name,
-                    rating=rating,
-                    bank="газпромбанк",
-                    service="myfin",
-                    source="parsing",
-                )
+    dataset = []
+    for html in items:
+        soup = BeautifulSoup(html, "html.parser")
+        name = soup.find(class_="review-author__name").get_text()
+        comment = soup.find(class_="review-block__text").get_text()
+        date = soup.find(class_="review-info__date").get_text().strip()
+        date = datetime.strptime(date, "%d.%m.%Y")
+        if date.date() < state.since:
+            break
+
+        rating = soup.find(class_="star-rating__text").get_text()
+        dataset.append(
+            RawComment(
+                comment=comment,
+                date=date,
+                name=name,
+                rating=rating,
+                bank="газпромбанк",
+                service="myfin",
+                source="parsing",
             )
-    await browser.close()
-    return dataset
+        )
+    return state.new(dataset, comment_key)
 
 
 @flow(
@@ -66,18 +57,12 @@ async def parse_data(last_parsing_date):
     log_prints=True,
 )
 async def parse_ru_myfin_by():
-    last_parsing_date = await fetch_last_parsing_date("myfin")
-    comments = await parse_data(last_parsing_date)
+    state = await CrawlState.load("myfin")
+    comments = await parse_data(state)
 
     print(f"ru.myfin.by parsed {len(comments)} comments")
+    fresh = await drop_duplicates(comments)
 
-    connection = await aio_pika.connect_robust(os.getenv("AMQP_DSN"))
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue(QUEUE_NAME, durable=True)
+    await publish_comments(fresh)
 
-        for comm in comments:
-            await channel.default_exchange.publish(
-                aio_pika.Message(body=comm.model_dump_json().encode()),
-                routing_key=queue.name,
-            )
+    await state.commit(comments, comment_key, date=lambda c: c.date)
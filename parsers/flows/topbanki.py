@@ -1,15 +1,15 @@
 import re
-from datetime import datetime
+from datetime import date, datetime
 from urllib.parse import urljoin
 
-import requests
 from bs4 import BeautifulSoup
 from prefect import flow, task
-import os
+from parsers.crawler import Crawler, detect_encoding
 from parsers.models import RawComment
 from parsers.utils.date_converter import custom_proc_file_topbanki
-from parsers.dao import fetch_last_parsing_date
-import aio_pika
+from parsers.dedup import drop_duplicates
+from parsers.publisher import publish_comments
+from parsers.crawl_state import CrawlState, review_key
 
 BASE_URL = "https://topbanki.ru"
 START_URL = "https://topbanki.ru/banks/gazprombank/page"
@@ -20,18 +20,9 @@ HEADERS = {
     "AppleWebKit/537.36 (KHTML, like Gecko) "
     "Chrome/124.0 Safari/537.36"
 }
-RABBITMQ_URL = os.getenv("AMQP_DSN")
-QUEUE_NAME = "comments"
 
 
-def fetch_html(url: str) -> str:
-    r = requests.get(url, headers=HEADERS, timeout=20)
-    r.raise_for_status()
-    r.encoding = r.apparent_encoding
-    return r.text
-
-
-def parse_main_page(html: str, date_until):
+def parse_main_page(html: str):
     soup = BeautifulSoup(html, "lxml")
     results = []
 
@@ -66,8 +57,6 @@ def parse_main_page(html: str, date_until):
             custom_proc_file_topbanki(date_div.get_text(strip=True)) if date_div else ""
         )
         date = datetime.strptime(date_str, "%d.%m.%Y").date()
-        if date_until and date < date_until.date():
-            break
         results.append(
             {
                 "url": url,
@@ -121,32 +110,43 @@ def parse_detail_page(html: str, url: str):
     }
 
 
+def page_urls():
+    for page_num in range(1, PAGE_COUNT + 1):
+        yield f"{START_URL}{page_num}"
+
+
+def list_key(review) -> str:
+    return review["url"] or review_key(review["date"], review["name"], review["comment"])
+
+
+def list_day(review) -> date:
+    return date.fromisoformat(review["date"])
+
+
 @task
-def parse_comments(last_parsing_date):
-    all_reviews = []
+async def parse_comments(state: CrawlState):
     data = []
-    print("Собираем список отзывов...")
 
-    for page_num in range(1, PAGE_COUNT + 1):
-        print(f"parsing page {page_num}")
-        cur_url = f"{START_URL}{page_num}"
-        html = fetch_html(cur_url)
-        reviews = parse_main_page(html, last_parsing_date)
-        all_reviews.extend(reviews)
+    async with Crawler(headers=HEADERS, default_encoding=detect_encoding) as crawler:
+        print("Собираем список отзывов...")
+        all_reviews = await crawler.crawl(
+            page_urls(),
+            lambda page: parse_main_page(page.text),
+            stop=state.list_stop(list_key, list_day),
+        )
+        # детальные страницы уже опубликованных отзывов не запрашиваем
+        fresh = state.new((r for r in all_reviews if r["url"] is not None and list_day(r) >= state.since), list_key)
+        urls = [r["url"] for r in fresh]
+
+        print(f"Обогащаем данными с детальных страниц ({len(urls)} новых)...")
+        details = await crawler.fetch_all(urls, lambda page: parse_detail_page(page.text, page.url))
 
     enriched = []
-    print("Обогащаем данными с детальных страниц...")
-    for r in all_reviews:
-        if r["url"] is None:
-            continue
-        try:
-            detail_html = fetch_html(r["url"])
-            if last_parsing_date and r["date"] < last_parsing_date.date():
-                continue
-            detail = parse_detail_page(detail_html, r["url"])
+    for url, detail in zip(urls, details):
+        if isinstance(detail, Exception):
+            print(f"[!] Ошибка при обработке {url}: {detail}")
+        else:
             enriched.append(detail)
-        except Exception as e:
-            print(f"[!] Ошибка при обработке {r['url']}: {e}")
 
     for r in enriched:
         if r["rating"] is None:
@@ -162,7 +162,7 @@ def parse_comments(last_parsing_date):
             service="topbanki",
             source="parsing",
         )
-        data.append(msg)
+        data.append((r["url"], msg))
     return data
 
 
@@ -171,16 +171,11 @@ def parse_comments(last_parsing_date):
     log_prints=True,
 )
 async def parse_topbanki_ru():
-    last_parsing_date = await fetch_last_parsing_date("topbanki")
-    comments = await parse_comments(last_parsing_date)
-
-    connection = await aio_pika.connect_robust(RABBITMQ_URL)
-    async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue(QUEUE_NAME, durable=True)
-
-        for comm in comments:
-            await channel.default_exchange.publish(
-                aio_pika.Message(body=comm.model_dump_json().encode()),
-                routing_key=queue.name,
-            )
+    state = await CrawlState.load("topbanki")
+    parsed = await parse_comments(state)
+    comments = [comment for _, comment in parsed]
+    fresh = await drop_duplicates(comments)
+
+    await publish_comments(fresh)
+
+    await state.commit(parsed, key=lambda item: item[0], date=lambda item: item[1].date)
@@ -1,10 +1,11 @@
+import asyncio
 import re
 import json
 from urllib.parse import urljoin
 
-import requests
 from bs4 import BeautifulSoup
-from tqdm import tqdm
+
+from parsers.crawler import Crawler, detect_encoding
 
 BASE_URL = "https://topbanki.ru"
 START_URL = "https://topbanki.ru/banks/gazprombank/page"
@@ -17,13 +18,6 @@ HEADERS = {
 }
 
 
-def fetch_html(url: str) -> str:
-    r = requests.get(url, headers=HEADERS, timeout=20)
-    r.raise_for_status()
-    r.encoding = r.apparent_encoding
-    return r.text
-
-
 def parse_main_page(html: str):
     """Парсим список отзывов на странице списка"""
     soup = BeautifulSoup(html, "lxml")
@@ -109,29 +103,23 @@ def parse_detail_page(html: str, url: str):
     }
 
 
-def main():
-    all_reviews = []
-    print("Собираем список отзывов...")
+async def main():
+    async with Crawler(headers=HEADERS, default_encoding=detect_encoding) as crawler:
+        print("Собираем список отзывов...")
+        pages = [f"{START_URL}{page_num}" for page_num in range(1, PAGE_COUNT + 1)]
+        all_reviews = await crawler.crawl(pages, lambda page: parse_main_page(page.text), cached=False)
 
-    for page_num in tqdm(range(1, PAGE_COUNT + 1)):
-        cur_url = f"{START_URL}{page_num}"
-        html = fetch_html(cur_url)
-        reviews = parse_main_page(html)
-        all_reviews.extend(reviews)
+        print("Обогащаем данными с детальных страниц...")
+        urls = [r["url"] for r in all_reviews if r["url"]]
+        details = iter(await crawler.fetch_all(urls, lambda page: parse_detail_page(page.text, page.url)))
 
     enriched = []
-    print("Обогащаем данными с детальных страниц...")
-    for r in tqdm(all_reviews):
-        if r["url"]:
-            try:
-                detail_html = fetch_html(r["url"])
-                detail = parse_detail_page(detail_html, r["url"])
-                enriched.append(detail)
-            except Exception as e:
-                print(f"[!] Ошибка при обработке {r['url']}: {e}")
-                enriched.append(r)
-        else:
-            enriched.append(r)
+    for r in all_reviews:
+        detail = next(details) if r["url"] else r
+        if isinstance(detail, Exception):
+            print(f"[!] Ошибка при обработке {r['url']}: {detail}")
+            detail = r
+        enriched.append(detail)
 
     # Вывод в консоль
     # for i, item in enumerate(enriched, 1):
@@ -151,4 +139,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,36 @@
+"""
+publishing parsed comments to the `comments` queue, shared by every flow:
+
+    await publish_comments(fresh)
+
+the publisher itself is common/amqp.py, the same one the api uses; the parsers only configure it.
+a flow run may bring its own event loop, the publisher reconnects then
+"""
+import os
+from typing import Iterable
+
+from common.amqp import Publisher
+from parsers.models import RawComment
+
+QUEUE_NAME = "comments"
+
+publisher = Publisher(
+    dsn=os.getenv("AMQP_DSN"),
+    pool_size=1,
+    batch_size=int(os.getenv("AMQP_PUBLISH_BATCH_SIZE", "1000")),
+    compress=os.getenv("AMQP_COMPRESS", "false").lower() == "true",
+    compress_min_bytes=int(os.getenv("AMQP_COMPRESS_MIN_BYTES", "1024")),
+    max_queue_depth=int(os.getenv("AMQP_MAX_QUEUE_DEPTH", "200000")),
+    backpressure_poll=float(os.getenv("AMQP_BACKPRESSURE_POLL", "5")),
+    # парсер никуда не торопится, но и висеть вечно за упавшим воркером не должен
+    backpressure_timeout=float(os.getenv("AMQP_BACKPRESSURE_TIMEOUT", "1800")),
+)
+
+
+async def publish_comments(comments: Iterable[RawComment], queue: str = QUEUE_NAME) -> int:
+    """
+    returns once the broker confirmed every comment, so crawl state can be committed right after
+    """
+    count = await publisher.publish(queue, [c.model_dump_json().encode() for c in comments])
+    print(f"published {count} comments to {queue}")
+    return count